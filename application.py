@@ -3,31 +3,81 @@ from flask_cors import CORS, cross_origin
 from flasgger import Swagger
 from flasgger.utils import swag_from
 from quickanalysis.utils.useful import NumpyEncoder
+from quickanalysis.utils.encoding import make_response
 
 application = app = Flask(__name__)
 Swagger(app)
 app.config['CORS_HEADERS'] = 'Content-Type'
 app.json_encoder = NumpyEncoder
 
-from flask import Flask, request, jsonify, render_template, render_template_string
+from flask import Flask, Response, request, jsonify, render_template, render_template_string
 import json
+import logging
 from astropy.io import fits
-from marshmallow import Schema, fields, ValidationError, validates_schema
+from marshmallow import EXCLUDE, Schema, fields, validate, ValidationError, validates_schema
 
-from quickanalysis.utils.load_data import check_if_s3_image_exists
+from quickanalysis.utils.load_data import ImageNotFoundError
+from quickanalysis.utils.load_data import ImageSelectionError
 from quickanalysis.utils.load_data import get_image_data
-from quickanalysis.utils.load_data import get_subregion_rect
+from quickanalysis.utils.load_data import get_image_histogram
+from quickanalysis.utils.load_data import get_image_preview
+from quickanalysis.utils.load_data import get_image_pyramid
+from quickanalysis.utils.load_data import get_approximate_stats
+from quickanalysis.utils.load_data import get_image_stats
+from quickanalysis.utils.load_data import get_image_value_counts
+from quickanalysis.utils.load_data import get_load_stats
+from quickanalysis.utils.load_data import get_session_statistics
+from quickanalysis.utils.load_data import prefetch_images
+from quickanalysis.analysis.histogram import get_histogram_window
 from quickanalysis.analysis.profile_line import get_intensity_profile
+from quickanalysis.analysis.profile_line import get_intensity_profiles
 from quickanalysis.analysis.profile_line import get_intensity_profile_input_plot
-from quickanalysis.analysis.histogram import get_histogram
+from quickanalysis.analysis.operations import get_clipped_histogram
+from quickanalysis.analysis.operations import run_operations
+from quickanalysis.analysis.preview import FORMATS
+from quickanalysis.analysis.preview import STRETCHES
+from quickanalysis.analysis.region_index import APPROXIMATE_STATS
+from quickanalysis.analysis.region_index import INDEXED_STATS
+from quickanalysis.analysis.region_stats import ALL_STATS
+from quickanalysis.utils import metrics
+from quickanalysis import settings
 
-from quickanalysis.analysis.region_stats import get_mode, get_median, get_mean, get_min, get_max, get_std, get_median_abs_deviation
+logging.basicConfig(level=settings.LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
 
+DEFAULT_PREVIEW_SIZE = 512
+MAX_PREVIEW_SIZE = 4096
+LINE_ARGS = ('x0', 'y0', 'x1', 'y1')
+MAX_SESSION_HISTOGRAM_BINS = 1000
 
-class LineProfileInput(Schema):
+
+def validate_hdu(value):
+    """An HDU is selected by its index in the file or by its EXTNAME."""
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValidationError('hdu must be an HDU index or an EXTNAME')
+    if isinstance(value, int) and value < 0:
+        raise ValidationError('hdu must not be negative')
+
+
+def get_hdu_arg(value):
+    """Parse an hdu query string argument: digits are an index, anything else an EXTNAME."""
+    if value is None or not value.isdigit():
+        return value
+    return int(value)
+
+
+class LineOptionsInput(Schema):
+    """Validate the sampling options of a line profile."""
+    linewidth = fields.Int(validate=validate.Range(min=1))
+    order = fields.Int(validate=validate.Range(min=0, max=5))  # spline interpolation order
+
+
+class LineProfileInput(LineOptionsInput):
     """Parse and validate input for the line profile endpoint."""
     full_filename = fields.Str(required=True)
     s3_directory = fields.Str(required=True)
+    hdu = fields.Raw(validate=validate_hdu)
+    plane = fields.Int(validate=validate.Range(min=0))
     start = fields.Dict(keys=fields.Str(), values=fields.Float(), required=True)
     end = fields.Dict(keys=fields.Str(), values=fields.Float(), required=True)
 
@@ -39,18 +89,179 @@ class LineProfileInput(Schema):
             data['end']['x'], 
             data['end']['y']
         ]
-        print(point_coords)
+        logger.debug('line profile coordinates: %s', point_coords)
         for val in point_coords:
             if val < 0 or val > 1:
                 raise ValidationError(
                     'Input coordinates must be between 0 and 1')
 
 
+class SubregionSchema(Schema):
+    """A rectangle of an image, in coordinates relative to its dimensions (0, 0 is the top left)."""
+    x0 = fields.Float(required=True, validate=validate.Range(min=0, max=1))
+    x1 = fields.Float(required=True, validate=validate.Range(min=0, max=1))
+    y0 = fields.Float(required=True, validate=validate.Range(min=0, max=1))
+    y1 = fields.Float(required=True, validate=validate.Range(min=0, max=1))
+    shape = fields.Str(validate=validate.Equal('rect'))
+
+    @validates_schema(skip_on_field_errors=True)
+    def validate_corners(self, data, **kwargs):
+        if data['x0'] > data['x1'] or data['y0'] > data['y1']:
+            raise ValidationError('The subregion corners must have x0 <= x1 and y0 <= y1')
+
+
+class StatisticsInput(Schema):
+    """Parse and validate input for the statistics endpoint."""
+    full_filename = fields.Str(required=True)
+    s3_directory = fields.Str(required=True)
+    hdu = fields.Raw(validate=validate_hdu)
+    plane = fields.Int(validate=validate.Range(min=0))
+    subregion = fields.Nested(SubregionSchema)
+    stats = fields.List(fields.Str())
+    approximate = fields.Bool()
+
+
+class HistogramInput(Schema):
+    """Parse and validate input for the clipped histogram endpoint."""
+    full_filename = fields.Str(required=True)
+    s3_directory = fields.Str(required=True)
+    hdu = fields.Raw(validate=validate_hdu)
+    plane = fields.Int(validate=validate.Range(min=0))
+    subregion = fields.Nested(SubregionSchema)
+    clip_percent = fields.Float(required=True, allow_none=True, validate=validate.Range(min=0, max=0.5))
+
+
+class HistogramWindowInput(Schema):
+    """Parse and validate input for the level-of-detail histogram endpoint."""
+    full_filename = fields.Str(required=True)
+    s3_directory = fields.Str(required=True)
+    hdu = fields.Raw(validate=validate_hdu)
+    plane = fields.Int(validate=validate.Range(min=0))
+    subregion = fields.Nested(SubregionSchema)
+    lo = fields.Float()
+    hi = fields.Float()
+    max_bins = fields.Int(validate=validate.Range(min=1))
+
+
+class PreviewInput(Schema):
+    """Parse and validate input for the preview endpoint."""
+    full_filename = fields.Str(required=True)
+    s3_directory = fields.Str(required=True)
+    hdu = fields.Raw(validate=validate_hdu)
+    plane = fields.Int(validate=validate.Range(min=0))
+    size = fields.Int(validate=validate.Range(min=1, max=MAX_PREVIEW_SIZE))
+    stretch = fields.Str(validate=validate.OneOf(STRETCHES))
+    format = fields.Str(validate=validate.OneOf(list(FORMATS)))
+    x0 = fields.Float(validate=validate.Range(min=0, max=1))
+    y0 = fields.Float(validate=validate.Range(min=0, max=1))
+    x1 = fields.Float(validate=validate.Range(min=0, max=1))
+    y1 = fields.Float(validate=validate.Range(min=0, max=1))
+
+    @validates_schema(skip_on_field_errors=True)
+    def validate_line(self, data, **kwargs):
+        given = [name in data for name in LINE_ARGS]
+        if any(given) and not all(given):
+            raise ValidationError('A line needs all of x0, y0, x1 and y1')
+
+
+class SessionInput(Schema):
+    """Parse and validate input for the session statistics endpoint."""
+    s3_directory = fields.Str(required=True)
+    full_filenames = fields.List(fields.Str())
+    prefix = fields.Str()
+    hdu = fields.Raw(validate=validate_hdu)
+    plane = fields.Int(validate=validate.Range(min=0))
+    stats = fields.List(fields.Str(validate=validate.OneOf(ALL_STATS)))
+    histogram_bins = fields.Int(validate=validate.Range(min=1, max=MAX_SESSION_HISTOGRAM_BINS))
+    lo = fields.Float()
+    hi = fields.Float()
+
+    @validates_schema(skip_on_field_errors=True)
+    def validate_frames(self, data, **kwargs):
+        if ('full_filenames' in data) == ('prefix' in data):
+            raise ValidationError('Give either full_filenames or prefix')
+
+
+class ImageInput(Schema):
+    """An image in s3."""
+    full_filename = fields.Str(required=True)
+    s3_directory = fields.Str(required=True)
+
+
+class PrefetchInput(Schema):
+    """Parse and validate input for the prefetch endpoint."""
+    images = fields.List(fields.Nested(ImageInput), required=True, validate=validate.Length(min=1))
+
+
+class BatchInput(Schema):
+    """Parse and validate input for the batch endpoint."""
+    full_filename = fields.Str(required=True)
+    s3_directory = fields.Str(required=True)
+    hdu = fields.Raw(validate=validate_hdu)
+    plane = fields.Int(validate=validate.Range(min=0))
+    operations = fields.List(fields.Dict(), required=True)
+
+    @validates_schema(skip_on_field_errors=True)
+    def validate_line_options(self, data, **kwargs):
+        for index, operation in enumerate(data['operations']):
+            if operation.get('type') == 'lineprofile':
+                try:
+                    LineOptionsInput(unknown=EXCLUDE).load(operation)
+                except ValidationError as e:
+                    raise ValidationError({index: e.messages}, 'operations') from e
+
+
+@app.errorhandler(ImageNotFoundError)
+def image_not_found(e):
+    return jsonify({
+        "success": False,
+        "message": str(e),
+    }), 400
+
+
+@app.errorhandler(ImageSelectionError)
+def image_selection_error(e):
+    return jsonify({
+        "success": False,
+        "message": str(e),
+    }), 400
+
+
+@app.before_request
+def start_request_timer():
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.start_request(route)
+
+
+@app.after_request
+def finish_request_timer(response):
+    metrics.finish_request(response.status_code)
+    return response
+
+
+@app.teardown_request
+def discard_request_timer(error):
+    # Only still running if the request failed before a response was made
+    metrics.finish_request(500)
+
+
 @app.route('/', methods=['GET', 'POST'])
 def home():
     return jsonify({"data":"welcome"})
 
 
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    """Return this worker's cache counters, and how many image loads were coalesced."""
+    return jsonify(get_load_stats())
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Return the request timings, bytes fetched and cache counters in the Prometheus text format."""
+    return Response(metrics.render_metrics(get_load_stats()), mimetype='text/plain; version=0.0.4')
+
+
 @app.route("/lineprofiledisplay", methods=["GET"])
 def plotView():
     """This is a route to visualize the line requested for the line profile.
@@ -62,6 +273,8 @@ def plotView():
         y1 (float): 'y' value for the line end point
         filename (str): Photon Ranch filename in S3, including the extension.
         s3_directory (str): The 'folder' that the image resides in s3. [ data | info-images | allsky ]
+        hdu (int or str): Optional HDU index or EXTNAME (default: the first HDU with image data).
+        plane (int): Optional plane of a data cube.
         
     Returns:
         Str: PNG of line intensity plot represented by a base 64 string
@@ -73,15 +286,60 @@ def plotView():
     y0 = float(request.args.get('y0'))
     y1 = float(request.args.get('y1'))
 
-    data = get_image_data(filename, s3_directory)
+    pyramid = get_image_pyramid(
+        filename, s3_directory, get_hdu_arg(request.args.get('hdu')), request.args.get('plane', type=int))
+    data = pyramid[0]
     start = (x0, y0)
     end = (x1, y1)
     profile = get_intensity_profile(data, start, end)
-    selection_plot = get_intensity_profile_input_plot(data, start, end)
+    selection_plot = get_intensity_profile_input_plot(data, start, end, pyramid=pyramid)
     
     return render_template_string("<img src='{{ image }}'/><div>{{data}}</div>", image=selection_plot, data=profile)
 
 
+@app.route('/preview', methods=['GET'])
+@cross_origin()
+def preview():
+    """Return a stretched preview of an image as a PNG or WebP, optionally with a line drawn over it.
+
+    The stretch comes from the image's cached statistics, and the preview of
+    each size and stretch is rendered once and cached, so moving the line only
+    redraws it over the cached preview.
+
+    GET Args:
+        full_filename (str): Photon Ranch filename in S3, including the extension.
+        s3_directory (str): The 'folder' that the image resides in s3. [ data | info-images | allsky ]
+        hdu (int or str): optional HDU index or EXTNAME (default: the first HDU with image data)
+        plane (int): optional plane of a data cube (required if the HDU has several)
+        size (int): optional, pixels along the longest side. Defaults to 512. Images are never enlarged.
+        stretch (str): optional, 'auto' (default) or 'linear'.
+        format (str): optional, 'png' (default) or 'webp'.
+        x0, y0, x1, y1 (float): optional ends of a line to draw, relative to the image dimensions.
+
+    Returns:
+        The encoded image.
+    """
+    try:
+        query = request.args.to_dict()
+        if 'hdu' in query:
+            query['hdu'] = get_hdu_arg(query['hdu'])
+        args = PreviewInput().load(query)
+        line = tuple(args[name] for name in LINE_ARGS) if 'x0' in args else None
+        image_format = args.get('format', 'png')
+        image = get_image_preview(
+            args['full_filename'], args['s3_directory'], args.get('size', DEFAULT_PREVIEW_SIZE),
+            args.get('stretch', 'auto'), image_format, line, hdu=args.get('hdu'), plane=args.get('plane'))
+        return Response(image, mimetype=FORMATS[image_format])
+
+    except ValidationError as e:
+        return jsonify({
+            "success": False,
+            "message": f"Validation error: {str(e)}",
+        }), 400
+    except ImageNotFoundError as e:
+        return image_not_found(e)
+
+
 @app.route('/lineprofile', methods=['POST'])
 @cross_origin()
 def lineprofile():
@@ -90,8 +348,12 @@ def lineprofile():
     Args:
         start (dict): 'x' and 'y' values for the line start point, in [0, 1]
         end (dict): Same as start
+        linewidth (int): Optional width of the line in pixels. Values across the line are averaged.
+        order (int): Optional spline interpolation order, 0 (nearest) to 5. Default is 1 (linear).
         full_filename (str): Photon Ranch filename in S3, including the extension.
         s3_directory (str): The 'folder' that the image resides in s3. [ data | info-images | allsky ]
+        hdu (int or str): Optional HDU index or EXTNAME (default: the first HDU with image data).
+        plane (int): Optional plane of a data cube (required if the HDU has several).
 
     Returns:
         success (boolean): Successful line profile
@@ -114,24 +376,18 @@ def lineprofile():
         full_filename = args['full_filename']
         s3_directory = args['s3_directory']
 
-        # Make sure the requested file exists
-        if not check_if_s3_image_exists(full_filename, s3_directory):
-            return jsonify({
-                "success": False,
-                "message": f"Image does not exist: {s3_directory}/{full_filename}."
-            }), 400
-
         # Get the image data and compute a line profile
-        data = get_image_data(full_filename, s3_directory)
-        profile = get_intensity_profile(data, start, end)
+        data = get_image_data(full_filename, s3_directory, hdu=args.get('hdu'), plane=args.get('plane'))
+        profiles, lengths = get_intensity_profiles(
+            data, [(start, end)], args.get('linewidth', 1), args.get('order', 1))
+        profile = profiles[0, :lengths[0]]
 
-        response = jsonify({
+        return make_response({
             "success": True,
             "start": start,
             "end": end,
             "data": profile,
         })
-        return response
 
 
     except ValidationError as e:
@@ -139,6 +395,10 @@ def lineprofile():
             "success": False,
             "message": f"Validation error: {str(e)}",
         }), 400
+    except ImageNotFoundError as e:
+        return image_not_found(e)
+    except ImageSelectionError as e:
+        return image_selection_error(e)
     except Exception as e:
         return jsonify({
             "success": False,
@@ -160,6 +420,15 @@ def image_statistics():
         subregion['y1'] (float): 'y' value for the rectangle bottom edge
         full_filename (str): Photon Ranch filename in S3, including the extension.
         s3_directory (str): The 'folder' that the image resides in s3. [ data | info-images | allsky ]
+        hdu (int or str): Optional HDU index or EXTNAME (default: the first HDU with image data).
+        plane (int): Optional plane of a data cube (required if the HDU has several).
+        stats (list): Optional names of the statistics to compute (default: all of them).
+            Requesting only mean, std, min and max of a subregion is much faster,
+            eg. while the user is dragging a selection box.
+        approximate (bool): Optional, estimate the median of a subregion in well
+            under a millisecond instead of computing it exactly. Only mean, std,
+            min, max and median can be requested, and the response has an
+            'errors' dict bounding the absolute error of each statistic.
 
     Example Response: 
         success (bool): True,
@@ -177,39 +446,50 @@ def image_statistics():
     
     """
 
-    # TODO: validation
-
-    args = json.loads(request.data)
+    try:
+        args = StatisticsInput().load(json.loads(request.data))
+    except ValidationError as e:
+        return jsonify({
+            "success": False,
+            "message": f"Validation error: {str(e)}",
+        }), 400
     full_filename = args['full_filename']
     s3_directory = args['s3_directory']
 
-    # Make sure the requested file exists
-    if not check_if_s3_image_exists(full_filename, s3_directory):
+    which = args.get('stats', ALL_STATS)
+    unknown = set(which) - set(ALL_STATS)
+    if unknown:
         return jsonify({
             "success": False,
-            "message": f"Image does not exist: {s3_directory}/{full_filename}."
+            "message": f"Unknown statistics requested: {sorted(unknown)}",
         }), 400
 
-    image_data = get_image_data(full_filename, s3_directory)
-    if 'subregion' in args.keys():
-        coords = args['subregion']
-        image_data = get_subregion_rect(image_data, coords['x0'], coords['x1'], coords['y0'], coords['y1'] )
-
-    stats = {
-        "median": get_median(image_data),
-        "mean": get_mean(image_data),
-        "mode": get_mode(image_data),
-        "min": get_min(image_data),
-        "max": get_max(image_data),
-        "std": get_std(image_data),
-        "median_abs_deviation": get_median_abs_deviation(image_data),
-    }
-    
-    return jsonify({
+    if args.get('approximate', False):
+        which = args.get('stats', APPROXIMATE_STATS + INDEXED_STATS)
+        unsupported = set(which) - set(APPROXIMATE_STATS + INDEXED_STATS)
+        if unsupported:
+            return jsonify({
+                "success": False,
+                "message": f"Statistics cannot be estimated: {sorted(unsupported)}",
+            }), 400
+        stats, errors = get_approximate_stats(
+            full_filename, s3_directory, subregion=args.get('subregion'), which=which,
+            hdu=args.get('hdu'), plane=args.get('plane'))
+        return make_response({
+            "success": True,
+            "stats": stats,
+            "errors": errors,
+            "params": json.loads(request.data)
+        })
+
+    stats = get_image_stats(full_filename, s3_directory, subregion=args.get('subregion'), which=which,
+                            hdu=args.get('hdu'), plane=args.get('plane'))
+
+    return make_response({
         "success": True,
         "stats": stats,
         "params": json.loads(request.data)
-    }), 200
+    })
 
 
 @app.route('/histogram-clipped', methods=['POST'])
@@ -228,6 +508,8 @@ def histogram():
         subregion['x1'] (float): 'x' value for the rectangle right edge
         subregion['y0'] (float): 'y' value for the rectangle top edge
         subregion['y1'] (float): 'y' value for the rectangle bottom edge
+        hdu (int or str): optional HDU index or EXTNAME (default: the first HDU with image data)
+        plane (int): optional plane of a data cube (required if the HDU has several)
     
     Example Response:
             "success": True,
@@ -245,43 +527,237 @@ def histogram():
             "params": json.loads(request.data)
     """
 
-    # TODO: input documentation and validation
-
-    args = json.loads(request.data)
+    try:
+        args = HistogramInput().load(json.loads(request.data))
+    except ValidationError as e:
+        return jsonify({
+            "success": False,
+            "message": f"Validation error: {str(e)}",
+        }), 400
     full_filename = args['full_filename']
     s3_directory = args['s3_directory']
     clip_percent = args['clip_percent']
-    print(full_filename, clip_percent)
+    logger.debug('clipped histogram of %s with clip_percent %s', full_filename, clip_percent)
+
+    subregion = args.get('subregion')
+    selection = {'hdu': args.get('hdu'), 'plane': args.get('plane')}
+    if subregion is None:
+        # Integer frames are served from the cached full frame summary, without the pixels
+        value_counts = get_image_value_counts(full_filename, s3_directory, **selection)
+        image_data = None if value_counts is not None else get_image_data(full_filename, s3_directory, **selection)
+    else:
+        image_data = get_image_data(full_filename, s3_directory, subregion=subregion, **selection)
+        value_counts = get_image_value_counts(
+            full_filename, s3_directory, subregion, region_data=image_data, **selection)
+
+    return make_response({
+        "success": True,
+        "histogram": get_clipped_histogram(image_data, clip_percent, value_counts),
+        "params": json.loads(request.data)
+    })
+
+
+@app.route('/histogram-lod', methods=['POST'])
+@cross_origin()
+def histogram_lod():
+    """Return a window of an image's histogram, at a resolution suited for display.
 
-    # Make sure the requested file exists
-    if not check_if_s3_image_exists(full_filename, s3_directory):
+    The full resolution histogram of the image (or subregion) is computed on
+    the first request and cached. Later requests for other windows, as the
+    user zooms and pans the histogram, are rebinned from the cached counts
+    without another pass over the pixels.
+
+    POST Args:
+        full_filename (str): Photon Ranch filename in S3, including the extension.
+        s3_directory (str): The 'folder' that the image resides in s3. [ data | info-images | allsky ]
+        subregion (dict): optional, analyze subregion of image (as in /histogram-clipped)
+        hdu (int or str): optional HDU index or EXTNAME (default: the first HDU with image data)
+        plane (int): optional plane of a data cube (required if the HDU has several)
+        lo (float): optional, lowest pixel value to include. Defaults to the image minimum.
+        hi (float): optional, highest pixel value to include. Defaults to the image maximum.
+        max_bins (int): optional, the most bins to return. Defaults to 1000.
+
+    Example Response:
+        "success": True,
+        "histogram": {
+            "counts": [415, 438, ....4152],
+            "edges": [106, 108, ... 1406],
+            "range": [51, 64963],
+        },
+        "params": json.loads(request.data)
+    """
+
+    try:
+        args = HistogramWindowInput().load(json.loads(request.data))
+        full_histogram = get_image_histogram(
+            args['full_filename'], args['s3_directory'], args.get('subregion'),
+            hdu=args.get('hdu'), plane=args.get('plane'))
+        counts, edges = get_histogram_window(
+            full_histogram, args.get('lo'), args.get('hi'), args.get('max_bins', 1000))
+        return make_response({
+            "success": True,
+            "histogram": {
+                "counts": counts,
+                "edges": edges,
+                "range": [full_histogram['min'], full_histogram['max']],
+            },
+            "params": json.loads(request.data)
+        })
+
+    except ValidationError as e:
         return jsonify({
             "success": False,
-            "message": f"Image does not exist: {s3_directory}/{full_filename}."
+            "message": f"Validation error: {str(e)}",
+        }), 400
+    except ImageNotFoundError as e:
+        return image_not_found(e)
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "message": f"Error: {str(e)}",
         }), 400
 
-    image_data = get_image_data(full_filename, s3_directory)
-    if 'subregion' in args.keys():
-        coords = args['subregion']
-        image_data = get_subregion_rect(image_data, coords['x0'], coords['x1'], coords['y0'], coords['y1'] )
 
-    counts, edges = get_histogram(image_data, clip_percent=clip_percent)
-    
+@app.route('/session-statistics', methods=['POST'])
+@cross_origin()
+def session_statistics():
+    """Return the statistics (and optionally histograms) of the frames of a session, as columns.
+
+    Every frame's full frame analyses are computed once and cached, and new
+    frames are loaded several at once, so polling a session as frames arrive
+    only processes the new ones.
+
+    POST Args:
+        s3_directory (str): The 'folder' that the images reside in s3. [ data | info-images | allsky ]
+        full_filenames (list): the frames, in order. Either this or prefix is required.
+        prefix (str): the start of the frames' filenames, eg. 'tst-test-20201112-'. Frames are
+            ordered by filename, and only the last SESSION_MAX_FRAMES are included.
+        hdu (int or str): optional HDU index or EXTNAME (default: the first HDU with image data)
+        plane (int): optional plane of a data cube (required if the HDU has several)
+        stats (list): optional names of the statistics to return (default: all of them).
+        histogram_bins (int): optional number of histogram bins, shared by every frame.
+            Without it no histograms are returned.
+        lo (float): optional lower edge of the histograms. Defaults to the lowest pixel of any frame.
+        hi (float): optional upper edge of the histograms. Defaults to the highest pixel of any frame.
+
+    Example Response:
+        "success": True,
+        "frames": ["tst-test-20201112-00000058-EX10.fits.bz2", ...],
+        "stats": {"median": [158, 161, ...], "max": [64963, 65535, ...], ...},
+        "histograms": {"edges": [51, 64.5, ... 65535], "counts": [[415, 438, ...], ...]},
+        "errors": {"tst-test-20201112-00000060-EX10.fits.bz2": "Image does not exist: ..."},
+    """
+
+    try:
+        args = SessionInput().load(json.loads(request.data))
+        session = get_session_statistics(
+            args['s3_directory'], args.get('full_filenames'), args.get('prefix'),
+            which=args.get('stats', ALL_STATS), histogram_bins=args.get('histogram_bins'),
+            lo=args.get('lo'), hi=args.get('hi'), hdu=args.get('hdu'), plane=args.get('plane'))
+        return make_response({"success": True, **session})
+
+    except ValidationError as e:
+        return jsonify({
+            "success": False,
+            "message": f"Validation error: {str(e)}",
+        }), 400
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "message": f"Error: {str(e)}",
+        }), 400
+
+
+@app.route('/prefetch', methods=['POST'])
+@cross_origin()
+def prefetch():
+    """Load images and their full frame analyses into the cache in the background.
+
+    Call this as new frames arrive, so the first analysis request for them is
+    a cache hit. The response is returned immediately; the images are loaded
+    newest first (later entries go first), and when too many are waiting the
+    oldest are dropped.
+
+    POST Args:
+        images (list): the images to load, oldest first, each with
+            full_filename (str): Photon Ranch filename in S3, including the extension.
+            s3_directory (str): The 'folder' that the image resides in s3. [ data | info-images | allsky ]
+
+    Example Response:
+        "success": True,
+        "queued": 2
+    """
+
+    try:
+        args = PrefetchInput().load(json.loads(request.data))
+    except ValidationError as e:
+        return jsonify({
+            "success": False,
+            "message": f"Validation error: {str(e)}",
+        }), 400
+
+    prefetch_images((image['s3_directory'], image['full_filename']) for image in args['images'])
     return jsonify({
         "success": True,
-        "histogram": {
-            "counts": counts,
-            "edges": edges,
-            "stats": {
-                "median": get_median(image_data),
-                "mean": get_mean(image_data),
-                "mode": get_mode(image_data),
-                "min": get_min(image_data),
-                "max": get_max(image_data),
-            }
-        },
-        "params": json.loads(request.data)
-    }), 200
+        "queued": len(args['images']),
+    }), 202
+
+
+@app.route('/batch', methods=['POST'])
+@cross_origin()
+def batch():
+    """Run several analyses against one image in a single request.
+
+    The image is loaded once, operations on the same subregion
+    share their intermediate results, and independent operations run in
+    parallel.
+
+    POST Args:
+        full_filename (str): Photon Ranch filename in S3, including the extension.
+        s3_directory (str): The 'folder' that the image resides in s3. [ data | info-images | allsky ]
+        hdu (int or str): Optional HDU index or EXTNAME (default: the first HDU with image data).
+        plane (int): Optional plane of a data cube (required if the HDU has several).
+        operations (list): operations to run. Each has a 'type' and the same
+            arguments as the corresponding endpoint:
+            {"type": "lineprofile", "start": {"x", "y"}, "end": {"x", "y"}, "linewidth": 1, "order": 1}
+            {"type": "statistics", "subregion": {...} (optional), "stats": [...] (optional)}
+            {"type": "histogram", "clip_percent": 0.05, "subregion": {...} (optional)}
+
+    Example Response:
+        "success": True,
+        "results": [
+            {"type": "lineprofile", "success": True, "start": [0, 0], "end": [1, 1], "data": [...]},
+            {"type": "statistics", "success": True, "stats": {"median": 158, ...}},
+            {"type": "histogram", "success": True, "histogram": {"counts": [...], "edges": [...], "stats": {...}}},
+            {"type": "histogram", "success": False, "message": "Error: ..."},
+        ]
+    """
+
+    try:
+        args = BatchInput().load(json.loads(request.data))
+        full_filename = args['full_filename']
+        s3_directory = args['s3_directory']
+
+        image_data = get_image_data(full_filename, s3_directory, hdu=args.get('hdu'), plane=args.get('plane'))
+        return make_response({
+            "success": True,
+            "results": run_operations(image_data, args['operations']),
+        })
+
+    except ValidationError as e:
+        return jsonify({
+            "success": False,
+            "message": f"Validation error: {str(e)}",
+        }), 400
+    except ImageNotFoundError as e:
+        return image_not_found(e)
+    except ImageSelectionError as e:
+        return image_selection_error(e)
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "message": f"Error: {str(e)}",
+        }), 500
 
 
 if __name__ == "__main__":
@@ -0,0 +1,132 @@
+"""Async (ASGI) entry point for the quickanalysis app.
+
+Run it with any ASGI server, eg.
+
+    uvicorn asgi:application --workers 4
+
+The Flask views are blocking, so each request runs on a thread pool while the
+event loop keeps accepting connections. At most ASGI_MAX_CONCURRENT_REQUESTS
+requests run at once and the rest wait on the loop without holding a thread.
+Within the views, s3 downloads are limited to S3_MAX_CONCURRENT_DOWNLOADS at a
+time and concurrent loads of the same image share one download (see
+`quickanalysis.utils.load_data`). Most numpy work releases the GIL, so views
+analyzing already-loaded images run in parallel with the downloads.
+"""
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from application import app
+from quickanalysis import settings
+
+
+class WsgiToAsgi:
+    """Serve a WSGI app over ASGI, running it on a bounded thread pool.
+
+    Args:
+        wsgi_app (callable): the WSGI application.
+        workers (int): threads used to run the WSGI app.
+        max_concurrent_requests (int): requests handled at once. Requests
+            beyond this wait (on the event loop) for one to finish.
+    """
+
+    def __init__(self, wsgi_app, workers, max_concurrent_requests):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='asgi')
+        self.max_concurrent_requests = max_concurrent_requests
+        self._semaphore = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.handle_lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+
+        body = await self.read_body(receive)
+        # Created here so it belongs to the server's event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            status, headers, body = await loop.run_in_executor(
+                self.executor, self.run_wsgi, scope, body)
+
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def read_body(receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        return b''.join(chunks)
+
+    def run_wsgi(self, scope, body):
+        """Call the WSGI app for one request. Returns (status, headers, body)."""
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers
+            ]
+
+        result = self.wsgi_app(get_environ(scope, body), start_response)
+        try:
+            content = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], content
+
+
+def get_environ(scope, body):
+    """Build the WSGI environ for an ASGI http scope and its request body."""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name == 'CONTENT_LENGTH':
+            continue  # set from the body we actually received
+        if name != 'CONTENT_TYPE':
+            name = 'HTTP_' + name
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+application = WsgiToAsgi(app, settings.ASGI_WORKERS, settings.ASGI_MAX_CONCURRENT_REQUESTS)
@@ -0,0 +1,277 @@
+"""Time the analysis functions and routes on synthetic frames of our real sizes.
+
+16-bit frames of 4k x 4k and 6k x 9k pixels (plain and bz2 compressed) are
+uploaded to the fake s3 client used by the unit tests, and every case is run
+against them:
+
+- loading (`get_image_data`) with empty caches,
+- the analysis functions (`get_histogram`, each `region_stats` function,
+  `get_intensity_profile`, `get_intensity_profile_input_plot`) on the
+  decoded frame,
+- every route through the Flask test client, both cold (empty caches, so
+  including the download) and warm (cached image and analyses).
+
+For each case the latency percentiles over the repeats, the throughput in
+megapixels of the frame per second, and the peak memory allocated (measured
+with tracemalloc in a separate, untimed run) are reported.
+
+Results are compared with the baselines stored in `baselines.json`, and the
+script exits with an error if any case got slower or uses more memory than
+its baseline allows. Baselines depend on the machine, so record them again
+with `--save` after changing machines or after an intentional change:
+
+    python -m benchmarks.bench_suite
+    python -m benchmarks.bench_suite --sizes 4k --filter statistics
+    python -m benchmarks.bench_suite --save
+"""
+import argparse
+import bz2
+import contextlib
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+from application import app
+from benchmarks.bench_histogram import make_frame
+from quickanalysis import settings
+from quickanalysis.analysis import region_stats
+from quickanalysis.analysis.histogram import get_histogram
+from quickanalysis.analysis.profile_line import get_intensity_profile
+from quickanalysis.analysis.profile_line import get_intensity_profile_input_plot
+from quickanalysis.utils import load_data
+from quickanalysis.utils.disk_cache import DiskArrayCache
+from tests.unit.conftest import FakeS3Client
+
+SIZES = {
+    '4k': (4096, 4096),
+    '6kx9k': (6000, 9000),
+}
+S3_DIRECTORY = 'bench/raw'
+REPEATS = 5
+PERCENTILES = (50, 90, 99)
+BASELINES_PATH = Path(__file__).with_name('baselines.json')
+
+# A case regresses if its median latency grows by more than this fraction of
+# its baseline, or its peak memory by more than PEAK_TOLERANCE of it. The
+# slacks keep timer noise and tiny allocations of the fastest cases from flagging.
+LATENCY_TOLERANCE = 0.25
+LATENCY_SLACK = 0.005
+PEAK_TOLERANCE = 0.10
+PEAK_SLACK_BYTES = 1 << 20
+
+START, END = (0.1, 0.2), (0.9, 0.7)
+SUBREGION = {'x0': 0.2, 'x1': 0.7, 'y0': 0.1, 'y1': 0.6}
+REGION_STATS_FUNCTIONS = (
+    'get_mean', 'get_median', 'get_mode', 'get_min', 'get_max', 'get_std', 'get_median_abs_deviation')
+
+
+class Case:
+    """One benchmarked operation.
+
+    Args:
+        name (str): the name results are reported and stored under.
+        run (callable): the timed operation.
+        setup (callable): optional, called before every run without being timed.
+    """
+
+    def __init__(self, name, run, setup=None):
+        self.name = name
+        self.run = run
+        self.setup = setup or (lambda: None)
+
+
+def clear_caches():
+    load_data.image_cache.clear()
+    load_data.derived_cache.clear()
+    load_data.disk_cache.clear()
+
+
+def post(route, **body):
+    client = app.test_client()
+
+    def run():
+        response = client.post(route, data=json.dumps(body))
+        assert response.status_code == 200, response.get_data(as_text=True)
+    return run
+
+
+def get(route, **args):
+    client = app.test_client()
+
+    def run():
+        response = client.get(route, query_string=args)
+        assert response.status_code == 200, response.get_data(as_text=True)
+    return run
+
+
+def upload_frames(client, sizes):
+    """Put a plain and a bz2 compressed FITS file of each size in the fake bucket.
+
+    Returns:
+        dict: the frame of each size.
+    """
+    frames = {}
+    for size in sizes:
+        frame = make_frame(SIZES[size])
+        buffer = io.BytesIO()
+        fits.PrimaryHDU(frame).writeto(buffer)
+        body = buffer.getvalue()
+        client.put_object(Bucket=settings.S3_BUCKET, Key=f'{S3_DIRECTORY}/{size}.fits', Body=body)
+        client.put_object(Bucket=settings.S3_BUCKET, Key=f'{S3_DIRECTORY}/{size}.fits.bz2', Body=bz2.compress(body))
+        frames[size] = frame
+    return frames
+
+
+def get_cases(size, frame):
+    """Return every case for the frame of one size."""
+    filename = f'{size}.fits'
+    image = {'full_filename': filename, 's3_directory': S3_DIRECTORY}
+    cases = [
+        Case(f'get_image_data[{size}]', lambda: load_data.get_image_data(filename, S3_DIRECTORY), clear_caches),
+        Case(f'get_image_data[{size}.bz2]',
+             lambda: load_data.get_image_data(filename + '.bz2', S3_DIRECTORY), clear_caches),
+        Case(f'get_histogram[{size}]', lambda: get_histogram(frame, bin_size=1, clip_percent=0.05)),
+        Case(f'get_intensity_profile[{size}]', lambda: get_intensity_profile(frame, START, END)),
+        Case(f'get_intensity_profile_input_plot[{size}]',
+             lambda: get_intensity_profile_input_plot(frame, START, END)),
+    ]
+    for function_name in REGION_STATS_FUNCTIONS:
+        function = getattr(region_stats, function_name)
+        cases.append(Case(f'{function_name}[{size}]', lambda function=function: function(frame)))
+
+    routes = {
+        '/statistics': post('/statistics', **image),
+        '/statistics subregion': post('/statistics', subregion=SUBREGION, **image),
+        '/histogram-clipped': post('/histogram-clipped', clip_percent=0.05, **image),
+        '/histogram-lod': post('/histogram-lod', max_bins=1000, **image),
+        '/lineprofile': post('/lineprofile', start=dict(zip('xy', START)), end=dict(zip('xy', END)), **image),
+        '/lineprofiledisplay': get('/lineprofiledisplay', filename=filename, s3_directory=S3_DIRECTORY,
+                                   x0=START[0], y0=START[1], x1=END[0], y1=END[1]),
+        '/preview': get('/preview', x0=START[0], y0=START[1], x1=END[0], y1=END[1], **image),
+        '/batch': post('/batch', operations=[
+            {'type': 'statistics', 'subregion': SUBREGION},
+            {'type': 'histogram', 'clip_percent': 0.05},
+            {'type': 'lineprofile', 'start': dict(zip('xy', START)), 'end': dict(zip('xy', END))},
+        ], **image),
+    }
+    for route, run in routes.items():
+        cases.append(Case(f'{route} cold[{size}]', run, clear_caches))
+        cases.append(Case(f'{route} warm[{size}]', run, run))
+    return cases
+
+
+def measure(case, repeats):
+    """Time `repeats` runs of a case, then measure the peak memory of one more.
+
+    Returns:
+        dict: latency percentiles ('p50'... in seconds) and 'peak_bytes'.
+    """
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeats):
+            case.setup()
+            start = time.perf_counter()
+            case.run()
+            times.append(time.perf_counter() - start)
+
+        case.setup()
+        tracemalloc.start()
+        try:
+            case.run()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    result = {f'p{q}': float(np.percentile(times, q)) for q in PERCENTILES}
+    result['peak_bytes'] = peak
+    return result
+
+
+def find_regressions(results, baselines):
+    """Compare results with the stored baselines.
+
+    Returns:
+        list of str: a description of every regression.
+    """
+    regressions = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            continue
+        if result['p50'] > baseline['p50'] * (1 + LATENCY_TOLERANCE) + LATENCY_SLACK:
+            regressions.append(f"{name}: median {result['p50'] * 1e3:.1f} ms, "
+                               f"baseline {baseline['p50'] * 1e3:.1f} ms")
+        if result['peak_bytes'] > baseline['peak_bytes'] * (1 + PEAK_TOLERANCE) + PEAK_SLACK_BYTES:
+            regressions.append(f"{name}: peak {result['peak_bytes'] / 1e6:.1f} MB, "
+                               f"baseline {baseline['peak_bytes'] / 1e6:.1f} MB")
+    return regressions
+
+
+def load_baselines():
+    if not BASELINES_PATH.exists():
+        return {}
+    return json.loads(BASELINES_PATH.read_text())
+
+
+def save_baselines(results):
+    """Merge `results` into the stored baselines (other cases are kept)."""
+    baselines = load_baselines()
+    baselines.update(results)
+    BASELINES_PATH.write_text(json.dumps(baselines, indent=2, sort_keys=True) + '\n')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', nargs='+', choices=SIZES, default=list(SIZES),
+                        help='frame sizes to run (default: all)')
+    parser.add_argument('--filter', default='', help='only run cases whose name contains this')
+    parser.add_argument('--repeats', type=int, default=REPEATS, help='timed runs per case')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baselines')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Every request logs its timings at INFO, which would drown out the results
+    logging.getLogger('quickanalysis').setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        client = FakeS3Client(Path(tmp_dir))
+        load_data.s3 = client
+        load_data.disk_cache = DiskArrayCache(os.path.join(tmp_dir, 'cache'), 0)
+        settings.IMAGE_LOADER = 'stream'
+        frames = upload_frames(client, args.sizes)
+
+        results = {}
+        print(f"{'case':<44}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'MP/s':>10}{'peak MB':>10}")
+        for size, frame in frames.items():
+            megapixels = frame.size / 1e6
+            for case in get_cases(size, frame):
+                if args.filter not in case.name:
+                    continue
+                result = results[case.name] = measure(case, args.repeats)
+                print(f"{case.name:<44}{result['p50'] * 1e3:>10.1f}{result['p90'] * 1e3:>10.1f}"
+                      f"{result['p99'] * 1e3:>10.1f}{megapixels / result['p50']:>10.0f}"
+                      f"{result['peak_bytes'] / 1e6:>10.1f}")
+
+    if args.save:
+        save_baselines(results)
+        print(f"Saved {len(results)} baselines to {BASELINES_PATH}")
+        return 0
+
+    regressions = find_regressions(results, load_baselines())
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,14 @@
+import logging
+
 import numpy as np
 
+from quickanalysis.analysis.region_stats import _weighted_percentile
+from quickanalysis.analysis.region_stats import get_min_max
+from quickanalysis.analysis.region_stats import get_value_counts
+from quickanalysis.analysis.tiled import map_bands
+
+logger = logging.getLogger(__name__)
+
 def get_num_bins(bin_size, min_val, max_val):
   """Given the bin size, how many bins are necessary to cover the given range of values? 
 
@@ -23,7 +32,49 @@ def get_num_bins(bin_size, min_val, max_val):
   # Add one because we need num_bins * bin_size > range (not <= range). 
   return q + 1
 
-def get_histogram(arr, bin_size=None, clip_percent=None, bitpix=16, exclude_zero=False):
+def get_histogram_from_counts(low_val, counts, edges):
+  """Bin the per-value counts of integer data into a histogram with the given edges.
+
+  This gives the same result as `np.histogram(arr, bins=edges)` on the data the
+  counts came from: every bin is half-open except the last, which includes its
+  right edge, and values outside the edges are ignored. It only looks at the
+  counts, so it costs O(number of values + number of bins).
+
+  Args:
+    low_val (int): the value counted by counts[0].
+    counts (numpy array of ints): number of pixels with each value from low_val upwards,
+                                  as returned by `get_value_counts`.
+    edges (numpy array): monotonically increasing bin edges.
+
+  Returns:
+    numpy array of ints: number of counts in each bin
+  """
+  # cumulative[i] is the number of pixels with a value below low_val + i
+  cumulative = np.zeros(counts.size + 1, dtype=np.int64)
+  np.cumsum(counts, out=cumulative[1:])
+
+  # Integer values below an edge e are the ones below ceil(e)
+  below = np.clip(np.ceil(edges) - low_val, 0, counts.size).astype(np.intp)
+  totals = cumulative[below]
+  # The last bin includes values equal to its right edge
+  totals[-1] = cumulative[int(np.clip(np.floor(edges[-1]) - low_val + 1, 0, counts.size))]
+  return np.diff(totals)
+
+def histogram_by_rows(arr, bins, value_range=None):
+  """Same as `np.histogram(arr, bins, value_range)[0]`, without flattening `arr`.
+
+  `np.histogram` copies a subregion view to flatten it. This bins it a band of rows
+  at a time instead (in parallel, see `tiled.map_bands`), so the temporary arrays stay
+  small whatever the size of `arr`. `bins` must be the bin edges, or a number of bins
+  with an explicit `value_range`, so that every band is binned the same way.
+  """
+  counts = None
+  for band_counts in map_bands(lambda band: np.histogram(band, bins=bins, range=value_range)[0], arr):
+    counts = band_counts if counts is None else counts + band_counts
+  return counts
+
+def get_histogram(arr, bin_size=None, clip_percent=None, bitpix=16, exclude_zero=False, value_range=None,
+                  value_counts=None):
   """Compute a histogram for the provided image data array.
 
   Args:
@@ -35,6 +86,16 @@ def get_histogram(arr, bin_size=None, clip_percent=None, bitpix=16, exclude_zero
                           If clip_percent==None, the histogram will use the full range of possible pixel intensities.
                           Note that if clip_percent==0, the histogram range will not exceed the min and max pixels. 
     bitpix (int): bits per pixel. Find total number of possible pixel values by computing 2**bitpix
+    value_range (tuple): optional (low, high) range for the histogram, if it has already been computed
+                         (eg. from the clipping percentiles returned by `compute_region_stats`).
+                         This skips the min/max or percentile passes over the data.
+    value_counts ((int, numpy array)): optional `get_value_counts(arr)`, if it has already been computed.
+                                       `arr` isn't used (and may be None) if this is given.
+
+  Integer data is counted once with `np.bincount`, and the range, clipping percentiles
+  and binned counts are all derived from those counts. Other data uses `np.percentile`
+  (one temporary copy of the data) and `np.histogram` on blocks of rows. Both give
+  identical results.
 
   Returns:
     counts (numpy array of ints): number of counts in each bin
@@ -42,19 +103,38 @@ def get_histogram(arr, bin_size=None, clip_percent=None, bitpix=16, exclude_zero
                                    edges[i] and edges[i+1])
   """
 
+  if value_counts is None:
+    value_counts = get_value_counts(arr)
+  if value_counts is not None:
+    count_offset, value_counts = value_counts
+    nonzero = np.flatnonzero(value_counts)
+    first, last = nonzero[0], nonzero[-1]
+    values = np.arange(count_offset + first, count_offset + last + 1)
+
+  if value_range is not None:
+    low_val, high_val = value_range
+
   # Default range should include the whole image
-  low_val = np.min(arr)
-  high_val = np.max(arr)
-  print(f"low val: {low_val}, high val: {high_val}")
+  elif value_counts is not None:
+    # Python ints, so the bin edge arithmetic below can't overflow the pixel dtype
+    low_val = int(values[0])
+    high_val = int(values[-1])
+  else:
+    low_val, high_val = get_min_max(arr)
+  logger.debug('low val: %s, high val: %s', low_val, high_val)
 
   # Or use percentage clipping to determine the range (if clip_percent is specified)
-  if clip_percent is not None:
+  if clip_percent is not None and value_range is None:
     # Convert percentile from [0,1] to [0, 100]
     clip_percent *= 100
 
     # Compute clipping high/low values
-    low_val = np.percentile(arr, clip_percent)
-    high_val = np.percentile(arr, 100 - clip_percent)
+    if value_counts is not None:
+      trimmed_counts = value_counts[first:last + 1]
+      low_val = _weighted_percentile(values, trimmed_counts, clip_percent)
+      high_val = _weighted_percentile(values, trimmed_counts, 100 - clip_percent)
+    else:
+      low_val, high_val = np.percentile(arr, (clip_percent, 100 - clip_percent))
 
   if exclude_zero and low_val == 0:
     low_val += 1
@@ -68,10 +148,10 @@ def get_histogram(arr, bin_size=None, clip_percent=None, bitpix=16, exclude_zero
     for possible_bin_size in range (1,20):
       num_bins_candidate = get_num_bins(possible_bin_size, low_val, high_val)
       if num_bins_candidate < 5000:
-        print('num_bins_candidate: ',num_bins_candidate)
+        logger.debug('num_bins_candidate: %s', num_bins_candidate)
         num_bins = num_bins_candidate
         bin_size = possible_bin_size
-        print('bin_size: ', possible_bin_size)
+        logger.debug('bin_size: %s', possible_bin_size)
         break
 
   # No auto bin sizes if a bin_size value is provided. 
@@ -87,6 +167,121 @@ def get_histogram(arr, bin_size=None, clip_percent=None, bitpix=16, exclude_zero
   bin_edges = np.arange(low_val, modified_high_val, bin_size)
 
 
-  counts, edges = np.histogram(arr, bins=bin_edges)
-  print('number of counts: ', len(counts))
+  if value_counts is not None:
+    counts, edges = get_histogram_from_counts(count_offset, value_counts, bin_edges), bin_edges
+  else:
+    counts, edges = histogram_by_rows(arr, bin_edges), bin_edges
+  logger.debug('number of counts: %s', len(counts))
+  return counts, edges
+
+# Most bins kept in a full resolution histogram. Integer data spanning more values than this,
+# and all float data, is binned to this many bins of equal width.
+FULL_HISTOGRAM_MAX_BINS = 1 << 16
+
+def build_full_histogram(arr, value_counts=None):
+  """Compute the full resolution histogram used to serve level-of-detail windows.
+
+  For integer data each bin holds a single value. The histogram is stored as
+  cumulative counts, so any window of it can be rebinned by `get_histogram_window`
+  without looking at the pixels again.
+
+  Args:
+    arr (n-dimensional numpy array): the data to analyze
+    value_counts ((int, numpy array)): optional `get_value_counts(arr)`, if it has already been computed.
+                                       `arr` isn't used (and may be None) if this is given.
+
+  Returns:
+    dict: 'low' (the lower edge of the first bin), 'bin_width', 'cumulative' (cumulative[i] is
+          the number of pixels below bin i, with one extra element for the total), and
+          'min' and 'max' of the data.
+  """
+  if value_counts is None:
+    value_counts = get_value_counts(arr)
+
+  if value_counts is not None:
+    low_val, counts = value_counts
+    nonzero = np.flatnonzero(counts)
+    first, last = nonzero[0], nonzero[-1]
+    counts = counts[first:last + 1]
+    low_val += int(first)
+    min_val, max_val = low_val, low_val + counts.size - 1
+    bin_width = -(-counts.size // FULL_HISTOGRAM_MAX_BINS)
+    if bin_width > 1:
+      counts = np.add.reduceat(counts, np.arange(0, counts.size, bin_width))
+  else:
+    min_val, max_val = (float(value) for value in get_min_max(arr))
+    low_val = min_val
+    high_val = max_val if max_val > min_val else min_val + FULL_HISTOGRAM_MAX_BINS
+    bin_width = (high_val - low_val) / FULL_HISTOGRAM_MAX_BINS
+    counts = histogram_by_rows(arr, FULL_HISTOGRAM_MAX_BINS, (low_val, high_val))
+
+  cumulative = np.zeros(counts.size + 1, dtype=np.int64)
+  np.cumsum(counts, out=cumulative[1:])
+  return {
+    "low": low_val,
+    "bin_width": bin_width,
+    "cumulative": cumulative,
+    "min": min_val,
+    "max": max_val,
+  }
+
+def get_histogram_window(full_histogram, lo=None, hi=None, max_bins=1000):
+  """Rebin part of a full resolution histogram for display.
+
+  Adjacent full resolution bins are summed so the window has at most `max_bins`
+  bins. This only looks at the cumulative counts, so it costs O(max_bins) no
+  matter how large the image is.
+
+  Args:
+    full_histogram (dict): the output of `build_full_histogram`.
+    lo (float): lowest value to include. Defaults to the data minimum.
+    hi (float): highest value to include. Defaults to the data maximum.
+    max_bins (int): the most bins to return.
+
+  Returns:
+    counts (numpy array of ints): number of counts in each bin
+    edges (numpy array): bin edges (i-th bin is anything between edges[i] and edges[i+1]).
+                         These fall on the full resolution bin edges enclosing [lo, hi].
+  """
+  if max_bins < 1:
+    raise ValueError("max_bins must be at least 1")
+  low_val = full_histogram['low']
+  bin_width = full_histogram['bin_width']
+  cumulative = full_histogram['cumulative']
+  num_full_bins = cumulative.size - 1
+
+  lo = full_histogram['min'] if lo is None else lo
+  hi = full_histogram['max'] if hi is None else hi
+  if hi < lo:
+    raise ValueError("hi must not be less than lo")
+
+  # Full resolution bins covering [lo, hi]
+  start = min(max(int(np.floor((lo - low_val) / bin_width)), 0), num_full_bins)
+  stop = min(max(int(np.floor((hi - low_val) / bin_width)) + 1, start), num_full_bins)
+
+  group = max(1, -(-(stop - start) // max_bins))
+  indexes = np.append(np.arange(start, stop, group), stop)
+  counts = np.diff(cumulative[indexes])
+  edges = low_val + indexes * bin_width
   return counts, edges
+
+def get_histogram_counts(full_histogram, edges):
+  """Count the pixels between given edges from a full resolution histogram.
+
+  Unlike `get_histogram_window`, the edges are chosen by the caller, so the
+  histograms of several images can share them. Each edge is rounded up to the
+  nearest full resolution bin edge, and the last bin includes its upper edge.
+
+  Args:
+    full_histogram (dict): the output of `build_full_histogram`.
+    edges (1d numpy array): increasing bin edges.
+
+  Returns:
+    numpy array of ints: the counts of the len(edges) - 1 bins.
+  """
+  cumulative = full_histogram['cumulative']
+  positions = (np.asarray(edges, dtype=np.float64) - full_histogram['low']) / full_histogram['bin_width']
+  indexes = np.ceil(positions)
+  indexes[-1] = np.floor(positions[-1]) + 1
+  indexes = np.clip(indexes, 0, cumulative.size - 1).astype(np.intp)
+  return np.diff(cumulative[indexes])
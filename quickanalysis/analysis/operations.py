@@ -0,0 +1,185 @@
+from quickanalysis.analysis.histogram import get_histogram
+from quickanalysis.analysis.profile_line import get_intensity_profiles
+from quickanalysis.analysis.region_stats import ALL_STATS
+from quickanalysis.analysis.region_stats import compute_region_stats
+from quickanalysis.analysis.region_stats import get_value_counts
+from quickanalysis.utils.load_data import get_region_key
+from quickanalysis.utils.load_data import get_subregion_rect
+from quickanalysis.utils.pools import analysis_pool
+from quickanalysis.utils.pools import submit
+
+OPERATION_TYPES = ('lineprofile', 'statistics', 'histogram')
+
+# Stats included with a clipped histogram
+HISTOGRAM_STATS = ('median', 'mean', 'mode', 'min', 'max')
+
+
+def get_clipped_histogram(image_data, clip_percent, value_counts=None):
+    """ Compute the histogram and summary stats returned by /histogram-clipped.
+
+    Args:
+        image_data (2d numpy array): the image or subregion to analyze.
+        clip_percent (float): see `get_histogram`.
+        value_counts ((int, numpy array)): optional `get_value_counts(image_data)`,
+            if it has already been computed. Then `image_data` isn't used and may be None.
+
+    Returns:
+        dict: 'counts' and 'edges' of the histogram, and 'stats'.
+    """
+    # Compute the stats, the clipping range and the histogram from one count of the pixel values
+    if value_counts is None:
+        value_counts = get_value_counts(image_data)
+    clip_percentiles = ()
+    if clip_percent is not None:
+        clip_percentiles = (clip_percent * 100, 100 - clip_percent * 100)
+    stats = compute_region_stats(
+        image_data,
+        which=HISTOGRAM_STATS,
+        percentiles=clip_percentiles,
+        value_counts=value_counts,
+    )
+    value_range = None
+    if clip_percentiles:
+        percentiles = stats.pop('percentiles')
+        value_range = tuple(percentiles[q] for q in clip_percentiles)
+    counts, edges = get_histogram(
+        image_data, clip_percent=clip_percent, value_range=value_range, value_counts=value_counts)
+    return {
+        "counts": counts,
+        "edges": edges,
+        "stats": stats,
+    }
+
+
+def get_region(image_data, subregion):
+    """ Return the subregion of an image described by a subregion dict, or the whole image. """
+    if subregion is None:
+        return image_data
+    return get_subregion_rect(image_data, subregion['x0'], subregion['x1'], subregion['y0'], subregion['y1'])
+
+
+def parse_line_operation(operation):
+    """ Return the (start, end, linewidth, order) of a lineprofile operation. """
+    start = (operation['start']['x'], operation['start']['y'])
+    end = (operation['end']['x'], operation['end']['y'])
+    if not all(0 <= val <= 1 for val in start + end):
+        raise ValueError('Input coordinates must be between 0 and 1')
+    return start, end, int(operation.get('linewidth', 1)), int(operation.get('order', 1))
+
+
+def run_operation(image_data, operation, value_counts=None, profile=None):
+    """ Run a single operation from a batch request.
+
+    Args:
+        image_data (2d numpy array): the full image.
+        operation (dict): the operation 'type' (one of OPERATION_TYPES) and its
+            arguments, named as in the corresponding endpoint.
+        value_counts ((int, numpy array)): optional `get_value_counts` of the
+            operation's subregion.
+        profile (numpy array): optional precomputed profile for a lineprofile operation.
+
+    Returns:
+        dict: the operation's results, shaped like the corresponding endpoint's response.
+    """
+    operation_type = operation.get('type')
+
+    if operation_type == 'lineprofile':
+        start, end, linewidth, order = parse_line_operation(operation)
+        if profile is None:
+            profiles, lengths = get_intensity_profiles(image_data, [(start, end)], linewidth, order)
+            profile = profiles[0, :lengths[0]]
+        return {
+            "start": start,
+            "end": end,
+            "data": profile,
+        }
+
+    region = get_region(image_data, operation.get('subregion'))
+    if operation_type == 'statistics':
+        which = operation.get('stats', ALL_STATS)
+        return {"stats": compute_region_stats(region, which=which, value_counts=value_counts)}
+    if operation_type == 'histogram':
+        return {"histogram": get_clipped_histogram(region, operation['clip_percent'], value_counts)}
+
+    raise ValueError(f"Unknown operation type: {operation_type}. Expected one of {OPERATION_TYPES}")
+
+
+def _run_operation_safely(image_data, operation, region_counts, profile):
+    try:
+        value_counts = None
+        if operation.get('type') in ('statistics', 'histogram'):
+            value_counts = region_counts.get(get_region_key(operation.get('subregion')))
+        result = run_operation(image_data, operation, value_counts, profile)
+    except Exception as e:
+        return {"type": operation.get('type'), "success": False, "message": f"Error: {str(e)}"}
+    return dict(type=operation['type'], success=True, **result)
+
+
+def run_operations(image_data, operations, pool=analysis_pool):
+    """ Run a batch of operations against one image.
+
+    Operations on the same subregion share a single count of its pixel values,
+    line profiles with the same options are extracted together in one
+    vectorized call, and independent work runs concurrently on `pool`. A
+    failing operation reports its error in its own result without affecting
+    the others.
+
+    Args:
+        image_data (2d numpy array): the full image.
+        operations (list of dict): see `run_operation`.
+        pool (concurrent.futures.Executor): where to run the work.
+
+    Returns:
+        list of dict: one result per operation, in the same order, each with
+            'type' and 'success' keys (and 'message' on failure).
+    """
+    # Count the pixel values of each distinct region once
+    counts_futures = {}
+    for operation in operations:
+        if operation.get('type') in ('statistics', 'histogram'):
+            subregion = operation.get('subregion')
+            try:
+                key = get_region_key(subregion)
+                if key in counts_futures:
+                    continue
+            except Exception:
+                continue  # the error is reported when the operation runs on its own
+            counts_futures[key] = submit(pool, _get_region_counts, image_data, subregion)
+
+    # Group the line profiles by their (linewidth, order) options
+    line_groups = {}
+    for index, operation in enumerate(operations):
+        if operation.get('type') == 'lineprofile':
+            try:
+                start, end, linewidth, order = parse_line_operation(operation)
+            except Exception:
+                continue  # the error is reported when the operation runs on its own
+            line_groups.setdefault((linewidth, order), []).append((index, (start, end)))
+    profile_futures = {
+        options: submit(pool, get_intensity_profiles, image_data, [line for _, line in members], *options)
+        for options, members in line_groups.items()
+    }
+
+    region_counts = {key: future.result() for key, future in counts_futures.items()}
+    line_profiles = {}
+    for options, members in line_groups.items():
+        try:
+            profiles, lengths = profile_futures[options].result()
+        except Exception:
+            continue
+        for row, (index, _) in enumerate(members):
+            line_profiles[index] = profiles[row, :lengths[row]]
+
+    futures = [
+        submit(pool, _run_operation_safely, image_data, operation, region_counts, line_profiles.get(index))
+        for index, operation in enumerate(operations)
+    ]
+    return [future.result() for future in futures]
+
+
+def _get_region_counts(image_data, subregion):
+    # Failures are reported by the operations themselves when they run
+    try:
+        return get_value_counts(get_region(image_data, subregion))
+    except Exception:
+        return None
@@ -0,0 +1,149 @@
+"""Render stretched previews of an image as PNG or WebP, without matplotlib.
+
+A preview is made in three steps, so that each can be cached on its own:
+
+1. `get_stretch_parameters` turns the image's full frame statistics into the
+   black point, white point and midtone balance of a stretch.
+2. `render_preview` resizes the smallest pyramid level that is large enough
+   and stretches it to an 8-bit grayscale image.
+3. `encode_preview` optionally draws a line over that image and encodes it.
+
+The auto stretch follows the screen transfer function of PixInsight: the
+black point is clipped a few noise sigmas below the median, and the midtones
+are balanced so that the median lands on a dark gray background.
+"""
+import io
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from quickanalysis.analysis.pyramid import get_pyramid_level
+
+STRETCHES = ('auto', 'linear')
+FORMATS = {'png': 'image/png', 'webp': 'image/webp'}
+
+# Auto stretch: where the median ends up in [0, 1], and how far below the
+# median (in sigmas estimated from the MAD) the black point is clipped.
+TARGET_BACKGROUND = 0.25
+SHADOWS_CLIP = -1.25
+MAD_TO_SIGMA = 1.4826
+
+# Favour encoding speed: previews are small, and made while the user waits.
+PNG_COMPRESS_LEVEL = 1
+WEBP_QUALITY = 90
+
+OVERLAY_COLOR = (255, 51, 51)
+
+
+def midtones_transfer(midtone, x):
+    """The midtones transfer function, mapping 0 to 0, `midtone` to 0.5 and 1 to 1.
+
+    Args:
+        midtone (float): in (0, 1).
+        x (float or numpy array): values in [0, 1].
+    """
+    return (midtone - 1) * x / ((2 * midtone - 1) * x - midtone)
+
+
+def get_stretch_parameters(stats, stretch='auto'):
+    """Compute a stretch from an image's statistics.
+
+    Args:
+        stats (dict): 'median', 'median_abs_deviation', 'min' and 'max' of the
+            image, eg. from `load_data.get_image_stats`.
+        stretch (str): 'auto' to clip the shadows and brighten the background
+            (see the module docstring), or 'linear' to map min to max linearly.
+
+    Returns:
+        dict: 'black' and 'white' (pixel values shown as black and white) and
+            'midtone' (the value in [0, 1] between them that is shown as mid
+            gray; 0.5 for a linear stretch).
+    """
+    if stretch == 'linear':
+        return {'black': float(stats['min']), 'white': float(stats['max']), 'midtone': 0.5}
+    if stretch != 'auto':
+        raise ValueError(f'Unknown stretch: {stretch}')
+
+    # The stretch is computed on the data normalized by its maximum
+    white = float(stats['max'])
+    if white <= 0:
+        return {'black': 0.0, 'white': white, 'midtone': 0.5}
+    median = stats['median'] / white
+    sigma = MAD_TO_SIGMA * stats['median_abs_deviation'] / white
+    black = min(max(median + SHADOWS_CLIP * sigma, 0.0), 1.0)
+    midtone = 0.5
+    if black < 1:
+        midtone = float(midtones_transfer(TARGET_BACKGROUND, (median - black) / (1 - black)))
+    return {'black': black * white, 'white': white, 'midtone': midtone}
+
+
+def get_preview_shape(shape, size):
+    """Return the (rows, columns) of a preview whose longest side is `size`.
+
+    The aspect ratio of the image is kept, and it is never enlarged.
+    """
+    ylen, xlen = shape[-2:]
+    scale = min(size / max(ylen, xlen), 1.0)
+    return max(1, round(ylen * scale)), max(1, round(xlen * scale))
+
+
+def render_preview(pyramid, stretch, size):
+    """Resize and stretch an image to an 8-bit grayscale preview.
+
+    Args:
+        pyramid (list of 2d numpy arrays): the image's pyramid (see
+            `load_data.get_image_pyramid`). Only the smallest level with at
+            least `size` pixels along its longest side is read.
+        stretch (dict): from `get_stretch_parameters`.
+        size (int): pixels along the longest side of the preview.
+
+    Returns:
+        2d numpy array of uint8, with the first row at the top.
+    """
+    rows, columns = get_preview_shape(pyramid[0].shape, size)
+    level, _ = get_pyramid_level(pyramid, max(rows, columns))
+    # Block means of the resized level, then the stretch on the (small) result
+    resized = Image.fromarray(np.asarray(level, dtype=np.float32)).resize((columns, rows), Image.BOX)
+    x = np.array(resized, dtype=np.float32)
+
+    black, white, midtone = stretch['black'], stretch['white'], stretch['midtone']
+    if not white > black:
+        return np.zeros((rows, columns), dtype=np.uint8)
+    x -= black
+    x /= white - black
+    np.clip(x, 0, 1, out=x)
+    if midtone != 0.5:
+        x = midtones_transfer(midtone, x)
+    x *= 255
+    np.nan_to_num(x, copy=False, nan=0)
+    return np.rint(x).astype(np.uint8)
+
+
+def encode_preview(preview, image_format='png', line=None):
+    """Encode a preview, optionally with a line drawn over it.
+
+    Args:
+        preview (2d numpy array of uint8): from `render_preview`. It is not modified.
+        image_format (str): one of FORMATS.
+        line (tuple of float): optional (x0, y0, x1, y1) line ends, relative
+            to the image dimensions (in [0, 1], with (0, 0) the top left).
+
+    Returns:
+        bytes: the encoded image.
+    """
+    if image_format not in FORMATS:
+        raise ValueError(f'Unknown image format: {image_format}')
+    image = Image.fromarray(preview)
+    if line is not None:
+        image = image.convert('RGB')
+        ylen, xlen = preview.shape
+        x0, y0, x1, y1 = line
+        ends = [(x0 * (xlen - 1), y0 * (ylen - 1)), (x1 * (xlen - 1), y1 * (ylen - 1))]
+        ImageDraw.Draw(image).line(ends, fill=OVERLAY_COLOR, width=max(1, max(xlen, ylen) // 256))
+
+    buffer = io.BytesIO()
+    if image_format == 'png':
+        image.save(buffer, 'PNG', compress_level=PNG_COMPRESS_LEVEL)
+    else:
+        image.save(buffer, 'WEBP', quality=WEBP_QUALITY)
+    return buffer.getvalue()
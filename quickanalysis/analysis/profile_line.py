@@ -1,11 +1,13 @@
 import io
 import base64
 import numpy as np
-from skimage.measure import profile_line
+from scipy import ndimage
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 from matplotlib.figure import Figure
 from auto_stretch.stretch import Stretch
 
+from quickanalysis.analysis.pyramid import build_pyramid, get_pyramid_level
+
 def get_pixel_dimensions(image_data_array, start, end):
     ''' Compute pixel coordinate values based on image dimensions and relative
     coordinats.
@@ -21,7 +23,7 @@ def get_pixel_dimensions(image_data_array, start, end):
                 in pixels.
     '''
     # Get the x,y dimensions so that we can calculate the line coordinates.
-    ylen, xlen = np.shape(image_data_array)
+    ylen, xlen = np.shape(image_data_array)[-2:]
     xlen -= 1
     ylen -= 1
 
@@ -47,25 +49,86 @@ def get_intensity_profile(image_data_array, start, end):
         List: intensity values between start and end point.
     '''
 
-    x0, y0, x1, y1 = get_pixel_dimensions(image_data_array, start, end)
+    profiles, lengths = get_intensity_profiles(image_data_array, [(start, end)])
+    return list(profiles[0, :lengths[0]])
 
-    # Extract intensity values along some profile line
-    # This method expects y=0 to be the top of the image. 
-    p = profile_line(image_data_array, [y0, x0], [y1, x1], mode="constant", cval=-1)
 
-    return list(p)
+def get_intensity_profiles(image_data_array, lines, linewidth=1, order=1):
+    ''' Compute intensity profiles along many lines with one interpolation call.
 
+    Each line is sampled like `skimage.measure.profile_line`: at
+    ceil(length) + 1 evenly spaced points including both ends, averaging
+    `linewidth` points spread perpendicular to the line. Points outside the
+    image are -1. The sample coordinates for every line are built together
+    and interpolated with a single `scipy.ndimage.map_coordinates` call.
 
-def get_intensity_profile_input_plot(image_data_array, start, end):
+    Args:
+        image_data_array (2d numpy array)
+        lines (list of (start, end)): start and end points of each line, as
+            (x, y) tuples of fractions of the image size (as in `get_intensity_profile`).
+        linewidth (int): width of the profile in pixels, perpendicular to the line.
+        order (int): spline interpolation order, 0 (nearest) to 5.
+
+    Return:
+        (2d numpy array, 1d numpy array): the profiles, one row per line and
+            padded with NaN after the end of shorter lines, and the number of
+            samples in each profile.
+    '''
+    pixel_lines = np.array(
+        [get_pixel_dimensions(image_data_array, start, end) for start, end in lines],
+        dtype=float,
+    ).reshape(-1, 4)
+    x0, y0, x1, y1 = pixel_lines.T
+    d_row = y1 - y0
+    d_col = x1 - x0
+
+    # Index every sample by its line and its position along the line
+    lengths = np.ceil(np.hypot(d_row, d_col) + 1).astype(int)
+    line_index = np.repeat(np.arange(len(lengths)), lengths)
+    step = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    fraction = step / np.maximum(lengths - 1, 1)[line_index]
+    rows = (y0[line_index] + fraction * d_row[line_index])[:, np.newaxis]
+    cols = (x0[line_index] + fraction * d_col[line_index])[:, np.newaxis]
+
+    # Spread linewidth points across each sample, perpendicular to its line.
+    # (linewidth - 1 converts from counting pixels to distances between them)
+    if linewidth > 1:
+        theta = np.arctan2(d_row, d_col)[line_index][:, np.newaxis]
+        across = np.linspace(-1, 1, linewidth)
+        rows = rows + (linewidth - 1) * np.cos(theta) / 2 * across
+        cols = cols + (linewidth - 1) * np.sin(-theta) / 2 * across
+
+    pixels = ndimage.map_coordinates(
+        image_data_array,
+        [rows.ravel(), cols.ravel()],
+        output=np.float64,
+        order=order,
+        mode='constant',
+        cval=-1,
+        prefilter=order > 1,
+    )
+    samples = pixels.reshape(rows.shape).mean(axis=1)
+
+    profiles = np.full((len(lengths), lengths.max(initial=0)), np.nan)
+    profiles[line_index, step] = samples
+    return profiles, lengths
+
+
+def get_intensity_profile_input_plot(image_data_array, start, end, pyramid=None):
     ''' Create a png plot of the image overlayed with the input line.
 
     This is useful for visualizing the analysis that is requested.
 
+    The image is stretched and drawn from the smallest pyramid level that still
+    has more pixels than the figure, rather than from the full resolution data.
+
     Args: 
         image_data_array (2d numpy array)
         start (tuple[float]): x, y point for the start of the line, denoted by 
             fraction of size (value will be between 0 and 1)
         end (tuple[float]): same as start
+        pyramid (list of 2d numpy arrays): optional precomputed `build_pyramid`
+            output for the image (eg. from `load_data.get_image_pyramid`).
     
     Return: 
         Str: png represented by a base 64 string
@@ -81,7 +144,15 @@ def get_intensity_profile_input_plot(image_data_array, start, end):
     axis.set_xlabel("x-axis")
     axis.set_ylabel("y-axis")
     axis.grid()
-    axis.imshow(Stretch().stretch(image_data_array), cmap='Greys')
+
+    # Draw a downsampled level, stretched over the original pixel coordinates
+    if pyramid is None:
+        pyramid = build_pyramid(image_data_array)
+    figure_size = int(max(fig.get_size_inches()) * fig.dpi)
+    preview, _ = get_pyramid_level(pyramid, figure_size)
+    ylen, xlen = np.shape(image_data_array)[-2:]
+    extent = (-0.5, xlen - 0.5, ylen - 0.5, -0.5)
+    axis.imshow(Stretch().stretch(preview), cmap='Greys', extent=extent)
     axis.plot( [x0, x1], [y0, y1], color="#f33")
 
     # Convert plot to PNG image
@@ -0,0 +1,58 @@
+import numpy as np
+
+# Stop adding levels once the longest side of an image would drop below this.
+MIN_LEVEL_SIZE = 256
+
+
+def downsample_block_mean(arr, factor=2):
+    """Downsample a 2d array by averaging non-overlapping factor x factor blocks.
+
+    Rows and columns that don't fill a whole block at the bottom and right
+    edges are dropped.
+
+    Args:
+        arr (2d numpy array): the image to downsample.
+        factor (int): block size.
+
+    Returns:
+        2d numpy array of float32 block means.
+    """
+    ylen = arr.shape[0] // factor * factor
+    xlen = arr.shape[1] // factor * factor
+    blocks = arr[:ylen, :xlen].reshape(ylen // factor, factor, xlen // factor, factor)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+def build_pyramid(arr, min_size=MIN_LEVEL_SIZE):
+    """Build a multi-resolution pyramid of block means (1x, 2x, 4x, 8x...).
+
+    Each level is computed from the previous one, so the whole pyramid costs
+    about one pass over the full resolution image.
+
+    Args:
+        arr (2d numpy array): the full resolution image. It is used as-is for
+            the first level, not copied.
+        min_size (int): don't add a level whose longest side is below this.
+
+    Returns:
+        list of 2d numpy arrays: level i is downsampled by a factor of 2**i.
+    """
+    levels = [arr]
+    while max(levels[-1].shape) // 2 >= min_size and min(levels[-1].shape) >= 2:
+        levels.append(downsample_block_mean(levels[-1]))
+    return levels
+
+
+def get_pyramid_level(pyramid, min_size):
+    """Return the smallest level whose longest side is at least `min_size`.
+
+    This is the cheapest level that still has as much detail as an output of
+    `min_size` pixels can show.
+
+    Returns:
+        (2d numpy array, int): the chosen level and its downsampling factor.
+    """
+    for level in range(len(pyramid) - 1, -1, -1):
+        if max(pyramid[level].shape) >= min_size:
+            return pyramid[level], 2 ** level
+    return pyramid[0], 1
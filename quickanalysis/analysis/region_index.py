@@ -0,0 +1,503 @@
+import numpy as np
+
+from quickanalysis.analysis.region_stats import _interpolate, _percentile_rank, get_value_counts
+
+# Side length (in pixels) of the square tiles the index summarizes.
+INDEX_TILE_SIZE = 64
+
+# Statistics `get_indexed_stats` can answer from the index.
+INDEXED_STATS = ('mean', 'std', 'min', 'max')
+
+
+def supports_region_index(arr):
+    """Whether `build_region_index` can index this image.
+
+    Only 8 and 16 bit integer data is indexed, so the sums of squares fit in int64.
+    """
+    return np.issubdtype(arr.dtype, np.integer) and arr.dtype.itemsize <= 2 and arr.ndim == 2
+
+
+def build_region_index(arr, tile_size=INDEX_TILE_SIZE):
+    """Build an index of an integer image for fast rectangle statistics.
+
+    The image is cut into tile_size x tile_size tiles (smaller at the bottom
+    and right edges). For each tile the index keeps its min and max, and
+    summed-area tables over the grid of tiles hold the cumulative sums of the
+    pixel values and of their squares. The sum over any block of whole tiles
+    is then four lookups.
+
+    Sums are kept as int64, so they are exact. Full resolution summed-area
+    tables would cost 16 bytes per pixel (800 MB for a 50 MP frame); at tile
+    resolution the index is a few hundred KB.
+
+    Args:
+        arr (2d numpy array of 8 or 16 bit ints): the image.
+        tile_size (int): side length of the tiles.
+
+    Returns:
+        dict: 'tile_size', 'shape', 'sum' and 'sum_sq' (summed-area tables with
+            an extra leading row and column of zeros), and per tile 'min' and 'max'.
+    """
+    if not supports_region_index(arr):
+        raise ValueError("The region index only supports 8 and 16 bit integer images")
+    tile_rows = -(-arr.shape[0] // tile_size)
+    tile_cols = -(-arr.shape[1] // tile_size)
+    sums = np.zeros((tile_rows + 1, tile_cols + 1), dtype=np.int64)
+    sums_sq = np.zeros((tile_rows + 1, tile_cols + 1), dtype=np.int64)
+    mins = np.empty((tile_rows, tile_cols), dtype=arr.dtype)
+    maxs = np.empty((tile_rows, tile_cols), dtype=arr.dtype)
+
+    column_starts = np.arange(0, arr.shape[1], tile_size)
+    for row in range(tile_rows):
+        band = arr[row * tile_size:(row + 1) * tile_size].astype(np.int64)
+        sums[row + 1, 1:] = np.add.reduceat(band.sum(axis=0), column_starts)
+        sums_sq[row + 1, 1:] = np.add.reduceat((band * band).sum(axis=0), column_starts)
+        mins[row] = np.minimum.reduceat(band.min(axis=0), column_starts)
+        maxs[row] = np.maximum.reduceat(band.max(axis=0), column_starts)
+
+    return {
+        "tile_size": tile_size,
+        "shape": arr.shape,
+        "sum": sums.cumsum(axis=0).cumsum(axis=1),
+        "sum_sq": sums_sq.cumsum(axis=0).cumsum(axis=1),
+        "min": mins,
+        "max": maxs,
+    }
+
+
+def split_rect(index, ystart, yend, xstart, xend):
+    """Split a rectangle into the whole tiles it covers and the strips around them.
+
+    Returns:
+        (tuple or None, list of tuples): the (tile_ystart, tile_yend, tile_xstart,
+            tile_xend) range of whole tiles inside the rectangle (None if there
+            are none), and the (ystart, yend, xstart, xend) pixel bounds of the
+            strips of the rectangle outside those tiles.
+    """
+    tile_size = index['tile_size']
+    ylen, xlen = index['shape']
+
+    def whole_tiles(start, end, length):
+        first = -(-start // tile_size)
+        # A partial tile at the image edge is whole if the rectangle reaches the edge
+        last = -(-length // tile_size) if end == length else end // tile_size
+        return first, last
+
+    tile_ystart, tile_yend = whole_tiles(ystart, yend, ylen)
+    tile_xstart, tile_xend = whole_tiles(xstart, xend, xlen)
+    if tile_ystart >= tile_yend or tile_xstart >= tile_xend:
+        return None, [(ystart, yend, xstart, xend)]
+
+    inner_ystart, inner_yend = tile_ystart * tile_size, min(tile_yend * tile_size, ylen)
+    inner_xstart, inner_xend = tile_xstart * tile_size, min(tile_xend * tile_size, xlen)
+    strips = [
+        (ystart, inner_ystart, xstart, xend),
+        (inner_yend, yend, xstart, xend),
+        (inner_ystart, inner_yend, xstart, inner_xstart),
+        (inner_ystart, inner_yend, inner_xend, xend),
+    ]
+    strips = [strip for strip in strips if strip[0] < strip[1] and strip[2] < strip[3]]
+    return (tile_ystart, tile_yend, tile_xstart, tile_xend), strips
+
+
+def _table_sum(table, tiles):
+    tile_ystart, tile_yend, tile_xstart, tile_xend = tiles
+    return int(table[tile_yend, tile_xend] - table[tile_ystart, tile_xend]
+               - table[tile_yend, tile_xstart] + table[tile_ystart, tile_xstart])
+
+
+def get_indexed_stats(index, arr, ystart, yend, xstart, xend, which=INDEXED_STATS):
+    """Compute mean, std, min and max of a rectangle of an image using its index.
+
+    Whole tiles are read from the index and only the strips along the edges of
+    the rectangle are scanned, so the cost depends on the rectangle's
+    perimeter rather than its area.
+
+    Args:
+        index (dict): `build_region_index(arr)`.
+        arr (2d numpy array): the image the index was built from.
+        ystart, yend, xstart, xend (int): pixel bounds of the rectangle, as
+            returned by `get_subregion_bounds`.
+        which (iterable of str): statistics to compute, from INDEXED_STATS.
+
+    Returns:
+        dict: the requested statistics by name, with the same values as
+            `compute_region_stats` on arr[ystart:yend, xstart:xend].
+    """
+    which = tuple(which)
+    unknown = set(which) - set(INDEXED_STATS)
+    if unknown:
+        raise ValueError(f"Statistics not available from the index: {sorted(unknown)}")
+    if ystart >= yend or xstart >= xend:
+        raise ValueError("Cannot compute statistics of an empty array")
+
+    tiles, strips = split_rect(index, ystart, yend, xstart, xend)
+    count = total = total_sq = 0
+    mins, maxs = [], []
+    if tiles is not None:
+        tile_ystart, tile_yend, tile_xstart, tile_xend = tiles
+        count = ((min(tile_yend * index['tile_size'], index['shape'][0]) - tile_ystart * index['tile_size'])
+                 * (min(tile_xend * index['tile_size'], index['shape'][1]) - tile_xstart * index['tile_size']))
+        total = _table_sum(index['sum'], tiles)
+        total_sq = _table_sum(index['sum_sq'], tiles)
+        mins.append(index['min'][tile_ystart:tile_yend, tile_xstart:tile_xend].min())
+        maxs.append(index['max'][tile_ystart:tile_yend, tile_xstart:tile_xend].max())
+    for strip_ystart, strip_yend, strip_xstart, strip_xend in strips:
+        strip = arr[strip_ystart:strip_yend, strip_xstart:strip_xend].astype(np.int64)
+        count += strip.size
+        total += int(strip.sum())
+        total_sq += int((strip * strip).sum())
+        mins.append(strip.min())
+        maxs.append(strip.max())
+
+    results = {}
+    if 'min' in which:
+        results['min'] = arr.dtype.type(min(mins))
+    if 'max' in which:
+        results['max'] = arr.dtype.type(max(maxs))
+    if 'mean' in which:
+        results['mean'] = total / count
+    if 'std' in which:
+        # Exact integer arithmetic until the final division and square root
+        results['std'] = float(np.sqrt((count * total_sq - total * total) / (count * count)))
+    return results
+
+
+# Number of coarse bins per tile in the histogram index.
+HISTOGRAM_INDEX_BINS = 256
+
+# Statistics `get_indexed_order_stats` can answer from the histogram index.
+ORDER_INDEXED_STATS = ('median', 'mode', 'median_abs_deviation')
+
+# The fraction of a rectangle's pixels the mode search reads from the index
+# before it falls back to counting all of them.
+MAX_MODE_SCAN = 1 / 32
+
+# Statistics `get_approximate_order_stats` can estimate.
+APPROXIMATE_STATS = ('median',)
+
+
+def _get_bin_edges(value_counts, bins):
+    """Integer bin edges splitting the counted values into `bins` bins of about equal population."""
+    low_val, counts = value_counts
+    cumulative = np.cumsum(counts)
+    present = np.flatnonzero(counts)
+    targets = cumulative[-1] * np.arange(1, bins) // bins
+    inner = np.searchsorted(cumulative, targets, side='right')
+    edges = np.unique(np.concatenate(([present[0]], inner, [present[-1] + 1])))
+    edges = edges[(edges >= present[0]) & (edges <= present[-1] + 1)]
+    return edges.astype(np.int64) + low_val
+
+
+def build_histogram_index(arr, value_counts, tile_size=INDEX_TILE_SIZE, bins=HISTOGRAM_INDEX_BINS):
+    """Build an index of an integer image for fast rectangle percentiles.
+
+    The pixel values are split into `bins` coarse bins holding about the same
+    number of pixels of the whole image each. For every tile (as in
+    `build_region_index`) the index keeps the number of its pixels in each
+    bin, and a copy of its pixels in sorted order, so the pixels of a tile
+    that fall in a given bin are one contiguous slice. Summed-area tables
+    over the grid of tiles give the coarse histogram of any block of whole
+    tiles with one lookup per bin.
+
+    The sorted copy costs as much memory as the image itself.
+
+    Args:
+        arr (2d numpy array of 8 or 16 bit ints): the image.
+        value_counts ((int, numpy array)): `get_value_counts(arr)`, which may
+            be trimmed to the values present. Used to choose the bin edges.
+        tile_size (int): side length of the tiles.
+        bins (int): the maximum number of coarse bins.
+
+    Returns:
+        dict: 'tile_size', 'shape', 'edges' (bin i holds the values in
+            [edges[i], edges[i + 1])), 'lookup' (the bin of every value of the
+            dtype, offset by 'lookup_low'), 'sorted' (the pixels of each tile in
+            order, padded to tile_size**2), 'offsets' (where each bin starts in
+            each tile's sorted pixels) and 'table' (summed-area tables of the
+            bin counts, with an extra leading row and column of zeros).
+    """
+    if not supports_region_index(arr):
+        raise ValueError("The histogram index only supports 8 and 16 bit integer images")
+    edges = _get_bin_edges(value_counts, bins)
+    bin_count = len(edges) - 1
+    info = np.iinfo(arr.dtype)
+    lookup = np.searchsorted(edges[1:-1], np.arange(info.min, info.max + 1), side='right').astype(np.intp)
+
+    tile_rows = -(-arr.shape[0] // tile_size)
+    tile_cols = -(-arr.shape[1] // tile_size)
+    count_dtype = np.int32 if arr.size < 2 ** 31 else np.int64
+    sorted_tiles = np.empty((tile_rows * tile_cols, tile_size * tile_size), dtype=arr.dtype)
+    tile_counts = np.zeros((tile_rows, tile_cols, bin_count), dtype=count_dtype)
+
+    columns = np.arange(arr.shape[1]) // tile_size * bin_count
+    for row in range(tile_rows):
+        band = arr[row * tile_size:(row + 1) * tile_size]
+        band_bins = lookup[band.astype(np.intp) - info.min] + columns
+        tile_counts[row] = np.bincount(band_bins.ravel(), minlength=tile_cols * bin_count).reshape(tile_cols, bin_count)
+
+        # Padding sorts to the end of each tile, after every counted pixel
+        padded = np.full((tile_size, tile_cols * tile_size), info.max, dtype=arr.dtype)
+        padded[:band.shape[0], :band.shape[1]] = band
+        tiles = padded.reshape(tile_size, tile_cols, tile_size).transpose(1, 0, 2).reshape(tile_cols, -1)
+        sorted_tiles[row * tile_cols:(row + 1) * tile_cols] = np.sort(tiles, axis=1)
+
+    offsets = np.zeros((tile_rows, tile_cols, bin_count + 1), dtype=np.int32)
+    np.cumsum(tile_counts, axis=2, out=offsets[:, :, 1:])
+    table = np.zeros((tile_rows + 1, tile_cols + 1, bin_count), dtype=count_dtype)
+    table[1:, 1:] = tile_counts.cumsum(axis=0).cumsum(axis=1)
+
+    return {
+        "tile_size": tile_size,
+        "shape": arr.shape,
+        "edges": edges,
+        "lookup": lookup,
+        "lookup_low": int(info.min),
+        "sorted": sorted_tiles,
+        "offsets": offsets,
+        "table": table,
+    }
+
+
+class _RectHistogram:
+    """The coarse histogram of a rectangle of an image, with exact rank queries.
+
+    Only the bins that a query lands in are ever read at full resolution.
+    """
+
+    def __init__(self, index, arr, ystart, yend, xstart, xend):
+        if ystart >= yend or xstart >= xend:
+            raise ValueError("Cannot compute statistics of an empty array")
+        self.index = index
+        self.region = arr[ystart:yend, xstart:xend]
+        self.edges = index['edges']
+        self.tiles, strips = split_rect(index, ystart, yend, xstart, xend)
+
+        self.strip_values = np.concatenate([
+            arr[strip_ystart:strip_yend, strip_xstart:strip_xend].ravel()
+            for strip_ystart, strip_yend, strip_xstart, strip_xend in strips
+        ] or [np.empty(0, dtype=arr.dtype)])
+        self.strip_bins = index['lookup'][self.strip_values.astype(np.intp) - index['lookup_low']]
+        self.counts = np.bincount(self.strip_bins, minlength=len(self.edges) - 1).astype(np.int64)
+        if self.tiles is not None:
+            tile_ystart, tile_yend, tile_xstart, tile_xend = self.tiles
+            table = index['table']
+            self.counts += (table[tile_yend, tile_xend] - table[tile_ystart, tile_xend]
+                            - table[tile_yend, tile_xstart] + table[tile_ystart, tile_xstart])
+        self.cumulative = np.cumsum(self.counts)
+        self.size = int(self.cumulative[-1])
+        self._bin_values = {}
+
+    def bin_values(self, b, ordered=True):
+        """Values of the rectangle's pixels in bin `b`, sorted unless `ordered` is False."""
+        if b in self._bin_values:
+            return self._bin_values[b]
+        parts = [self.strip_values[self.strip_bins == b]]
+        if self.tiles is not None:
+            parts.append(self._tile_bin_values(b))
+        values = np.concatenate(parts)
+        if ordered:
+            values = self._bin_values[b] = np.sort(values)
+        return values
+
+    def _tile_bin_values(self, b):
+        tile_ystart, tile_yend, tile_xstart, tile_xend = self.tiles
+        tile_cols = self.index['offsets'].shape[1]
+        sorted_tiles = self.index['sorted']
+        offsets = self.index['offsets'][tile_ystart:tile_yend, tile_xstart:tile_xend]
+        starts = offsets[:, :, b].ravel().astype(np.intp)
+        lengths = offsets[:, :, b + 1].ravel() - starts
+        rows = np.arange(tile_ystart, tile_yend)[:, None] * tile_cols + np.arange(tile_xstart, tile_xend)
+        # Positions of each tile's slice in the flattened sorted pixels, without a Python loop
+        positions = rows.ravel() * sorted_tiles.shape[1] + starts
+        gather = np.repeat(positions - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+        return sorted_tiles.reshape(-1)[gather]
+
+    def find_bin(self, rank):
+        """Return the bin holding the value with (0-based) `rank`, and the rank within the bin."""
+        b = int(np.searchsorted(self.cumulative, rank, side='right'))
+        return b, rank - int(self.cumulative[b] - self.counts[b])
+
+    def value_at(self, rank):
+        """The exact value with (0-based) `rank` in sorted order."""
+        b, offset = self.find_bin(rank)
+        return self.bin_values(b)[offset]
+
+    def count_less(self, value):
+        """The exact number of pixels with a value less than `value`."""
+        if value <= self.edges[0]:
+            return 0
+        if value >= self.edges[-1]:
+            return self.size
+        b = int(np.searchsorted(self.edges, value, side='right')) - 1
+        below = int(self.cumulative[b] - self.counts[b])
+        return below + int(np.searchsorted(self.bin_values(b), value, side='left'))
+
+    def estimate_value_at(self, rank):
+        """Estimate the value with `rank` from the coarse histogram alone.
+
+        Returns:
+            (float, int): the estimate, and a bound on its difference from the exact value.
+        """
+        b, offset = self.find_bin(rank)
+        low_val, high_val = int(self.edges[b]), int(self.edges[b + 1]) - 1
+        return low_val + (high_val - low_val) * (offset + 0.5) / self.counts[b], high_val - low_val
+
+    def percentile(self, q):
+        lower, gamma = _percentile_rank(self.size, q)
+        low_val = self.value_at(lower)
+        if lower == self.size - 1:
+            return np.float64(low_val)
+        return _interpolate(low_val, self.value_at(lower + 1), gamma)
+
+    def mode(self):
+        # Visit the most populated bins first: once a bin holds fewer pixels
+        # than the best count so far, no value in it or the remaining bins can win.
+        best_value, best_count, visited = None, 0, 0
+        for b in np.argsort(-self.counts, kind='stable'):
+            if self.counts[b] < best_count or self.counts[b] == 0:
+                break
+            visited += self.counts[b]
+            if visited > self.size * MAX_MODE_SCAN:
+                # A flat distribution: counting every pixel is cheaper
+                low_val, counts = get_value_counts(self.region)
+                return low_val + int(np.argmax(counts))
+            low_val = int(self.edges[b])
+            counts = np.bincount(self.bin_values(b, ordered=False).astype(np.intp) - low_val)
+            i = int(np.argmax(counts))
+            if counts[i] > best_count or (counts[i] == best_count and low_val + i < best_value):
+                best_value, best_count = low_val + i, counts[i]
+        return best_value
+
+    def count_less_bounds(self, value):
+        """Bounds on `count_less(value)` from the coarse histogram alone."""
+        if value <= self.edges[0]:
+            return 0, 0
+        if value >= self.edges[-1]:
+            return self.size, self.size
+        b = int(np.searchsorted(self.edges, value, side='right')) - 1
+        below = int(self.cumulative[b] - self.counts[b])
+        if value == self.edges[b]:
+            return below, below
+        return below, below + int(self.counts[b])
+
+    def median_abs_deviation(self, median):
+        # The median of integer data is a whole or half number, so every
+        # deviation from it is `fraction` plus a whole number.
+        fraction = median - np.floor(median)
+        largest = int(np.ceil(max(median - self.edges[0], self.edges[-1] - 1 - median)))
+
+        def smallest(test, low, high):
+            """The smallest whole number in [low, high] for which `test` holds."""
+            while low < high:
+                middle = (low + high) // 2
+                if test(middle):
+                    high = middle
+                else:
+                    low = middle + 1
+            return low
+
+        def deviation_at(rank):
+            # Pixels within `distance` of the median have values in [first, last]
+            def limits(whole):
+                return np.ceil(median - whole - fraction), np.floor(median + whole + fraction) + 1
+
+            def surely_enough(whole):
+                first, last = limits(whole)
+                return self.count_less_bounds(last)[0] - self.count_less_bounds(first)[1] > rank
+
+            def maybe_enough(whole):
+                first, last = limits(whole)
+                return self.count_less_bounds(last)[1] - self.count_less_bounds(first)[0] > rank
+
+            def enough(whole):
+                first, last = limits(whole)
+                return self.count_less(last) - self.count_less(first) > rank
+
+            # Narrow the search with the coarse histogram before reading any bins
+            high = smallest(surely_enough, 0, largest)
+            low = smallest(maybe_enough, 0, high)
+            return smallest(enough, low, high) + fraction
+
+        lower, gamma = _percentile_rank(self.size, 50)
+        low_val = deviation_at(lower)
+        if lower == self.size - 1:
+            return np.float64(low_val)
+        return _interpolate(low_val, deviation_at(lower + 1), gamma)
+
+
+def get_indexed_order_stats(index, arr, ystart, yend, xstart, xend, which=ORDER_INDEXED_STATS, percentiles=()):
+    """Compute median, mode, MAD and percentiles of a rectangle using its histogram index.
+
+    The coarse histogram of the rectangle is merged from the whole tiles'
+    counts and the edge strips' pixels. Each requested rank is then located
+    in one bin, and only the rectangle's pixels in that bin (a slice of each
+    tile's sorted pixels) are read to find its exact value.
+
+    Args:
+        index (dict): `build_histogram_index(arr, ...)`.
+        arr (2d numpy array): the image the index was built from.
+        ystart, yend, xstart, xend (int): pixel bounds of the rectangle, as
+            returned by `get_subregion_bounds`.
+        which (iterable of str): statistics to compute, from ORDER_INDEXED_STATS.
+        percentiles (iterable of float): percentiles to compute, in [0, 100].
+
+    Returns:
+        dict: the requested statistics by name (and 'percentiles' if any were
+            requested), with the same values as `compute_region_stats` on
+            arr[ystart:yend, xstart:xend].
+    """
+    which = tuple(which)
+    unknown = set(which) - set(ORDER_INDEXED_STATS)
+    if unknown:
+        raise ValueError(f"Statistics not available from the index: {sorted(unknown)}")
+    histogram = _RectHistogram(index, arr, ystart, yend, xstart, xend)
+
+    results = {}
+    if 'mode' in which:
+        results['mode'] = arr.dtype.type(histogram.mode())
+    if 'median' in which or 'median_abs_deviation' in which:
+        median = histogram.percentile(50)
+        if 'median' in which:
+            results['median'] = float(median)
+        if 'median_abs_deviation' in which:
+            results['median_abs_deviation'] = float(histogram.median_abs_deviation(median))
+    if len(percentiles):
+        results['percentiles'] = {q: float(histogram.percentile(q)) for q in percentiles}
+    return results
+
+
+def get_approximate_order_stats(index, arr, ystart, yend, xstart, xend, which=APPROXIMATE_STATS, percentiles=()):
+    """Estimate the median and percentiles of a rectangle from its coarse histogram.
+
+    Like `get_indexed_order_stats`, but values are interpolated within their
+    coarse bin instead of being looked up, so no pixel outside the edge
+    strips is read.
+
+    Returns:
+        (dict, dict): the estimated statistics as `get_indexed_order_stats`
+            returns them, and for each one a bound on its absolute error.
+    """
+    which = tuple(which)
+    unknown = set(which) - set(APPROXIMATE_STATS)
+    if unknown:
+        raise ValueError(f"Statistics cannot be estimated from the index: {sorted(unknown)}")
+    histogram = _RectHistogram(index, arr, ystart, yend, xstart, xend)
+
+    def estimate(q):
+        lower, gamma = _percentile_rank(histogram.size, q)
+        low_val, low_error = histogram.estimate_value_at(lower)
+        if lower == histogram.size - 1:
+            return float(low_val), low_error
+        high_val, high_error = histogram.estimate_value_at(lower + 1)
+        # Interpolating between two estimates is off by at most the larger error
+        return float(_interpolate(low_val, high_val, gamma)), max(low_error, high_error)
+
+    results, errors = {}, {}
+    if 'median' in which:
+        results['median'], errors['median'] = estimate(50)
+    if len(percentiles):
+        estimates = {q: estimate(q) for q in percentiles}
+        results['percentiles'] = {q: value for q, (value, _) in estimates.items()}
+        errors['percentiles'] = {q: error for q, (_, error) in estimates.items()}
+    return results, errors
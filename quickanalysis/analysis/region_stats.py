@@ -1,26 +1,330 @@
 import numpy as np
-from scipy import stats
+
+from quickanalysis.analysis.tiled import map_bands
+
+# Statistics returned by `compute_region_stats` when `which` is not specified.
+ALL_STATS = ('median', 'mean', 'mode', 'min', 'max', 'std', 'median_abs_deviation')
+
+# Stats that depend on the ordering of the pixel values (and so need a sort
+# or a histogram rather than a simple reduction).
+ORDER_STATS = ('median', 'mode', 'median_abs_deviation')
+
+# Integer data spanning more than this many distinct values uses the float path.
+MAX_INTEGER_RANGE = 1 << 24
+
+# Number of pixels converted to bin indices at a time while counting values.
+# This bounds the size of temporary arrays when counting large frames (2 MB
+# of indices), and is as fast as larger chunks.
+COUNT_CHUNK_SIZE = 1 << 18
+
+# Integer data spanning more values than this is counted one band at a time,
+# since every band counted in parallel needs its own array of counts.
+MAX_PARALLEL_COUNT_BINS = 1 << 20
+
 
 def get_mode(arr):
-  return stats.mode(arr.flatten())[0][0]
+    return compute_region_stats(arr, which=('mode',))['mode']
 
 def get_median(arr):
-    return np.median(arr)
+    return compute_region_stats(arr, which=('median',))['median']
 
 def get_mean(arr):
-    return np.mean(arr)
+    return sum(map_bands(lambda band: np.sum(band, dtype=np.float64), arr)) / arr.size
 
 def get_min(arr):
-    return np.min(arr)
+    return get_min_max(arr)[0]
 
 def get_max(arr):
-    return np.max(arr)
+    return get_min_max(arr)[1]
 
 def get_std(arr):
-    return np.std(arr)
+    return get_moments(arr)[1]
 
 def get_median_abs_deviation(arr):
-    # NOTE: pixinsight's (v1.8.7) MAD calculation matches the output of scipy.stats.median_absolute_deviation, 
-    # which is deprecated in favor of scipy.stats.median_abs_deviation. If matching pixinsight becomes a priority, 
+    # NOTE: pixinsight's (v1.8.7) MAD calculation matches the output of scipy.stats.median_absolute_deviation,
+    # which is deprecated in favor of scipy.stats.median_abs_deviation. If matching pixinsight becomes a priority,
     # we should swap algorithms.
-    return stats.median_abs_deviation(arr.flatten())
+    return compute_region_stats(arr, which=('median_abs_deviation',))['median_abs_deviation']
+
+
+def get_value_counts(arr):
+    """Count the occurrences of every integer value in an array.
+
+    8 and 16 bit data is counted over the full range of its dtype, so no extra
+    pass is needed to find the min and max. Wider integer types are offset by
+    their minimum value.
+
+    Args:
+        arr (n-dimensional numpy array): the data to analyze
+
+    Returns:
+        (int, numpy array of ints): the value of the first bin and the number of
+            pixels with each value from there upwards, or None if the data is not
+            integer typed or spans too many values to count efficiently.
+    """
+    if not np.issubdtype(arr.dtype, np.integer) or arr.size == 0:
+        return None
+
+    if arr.dtype.itemsize <= 2:
+        info = np.iinfo(arr.dtype)
+        low_val, high_val = int(info.min), int(info.max)
+    else:
+        low_val, high_val = (int(value) for value in get_min_max(arr))
+        if high_val - low_val >= MAX_INTEGER_RANGE:
+            return None
+
+    size = high_val - low_val + 1
+
+    def count_band(band):
+        # Walk over blocks of rows so subregion views are never copied in full,
+        # reusing one buffer of bin indices.
+        band_counts = np.zeros(size, dtype=np.int64)
+        rows_per_chunk = min(max(1, COUNT_CHUNK_SIZE // band.shape[1]), band.shape[0])
+        buffer = np.empty(rows_per_chunk * band.shape[1], dtype=np.intp)
+        for start in range(0, band.shape[0], rows_per_chunk):
+            block = band[start:start + rows_per_chunk]
+            chunk = buffer[:block.size]
+            np.copyto(chunk.reshape(block.shape), block, casting='unsafe')
+            if low_val != 0:
+                chunk -= low_val
+            band_counts += np.bincount(chunk, minlength=size)
+        return band_counts
+
+    # Each band in flight holds its own counts, so only small ranges are counted in parallel.
+    counts = np.zeros(size, dtype=np.int64)
+    for band_counts in map_bands(count_band, arr, parallel=size <= MAX_PARALLEL_COUNT_BINS):
+        counts += band_counts
+    return low_val, counts
+
+
+def get_min_max(arr):
+    """Return the smallest and largest values of an array, found a band of rows at a time.
+
+    NaNs propagate, as with `np.min` and `np.max`.
+    """
+    extremes = np.array(list(map_bands(lambda band: (np.min(band), np.max(band)), arr)))
+    return np.min(extremes[:, 0]), np.max(extremes[:, 1])
+
+
+def get_moments(arr):
+    """Return the mean and standard deviation of an array.
+
+    Each band of rows is summed (in float64) and its squared deviations from
+    its own mean are summed too. The bands are then merged in order with the
+    pairwise update of Chan et al., which avoids the cancellation of a plain
+    sum of squares.
+
+    Returns:
+        (float, float): the mean and the (population) standard deviation.
+    """
+    def band_moments(band):
+        mean = np.sum(band, dtype=np.float64) / band.size
+        deviations = np.subtract(band, mean, dtype=np.float64)
+        np.square(deviations, out=deviations)
+        return band.size, mean, np.sum(deviations)
+
+    n, mean, m2 = 0, 0.0, 0.0
+    for band_n, band_mean, band_m2 in map_bands(band_moments, arr):
+        total = n + band_n
+        delta = band_mean - mean
+        mean += delta * band_n / total
+        m2 += band_m2 + delta * delta * n * band_n / total
+        n = total
+    return float(mean), float(np.sqrt(m2 / n))
+
+
+def compute_region_stats(arr, which=ALL_STATS, percentiles=(), value_counts=None):
+    """Compute several statistics of an image (or subregion) together.
+
+    For integer data a single histogram of the pixel values is built and every
+    statistic is derived from it exactly. Other data is sorted once and the
+    order statistics are read off the sorted copy. Either way the frame is
+    scanned a couple of times at most, instead of once per statistic.
+
+    Args:
+        arr (n-dimensional numpy array): the data to analyze
+        which (iterable of str): names of the statistics to compute, from ALL_STATS.
+        percentiles (iterable of float): percentiles in [0, 100] to compute,
+            using the same linear interpolation as `np.percentile`.
+        value_counts ((int, numpy array)): optional result of `get_value_counts(arr)`,
+            if the caller already has it. `arr` isn't used (and may be None) if
+            this is given.
+
+    Returns:
+        dict: the requested statistics by name. If percentiles were requested,
+            'percentiles' maps each requested percentile to its value.
+    """
+    which = tuple(which)
+    unknown = set(which) - set(ALL_STATS)
+    if unknown:
+        raise ValueError(f"Unknown statistics requested: {sorted(unknown)}")
+    if value_counts is None:
+        if arr.size == 0:
+            raise ValueError("Cannot compute statistics of an empty array")
+        value_counts = get_value_counts(arr)
+
+    if value_counts is not None:
+        low_val, counts = value_counts
+        nonzero = np.flatnonzero(counts)
+        first, last = nonzero[0], nonzero[-1]
+        counts = counts[first:last + 1]
+        values = np.arange(low_val + first, low_val + last + 1)
+        return _stats_from_counts(values, counts, which, percentiles)
+
+    return _stats_from_sorted(arr, which, percentiles)
+
+
+def _percentile_rank(n, q):
+    """Position of percentile `q` among `n` sorted values, as `np.percentile` computes it.
+
+    Returns:
+        (int, float): the rank of the lower neighbour and the interpolation weight
+            of the upper one. The weight is 0 when the percentile falls on the last value.
+    """
+    quantile = np.true_divide(q, 100)
+    index = (n - 1) * quantile
+    if index >= n - 1:
+        return n - 1, 0.0
+    lower = np.floor(index)
+    return int(lower), index - lower
+
+
+def _interpolate(low_val, high_val, gamma):
+    """Linear interpolation between two neighbouring values, as in `np.percentile`."""
+    low_val, high_val = np.float64(low_val), np.float64(high_val)
+    difference = high_val - low_val
+    if gamma >= 0.5:
+        return high_val - difference * (1 - gamma)
+    return low_val + difference * gamma
+
+
+def _weighted_percentile(values, counts, q):
+    """Percentile `q` of data described by sorted `values` and their `counts`.
+
+    This follows the arithmetic of the default (linear) method of
+    `np.percentile` step by step, so the results are identical to it.
+    """
+    cumulative = np.cumsum(counts)
+    lower, gamma = _percentile_rank(int(cumulative[-1]), q)
+    low_val = values[np.searchsorted(cumulative, lower, side='right')]
+    if lower == cumulative[-1] - 1:
+        return np.float64(low_val)
+    high_val = values[np.searchsorted(cumulative, lower + 1, side='right')]
+    return _interpolate(low_val, high_val, gamma)
+
+
+def _stats_from_counts(values, counts, which, percentiles):
+    n = counts.sum()
+    results = {}
+    if 'min' in which:
+        results['min'] = values[0]
+    if 'max' in which:
+        results['max'] = values[-1]
+    if 'mode' in which:
+        # argmax picks the smallest value on ties, like scipy.stats.mode
+        results['mode'] = values[np.argmax(counts)]
+
+    mean = None
+    if 'mean' in which or 'std' in which:
+        mean = float(np.dot(counts, values.astype(np.float64)) / n)
+    if 'mean' in which:
+        results['mean'] = mean
+    if 'std' in which:
+        deviations = values - mean
+        results['std'] = float(np.sqrt(np.dot(counts, deviations * deviations) / n))
+
+    median = None
+    if 'median' in which or 'median_abs_deviation' in which:
+        median = float(_weighted_percentile(values, counts, 50))
+    if 'median' in which:
+        results['median'] = median
+    if 'median_abs_deviation' in which:
+        deviations = np.abs(values - median)
+        order = np.argsort(deviations, kind='stable')
+        results['median_abs_deviation'] = float(
+            _weighted_percentile(deviations[order], counts[order], 50))
+
+    if len(percentiles):
+        results['percentiles'] = {
+            q: float(_weighted_percentile(values, counts, q)) for q in percentiles
+        }
+    return results
+
+
+def _sorted_mode(flat):
+    """Return the first of the most repeated values in a sorted 1d array.
+
+    The runs of equal values are found a block at a time, so the temporary
+    arrays stay small even when nearly every value is distinct.
+    """
+    best_value, best_length = flat[0], 0
+    run_value, run_length = flat[0], 0  # the run continuing from the previous blocks
+    for start in range(0, flat.size, COUNT_CHUNK_SIZE):
+        chunk = flat[start:start + COUNT_CHUNK_SIZE]
+        if chunk[0] != run_value:
+            if run_length > best_length:
+                best_value, best_length = run_value, run_length
+            run_value, run_length = chunk[0], 0
+        run_starts = np.flatnonzero(chunk[1:] != chunk[:-1]) + 1
+        if not run_starts.size:
+            run_length += chunk.size
+            continue
+        run_length += run_starts[0]
+        if run_length > best_length:
+            best_value, best_length = run_value, run_length
+        if run_starts.size > 1:
+            run_lengths = np.diff(run_starts)
+            longest = np.argmax(run_lengths)
+            if run_lengths[longest] > best_length:
+                best_value, best_length = chunk[run_starts[longest]], run_lengths[longest]
+        run_value, run_length = chunk[run_starts[-1]], chunk.size - run_starts[-1]
+    if run_length > best_length:
+        best_value = run_value
+    return best_value
+
+
+def _stats_from_sorted(arr, which, percentiles):
+    results = {}
+    if 'std' in which:
+        mean, results['std'] = get_moments(arr)
+        if 'mean' in which:
+            results['mean'] = mean
+    elif 'mean' in which:
+        results['mean'] = get_mean(arr)
+
+    if not len(percentiles) and not set(which) & set(ORDER_STATS):
+        if 'min' in which or 'max' in which:
+            min_val, max_val = get_min_max(arr)
+            if 'min' in which:
+                results['min'] = min_val
+            if 'max' in which:
+                results['max'] = max_val
+        return results
+
+    # The only copy of the data. Everything that needs it in order is read
+    # first; the percentiles then partition it in place, and it is reused
+    # for the deviations from the median.
+    flat = np.sort(arr, axis=None)
+    if 'min' in which:
+        results['min'] = flat[0]
+    if 'max' in which:
+        results['max'] = flat[-1]
+    if 'mode' in which:
+        results['mode'] = _sorted_mode(flat)
+
+    if len(percentiles):
+        results['percentiles'] = {q: np.percentile(flat, q, overwrite_input=True) for q in percentiles}
+
+    median = None
+    if 'median' in which or 'median_abs_deviation' in which:
+        median = np.median(flat, overwrite_input=True)
+    if 'median' in which:
+        results['median'] = median
+    if 'median_abs_deviation' in which:
+        if np.result_type(flat, median) == flat.dtype:
+            deviations = np.subtract(flat, median, out=flat)
+            np.abs(deviations, out=deviations)
+        else:
+            deviations = np.abs(flat - median)
+        results['median_abs_deviation'] = np.median(deviations, overwrite_input=True)
+    return results
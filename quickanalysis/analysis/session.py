@@ -0,0 +1,52 @@
+"""Columnar tables of the statistics of the frames of an observing session.
+
+The frames of a session are compared with each other (eg. to follow the
+background as it drifts), so their statistics are returned as columns, one
+value per frame, rather than as one record per frame. Histograms share their
+edges, so they can be plotted as an image of frames against pixel values.
+"""
+import numpy as np
+
+from quickanalysis.analysis.histogram import get_histogram_counts
+from quickanalysis.analysis.region_stats import ALL_STATS
+
+
+def get_session_range(summaries):
+    """Return the lowest minimum and highest maximum of a list of image summaries."""
+    return (min(summary['stats']['min'] for summary in summaries),
+            max(summary['stats']['max'] for summary in summaries))
+
+
+def build_session_table(summaries, which=ALL_STATS, histogram_bins=None, lo=None, hi=None):
+    """Gather the statistics (and optionally histograms) of several frames into columns.
+
+    Args:
+        summaries (list of dict): the frames' `load_data.get_image_summary`, in order.
+        which (iterable of str): the statistics to include, from ALL_STATS.
+        histogram_bins (int): optional number of histogram bins. Without it no
+            histograms are returned.
+        lo (float): lower edge of the histograms. Defaults to the lowest pixel of any frame.
+        hi (float): upper edge of the histograms. Defaults to the highest pixel of any frame.
+
+    Returns:
+        dict: 'stats', with a float64 numpy array of each statistic (one
+            element per frame), and with `histogram_bins`, 'histograms': 'edges'
+            (shared by every frame) and 'counts', a frames x bins int64 array.
+    """
+    table = {'stats': {
+        name: np.array([summary['stats'][name] for summary in summaries], dtype=np.float64) for name in which
+    }}
+    if histogram_bins is None:
+        return table
+
+    low, high = get_session_range(summaries) if summaries else (0, 0)
+    lo = low if lo is None else lo
+    hi = high if hi is None else hi
+    if hi < lo:
+        raise ValueError("hi must not be less than lo")
+    edges = np.linspace(lo, hi, histogram_bins + 1)
+    counts = np.zeros((len(summaries), histogram_bins), dtype=np.int64)
+    for row, summary in zip(counts, summaries):
+        row[:] = get_histogram_counts(summary['histogram'], edges)
+    table['histograms'] = {'edges': edges, 'counts': counts}
+    return table
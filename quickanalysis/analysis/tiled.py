@@ -0,0 +1,67 @@
+"""Reduce large arrays a band of rows at a time, on several cores.
+
+Most numpy reductions release the GIL, so the bands of a frame can be
+reduced on `pools.stats_pool` at once while the request's thread merges the
+partial results. The bands depend only on the shape of the array, never on
+the number of workers, and the partial results are merged in band order, so
+the results are identical whether the bands run in parallel or one after
+the other (as they do when STATS_WORKERS is 1).
+"""
+from collections import deque
+
+from quickanalysis import settings
+from quickanalysis.utils import pools
+
+# Pixels in a band. This also bounds the temporary arrays made for each band.
+BAND_PIXELS = 1 << 18
+
+
+def get_row_bands(arr, band_pixels=BAND_PIXELS):
+    """Split an array into consecutive bands of whole rows.
+
+    Args:
+        arr (numpy array): the data. Arrays with more than two dimensions are
+            treated as a stack of their rows (along the last axis).
+        band_pixels (int): roughly how many pixels each band holds.
+
+    Returns:
+        list of 2d numpy arrays: views of the bands, in order. There is always
+            at least one band, even for an empty array.
+    """
+    rows = arr.reshape(-1, arr.shape[-1]) if arr.ndim > 1 else arr.reshape(1, -1)
+    rows_per_band = max(1, band_pixels // max(rows.shape[1], 1))
+    return [rows[start:start + rows_per_band] for start in range(0, max(rows.shape[0], 1), rows_per_band)]
+
+
+def map_bands(function, arr, parallel=True):
+    """Apply `function` to each band of rows of `arr` (see `get_row_bands`).
+
+    Args:
+        function (callable): takes a 2d band and returns its partial result.
+            It runs on `pools.stats_pool`, so it must not wait on other tasks
+            submitted to that pool.
+        arr (numpy array): the data.
+        parallel (bool): whether the bands may run on the pool. Otherwise they
+            run one after the other in the calling thread.
+
+    Returns:
+        iterator over the partial results, in band order. Only a couple of
+        bands per worker are submitted ahead of the results being consumed,
+        so merging the results as they come keeps few of them in memory.
+    """
+    bands = get_row_bands(arr)
+    pool = pools.stats_pool
+    if not parallel or pool is None or len(bands) == 1:
+        return map(function, bands)
+    return _map_ahead(pool, function, bands, 2 * settings.STATS_WORKERS)
+
+
+def _map_ahead(pool, function, items, ahead):
+    """Like `pool.map`, but with at most `ahead` items submitted and not yet consumed."""
+    futures = deque()
+    for item in items:
+        if len(futures) >= ahead:
+            yield futures.popleft().result()
+        futures.append(pool.submit(function, item))
+    while futures:
+        yield futures.popleft().result()
@@ -1,5 +1,58 @@
 # Configuration settings
+import os
+import tempfile
 
 S3_BUCKET = 'photonranch-archive'
 
 AWS_REGION = 'us-east-1'
+
+# Total size (in bytes) of decoded image arrays kept in memory by each worker.
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 1e9))
+
+# Total size (in bytes) of data derived from cached images (pyramids, indexes...)
+DERIVED_CACHE_MAX_BYTES = int(os.environ.get('DERIVED_CACHE_MAX_BYTES', 5e8))
+
+# How images are downloaded and decoded:
+#   'url': `fits.getdata` on a presigned url (reads the whole object into memory)
+#   'stream': ranged GETs for .fits/.fits.fz and incremental decompression for .fits.bz2
+IMAGE_LOADER = os.environ.get('IMAGE_LOADER', 'url')
+
+# Decoded images are also kept on local disk, shared by every worker process.
+# Setting DISK_CACHE_MAX_BYTES to 0 disables the disk cache.
+DISK_CACHE_DIR = os.environ.get('DISK_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'quickanalysis'))
+DISK_CACHE_MAX_BYTES = int(os.environ.get('DISK_CACHE_MAX_BYTES', 2e9))
+
+# Threads used to run independent analyses (eg. the operations in a /batch request)
+ANALYSIS_WORKERS = int(os.environ.get('ANALYSIS_WORKERS', os.cpu_count() or 1))
+
+# Threads that reduce bands of rows of a large frame at once (for its value
+# counts, moments, extremes and histograms). 1 reduces them serially.
+STATS_WORKERS = int(os.environ.get('STATS_WORKERS', os.cpu_count() or 1))
+
+# Seconds to remember the s3 metadata (size, ETag) of an image, and that an
+# image doesn't exist. Within these windows repeated requests don't ask s3.
+METADATA_CACHE_TTL = float(os.environ.get('METADATA_CACHE_TTL', 30))
+METADATA_MISSING_TTL = float(os.environ.get('METADATA_MISSING_TTL', 5))
+
+# Most image downloads from s3 running at once in a worker process, and the size
+# of the s3 client's connection pool. Requests beyond this wait for a free slot.
+S3_MAX_CONCURRENT_DOWNLOADS = int(os.environ.get('S3_MAX_CONCURRENT_DOWNLOADS', 8))
+
+# Async serving mode (asgi.py): threads that run the (blocking) Flask views,
+# and the most requests handled at once. Further requests wait their turn.
+ASGI_WORKERS = int(os.environ.get('ASGI_WORKERS', 32))
+ASGI_MAX_CONCURRENT_REQUESTS = int(os.environ.get('ASGI_MAX_CONCURRENT_REQUESTS', 64))
+
+# Images queued by /prefetch are loaded by PREFETCH_WORKERS background threads.
+# At most PREFETCH_QUEUE_SIZE wait at once; the oldest are dropped beyond that.
+PREFETCH_QUEUE_SIZE = int(os.environ.get('PREFETCH_QUEUE_SIZE', 32))
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', 2))
+
+# Frames of a session (see /session-statistics) loaded and summarized at once,
+# and the most frames listed from a prefix (the newest are kept beyond that).
+SESSION_WORKERS = int(os.environ.get('SESSION_WORKERS', 8))
+SESSION_MAX_FRAMES = int(os.environ.get('SESSION_MAX_FRAMES', 500))
+
+# Level of the app's logs. Each request logs its per-stage timings at INFO;
+# DEBUG adds the details of each analysis.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
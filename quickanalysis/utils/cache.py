@@ -0,0 +1,111 @@
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def get_nbytes(value):
+    """Estimate how many bytes a cached value occupies.
+
+    Numpy arrays report their buffer size; tuples, lists and dicts are summed
+    over their members. Anything else falls back to `sys.getsizeof`.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(get_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(get_nbytes(v) for v in value.values())
+    return sys.getsizeof(value)
+
+
+class ImageCache:
+    """Thread-safe LRU cache bounded by the total size of its values in bytes.
+
+    This is used to keep decoded image arrays in memory so that the burst of
+    requests the frontend makes against a single frame only downloads and
+    decodes it once.
+
+    Args:
+        max_bytes (int): evict least recently used entries once the summed
+            size of the cached values would exceed this many bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Return the value stored for `key`, marking it as recently used."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Store `value` under `key`, evicting old entries to stay in budget.
+
+        Values that are larger than the whole budget are not cached.
+
+        Returns:
+            bool: whether the value was stored.
+        """
+        nbytes = get_nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return False
+            while self._entries and self.current_bytes + nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_nbytes
+                self.evictions += 1
+            self._entries[key] = (value, nbytes)
+            self.current_bytes += nbytes
+            return True
+
+    def pop(self, key, default=None):
+        """Remove `key` from the cache and return its value."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self.current_bytes -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        """Remove every entry and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """Return the cache counters as a dict."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "current_bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
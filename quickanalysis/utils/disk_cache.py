@@ -0,0 +1,182 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+
+class DiskArrayCache:
+    """Decoded image arrays stored as .npy files in a local directory.
+
+    Arrays are read back with `np.load(mmap_mode='r')`, so every worker process
+    on the machine shares the same page-cache-backed pixels instead of holding
+    its own decoded copy, and the cache survives worker restarts.
+
+    Files are written to a temporary name and atomically renamed into place,
+    so concurrent workers never read a partial file. When the directory grows
+    past `max_bytes`, the least recently accessed files are deleted. Workers
+    that still have a deleted file mapped keep a valid view of it.
+
+    Args:
+        directory (str): where to keep the cached files. Created if missing.
+        max_bytes (int): total size of the cached files to stay under.
+            Setting this to 0 disables the cache.
+    """
+
+    SUFFIX = '.npy'
+    SIDECAR_SUFFIX = '.npz'
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get_path(self, key, suffix=SUFFIX):
+        """Return the file path used for `key`."""
+        digest = hashlib.sha1(repr(key).encode('utf8')).hexdigest()
+        return os.path.join(self.directory, digest + suffix)
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key):
+        """Return a read-only memory-mapped array for `key`, or None."""
+        if not self.enabled:
+            return None
+        path = self.get_path(key)
+        try:
+            array = np.load(path, mmap_mode='r')
+            os.utime(path)  # mark as recently used for eviction
+        except (OSError, ValueError):
+            self._count('misses')
+            return None
+        self._count('hits')
+        return np.asarray(array)
+
+    def put(self, key, array):
+        """Write `array` to the cache and return the cached, memory-mapped copy.
+
+        Returns:
+            numpy array: the read-only memory-mapped array, or None if the
+                cache is disabled, the array is larger than the budget, or
+                the file couldn't be written.
+        """
+        if not self.enabled or array.nbytes > self.max_bytes:
+            return None
+        path = self.get_path(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self.write_atomic(path, lambda f: np.save(f, np.ascontiguousarray(array)))
+        except OSError:
+            return None
+        self.evict()
+        return self.get(key)
+
+    def get_sidecar(self, key):
+        """Return the dict of small arrays stored with `put_sidecar` for `key`, or None."""
+        if not self.enabled:
+            return None
+        path = self.get_path(key, self.SIDECAR_SUFFIX)
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return arrays
+
+    def put_sidecar(self, key, arrays):
+        """Store a dict of small arrays (eg. precomputed results) for `key`.
+
+        Sidecars are evicted along with the cached images, but don't need the
+        image to be cached.
+
+        Returns:
+            bool: whether the sidecar was written.
+        """
+        if not self.enabled:
+            return False
+        path = self.get_path(key, self.SIDECAR_SUFFIX)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self.write_atomic(path, lambda f: np.savez(f, **arrays))
+        except OSError:
+            return False
+        self.evict()
+        return True
+
+    def write_atomic(self, path, write):
+        """Call `write(file)` on a temporary file, then rename it to `path`."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def list_entries(self):
+        """Return (access time, size, path) for every cached file."""
+        entries = []
+        try:
+            scan = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return entries
+        for entry in scan:
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue  # removed by another worker
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        """Delete the least recently accessed files until under the byte budget."""
+        entries = sorted(self.list_entries())
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                self._count('evictions')
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    def clear(self):
+        """Delete every cached file and reset the counters."""
+        for _, _, path in self.list_entries():
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """Return the cache counters as a dict."""
+        entries = self.list_entries()
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(entries),
+                "current_bytes": sum(size for _, size, _ in entries),
+                "max_bytes": self.max_bytes,
+            }
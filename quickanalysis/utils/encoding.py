@@ -0,0 +1,146 @@
+"""Binary encodings for responses with large numeric arrays.
+
+Every analysis endpoint returns JSON by default. Clients that send
+`Accept: application/octet-stream` or `Accept: application/msgpack` get the
+same payload with numpy arrays sent as raw little-endian buffers, which
+avoids converting every element to a Python number and back.
+
+The octet-stream format is:
+
+    4 bytes     magic b'QAB1'
+    4 bytes     little-endian uint32 length of the JSON header
+    header      UTF-8 JSON of the payload, padded with spaces to 8 bytes
+    buffers     the array data, each buffer starting on an 8 byte boundary
+
+In the header, each array is replaced by
+`{"__ndarray__": {"dtype": "<u2", "shape": [rows, cols], "offset": n}}`, where
+`offset` is the position of its data from the start of the buffers.
+
+With msgpack, each array is encoded as a map with 'dtype', 'shape' and
+'data' (the raw little-endian bytes) under the same '__ndarray__' key.
+"""
+import json
+import struct
+
+import msgpack
+import numpy as np
+from flask import Response, jsonify, request
+
+from quickanalysis.utils.metrics import span
+from quickanalysis.utils.useful import NumpyEncoder
+
+MAGIC = b'QAB1'
+ALIGNMENT = 8
+ARRAY_KEY = '__ndarray__'
+
+JSON_MIMETYPE = 'application/json'
+BINARY_MIMETYPE = 'application/octet-stream'
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+def _little_endian(arr):
+    """Return a C-contiguous little-endian version of `arr` (no copy if it already is one)."""
+    return np.ascontiguousarray(arr, dtype=arr.dtype.newbyteorder('<'))
+
+
+def _replace_arrays(obj, replace):
+    """Copy a payload of dicts/lists/tuples with every numpy array passed through `replace`."""
+    if isinstance(obj, np.ndarray) and obj.dtype != object:
+        return {ARRAY_KEY: replace(_little_endian(obj))}
+    if isinstance(obj, dict):
+        return {key: _replace_arrays(value, replace) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_replace_arrays(value, replace) for value in obj]
+    return obj
+
+
+def encode_binary(payload):
+    """Encode a payload in the octet-stream format described above.
+
+    Returns:
+        bytes
+    """
+    buffers = []
+    size = 0
+
+    def replace(arr):
+        nonlocal size
+        offset = size
+        padding = -arr.nbytes % ALIGNMENT
+        buffers.append(memoryview(arr).cast('B'))
+        buffers.append(b'\0' * padding)
+        size += arr.nbytes + padding
+        return {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": offset}
+
+    header = json.dumps(_replace_arrays(payload, replace), cls=NumpyEncoder).encode('utf8')
+    header += b' ' * (-(len(header) + 8) % ALIGNMENT)
+    return b''.join([MAGIC, struct.pack('<I', len(header)), header] + buffers)
+
+
+def decode_binary(data):
+    """Decode bytes written by `encode_binary`, restoring the numpy arrays."""
+    magic, header_length = struct.unpack_from('<4sI', data)
+    if magic != MAGIC:
+        raise ValueError('Not a quickanalysis binary payload')
+    start = 8 + header_length
+    buffers = memoryview(data)[start:]
+
+    def restore(obj):
+        if isinstance(obj, dict):
+            if ARRAY_KEY in obj:
+                info = obj[ARRAY_KEY]
+                dtype = np.dtype(info['dtype'])
+                count = int(np.prod(info['shape']))
+                arr = np.frombuffer(buffers, dtype=dtype, count=count, offset=info['offset'])
+                return arr.reshape(info['shape'])
+            return {key: restore(value) for key, value in obj.items()}
+        if isinstance(obj, list):
+            return [restore(value) for value in obj]
+        return obj
+
+    return restore(json.loads(bytes(data[8:start]).decode('utf8')))
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, np.bool_):
+        return bool(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()  # only object arrays get here
+    raise TypeError(f'Cannot encode {type(obj)} with msgpack')
+
+
+def encode_msgpack(payload):
+    """Encode a payload as msgpack, with arrays as raw little-endian bytes."""
+    def replace(arr):
+        return {"dtype": arr.dtype.str, "shape": list(arr.shape), "data": memoryview(arr).cast('B')}
+    return msgpack.packb(_replace_arrays(payload, replace), default=_msgpack_default)
+
+
+def decode_msgpack(data):
+    """Decode bytes written by `encode_msgpack`, restoring the numpy arrays."""
+    def object_hook(obj):
+        if ARRAY_KEY in obj:
+            info = obj[ARRAY_KEY]
+            return np.frombuffer(info['data'], dtype=info['dtype']).reshape(info['shape'])
+        return obj
+    return msgpack.unpackb(data, object_hook=object_hook, strict_map_key=False)
+
+
+def make_response(payload, status=200):
+    """Return `payload` encoded in the format the client asked for.
+
+    The format is chosen from the request's Accept header: octet-stream and
+    msgpack clients get the binary encodings above, everyone else gets JSON.
+    """
+    mimetype = request.accept_mimetypes.best_match(
+        (JSON_MIMETYPE, BINARY_MIMETYPE) + MSGPACK_MIMETYPES, default=JSON_MIMETYPE)
+    with span('serialize'):
+        if mimetype == BINARY_MIMETYPE:
+            return Response(encode_binary(payload), status=status, mimetype=BINARY_MIMETYPE)
+        if mimetype in MSGPACK_MIMETYPES:
+            return Response(encode_msgpack(payload), status=status, mimetype=mimetype)
+        return jsonify(payload), status
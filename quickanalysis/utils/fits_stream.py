@@ -0,0 +1,568 @@
+"""Decode FITS images from s3 without buffering the whole object in memory.
+
+Uncompressed `.fits` and tile compressed `.fits.fz` files are read with
+ranged GET requests: the headers are fetched first, then only the bytes of
+the image HDU. `.fits.bz2` files can't be seeked, so they are streamed and
+decompressed incrementally into an array preallocated from the header.
+
+When only a rectangular window of the image is needed, uncompressed files
+fetch just the rows overlapping it and tile compressed files fetch and decode
+just the tiles overlapping it.
+
+By default the first HDU with image data is read. Another HDU of a
+multi-extension file can be selected by its index or EXTNAME; the HDUs
+before it are skipped over without being fetched (or, for bz2, decoded).
+"""
+import bz2
+import itertools
+import re
+
+import numpy as np
+from astropy.io import fits
+from botocore.exceptions import ClientError
+
+from quickanalysis.utils.metrics import add_bytes_fetched
+from quickanalysis.utils.metrics import span
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+# Size of the pieces that object bodies are streamed in.
+STREAM_CHUNK_SIZE = 1 << 20
+
+# Bytes requested when fetching a header with a ranged GET. Most headers fit.
+HEADER_FETCH_SIZE = 4 * BLOCK_SIZE
+
+BITPIX_DTYPES = {8: '>u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+# Binary table column formats: TFORM codes and their sizes in bytes.
+TFORM_PATTERN = re.compile(r'(\d*)([LXBIJKAEDCMPQ])')
+TFORM_SIZES = {'L': 1, 'B': 1, 'I': 2, 'J': 4, 'K': 8, 'A': 1, 'E': 4, 'D': 8, 'C': 8, 'M': 16, 'P': 8, 'Q': 16}
+
+# Header keywords that no longer hold once a compressed table is cut down to a window.
+CHECKSUM_KEYWORDS = ('CHECKSUM', 'DATASUM', 'ZHECKSUM', 'ZDATASUM')
+
+# Minimal primary HDU used to wrap an extension so astropy can decode it.
+EMPTY_PRIMARY_HEADER = fits.PrimaryHDU().header.tostring().encode('ascii')
+
+
+class HDUNotFoundError(LookupError):
+    """Raised when a FITS file has no HDU matching a selector, or it has no image data."""
+
+
+def find_header_end(buffer):
+    """Return the padded length of the FITS header at the start of `buffer`.
+
+    Returns None if the END card is not in `buffer` yet.
+    """
+    for offset in range(0, len(buffer) - CARD_SIZE + 1, CARD_SIZE):
+        if buffer[offset:offset + 8] == b'END     ':
+            return (offset // BLOCK_SIZE + 1) * BLOCK_SIZE
+    return None
+
+
+def get_data_size(header):
+    """Return the size in bytes of the data following a header, including padding."""
+    naxis = header.get('NAXIS', 0)
+    if naxis == 0:
+        return 0
+    count = 1
+    for axis in range(1, naxis + 1):
+        count *= header[f'NAXIS{axis}']
+    size = abs(header['BITPIX']) // 8 * header.get('GCOUNT', 1) * (header.get('PCOUNT', 0) + count)
+    return -(-size // BLOCK_SIZE) * BLOCK_SIZE
+
+
+def get_image_shape(header):
+    """Return the numpy shape (slowest axis first) of an image or compressed image HDU."""
+    prefix = 'Z' if is_compressed_image_hdu(header) else ''
+    naxis = header[f'{prefix}NAXIS']
+    return tuple(header[f'{prefix}NAXIS{axis}'] for axis in range(naxis, 0, -1))
+
+
+def get_table_columns(header):
+    """Describe the columns in a row of a binary table.
+
+    Returns:
+        list of (int, str, int): byte offset of the column within the row, its
+            TFORM code, and for variable length ('P'/'Q') columns the size of
+            each element stored in the heap (None otherwise).
+    """
+    columns = []
+    offset = 0
+    for n in range(1, header['TFIELDS'] + 1):
+        tform = header[f'TFORM{n}'].strip()
+        match = TFORM_PATTERN.match(tform)
+        repeat = int(match.group(1)) if match.group(1) else 1
+        code = match.group(2)
+        heap_element_size = None
+        if code == 'X':
+            width = -(-repeat // 8)
+        else:
+            width = repeat * TFORM_SIZES[code]
+        if code in 'PQ':
+            heap_element_size = TFORM_SIZES[tform[match.end()]]
+        columns.append((offset, code, heap_element_size))
+        offset += width
+    return columns
+
+
+def is_image_hdu(header):
+    """Whether a header describes an uncompressed image with data."""
+    has_data = header.get('NAXIS', 0) > 0
+    return has_data and ('SIMPLE' in header or header.get('XTENSION') == 'IMAGE')
+
+
+def is_compressed_image_hdu(header):
+    """Whether a header describes a tile compressed image."""
+    return header.get('XTENSION') == 'BINTABLE' and bool(header.get('ZIMAGE', False))
+
+
+def match_hdu(header, index, hdu):
+    """Whether the HDU at position `index` of a file is the one selected by `hdu`.
+
+    Args:
+        header (astropy Header): the HDU's header.
+        index (int): position of the HDU in the file, 0 for the primary HDU.
+        hdu (int, str or None): the selector: an index, an EXTNAME (case
+            insensitive), or None for the first HDU with image data.
+
+    Raises:
+        HDUNotFoundError: if the HDU is selected but has no image data.
+    """
+    if hdu is None:
+        return is_image_hdu(header) or is_compressed_image_hdu(header)
+    if isinstance(hdu, str):
+        matched = str(header.get('EXTNAME', '')).strip().upper() == hdu.upper()
+    else:
+        matched = index == hdu
+    if matched and not (is_image_hdu(header) or is_compressed_image_hdu(header)):
+        raise HDUNotFoundError(f'HDU {hdu!r} has no image data')
+    return matched
+
+
+def to_native_byteorder(arr):
+    """Return `arr` in native byte order, swapping in place if needed."""
+    if arr.dtype.isnative:
+        return arr
+    return arr.byteswap(inplace=True).view(arr.dtype.newbyteorder('='))
+
+
+def scale_image_data(raw, header):
+    """Apply BZERO/BSCALE to raw big-endian pixels, like `fits.getdata` does.
+
+    The common unsigned integer convention (eg. BITPIX=16, BZERO=32768), and
+    signed bytes (BITPIX=8, BZERO=-128), are handled in place by flipping the
+    sign bit, so no extra copy of the frame is made. Other scaled data is
+    converted to floats.
+
+    Returns:
+        numpy array in native byte order.
+    """
+    bitpix = header['BITPIX']
+    bscale = header.get('BSCALE', 1)
+    bzero = header.get('BZERO', 0)
+
+    if bscale == 1 and bzero == 0:
+        return to_native_byteorder(raw)
+
+    if bitpix in (16, 32, 64) and bscale == 1 and bzero == 1 << (bitpix - 1):
+        unsigned = raw.view(raw.dtype.str.replace('i', 'u'))
+        unsigned ^= unsigned.dtype.type(1 << (bitpix - 1))
+        return to_native_byteorder(unsigned)
+
+    if bitpix == 8 and bscale == 1 and bzero == -128:
+        raw ^= np.uint8(0x80)
+        return raw.view(np.int8)
+
+    dtype = np.float32 if bitpix in (8, 16, -32) else np.float64
+    data = raw.astype(dtype)
+    if bitpix > 0 and 'BLANK' in header:
+        data[raw == header['BLANK']] = np.nan
+    data *= bscale
+    data += bzero
+    return data
+
+
+def decode_compressed_hdu(header_bytes, data_bytes):
+    """Decode a tile compressed image HDU from its raw bytes using astropy."""
+    hdul = fits.HDUList.fromstring(EMPTY_PRIMARY_HEADER + header_bytes + data_bytes)
+    return to_native_byteorder(np.asarray(hdul[1].data))
+
+
+def copy_stream(chunks, buffer):
+    """Copy an iterable of byte chunks into a writable buffer.
+
+    Returns:
+        int: the number of bytes copied.
+    """
+    view = memoryview(buffer).cast('B')
+    position = 0
+    for chunk in chunks:
+        chunk = chunk[:len(view) - position]
+        view[position:position + len(chunk)] = chunk
+        position += len(chunk)
+        if position == len(view):
+            break
+    return position
+
+
+class S3RangeReader:
+    """Random access to an s3 object using ranged GET requests.
+
+    Args:
+        client: boto3 s3 client
+        bucket (str): s3 bucket name
+        key (str): s3 object key
+        prefix (bytes): optional bytes from the start of the object that were
+            already fetched (eg. with its metadata). Headers in it are not
+            requested again.
+    """
+
+    def __init__(self, client, bucket, key, prefix=b''):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.prefix = prefix
+        self.bytes_fetched = 0
+
+    def _get_range(self, start, length):
+        return self.client.get_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Range=f'bytes={start}-{start + length - 1}',
+        )['Body']
+
+    def read(self, start, length):
+        """Return up to `length` bytes starting at byte `start` (b'' past the end of the object)."""
+        try:
+            with span('fetch'):
+                data = self._get_range(start, length).read()
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'InvalidRange':
+                raise
+            data = b''
+        self.bytes_fetched += len(data)
+        add_bytes_fetched(len(data))
+        return data
+
+    def readinto(self, start, buffer):
+        """Stream the bytes starting at `start` directly into `buffer`."""
+        length = memoryview(buffer).nbytes
+        with span('fetch'):
+            body = self._get_range(start, length)
+            copied = copy_stream(body.iter_chunks(STREAM_CHUNK_SIZE), buffer)
+        self.bytes_fetched += copied
+        add_bytes_fetched(copied)
+        if copied != length:
+            raise EOFError(f'Expected {length} bytes from s3://{self.bucket}/{self.key}, got {copied}')
+
+    def read_header(self, start):
+        """Read the FITS header starting at byte `start`.
+
+        Returns:
+            (astropy Header, bytes): the parsed header and its raw padded bytes.
+        """
+        buffer = self.prefix[start:]
+        while True:
+            header_size = find_header_end(buffer)
+            if header_size is not None:
+                header_bytes = buffer[:header_size]
+                return fits.Header.fromstring(header_bytes.decode('ascii')), header_bytes
+            chunk = self.read(start + len(buffer), HEADER_FETCH_SIZE)
+            if not chunk:
+                raise EOFError(f'No FITS header at byte {start} of s3://{self.bucket}/{self.key}')
+            buffer += chunk
+
+
+class Bz2StreamReader:
+    """Sequential reads from a bz2 compressed object body, decompressed incrementally.
+
+    Multi-stream bz2 files (as written by parallel compressors) are supported.
+
+    Args:
+        body: streaming response body with an `iter_chunks` method.
+    """
+
+    def __init__(self, body):
+        self._chunks = body.iter_chunks(STREAM_CHUNK_SIZE)
+        self._decompressor = bz2.BZ2Decompressor()
+        self._compressed = b''
+        self._pending = b''
+
+    def _next_chunk(self):
+        """Return the next piece of decompressed data, or b'' at the end of the stream."""
+        if self._pending:
+            chunk, self._pending = self._pending, b''
+            return chunk
+        while True:
+            if not self._compressed:
+                with span('fetch'):
+                    self._compressed = next(self._chunks, b'')
+                if not self._compressed:
+                    return b''
+                add_bytes_fetched(len(self._compressed))
+            if self._decompressor.eof:
+                self._decompressor = bz2.BZ2Decompressor()
+            output = self._decompressor.decompress(self._compressed)
+            self._compressed = self._decompressor.unused_data if self._decompressor.eof else b''
+            if output:
+                return output
+
+    def readinto(self, buffer):
+        """Fill `buffer` with the next decompressed bytes.
+
+        Returns:
+            int: the number of bytes written, which is less than the buffer
+                size only at the end of the stream.
+        """
+        view = memoryview(buffer).cast('B')
+        position = 0
+        while position < len(view):
+            chunk = self._next_chunk()
+            if not chunk:
+                break
+            needed = len(view) - position
+            if len(chunk) > needed:
+                chunk, self._pending = chunk[:needed], chunk[needed:]
+            view[position:position + len(chunk)] = chunk
+            position += len(chunk)
+        return position
+
+    def read(self, length):
+        """Return the next `length` decompressed bytes."""
+        buffer = bytearray(length)
+        return bytes(buffer[:self.readinto(buffer)])
+
+    def skip(self, length):
+        """Discard the next `length` decompressed bytes."""
+        buffer = bytearray(min(length, STREAM_CHUNK_SIZE))
+        while length > 0:
+            read = self.readinto(memoryview(buffer)[:min(length, len(buffer))])
+            if read == 0:
+                raise EOFError('Unexpected end of bz2 stream')
+            length -= read
+
+    def read_header(self):
+        """Read the next FITS header in the stream.
+
+        Returns:
+            (astropy Header, bytes): the parsed header and its raw padded bytes.
+        """
+        header_bytes = b''
+        while True:
+            block = self.read(BLOCK_SIZE)
+            if len(block) < BLOCK_SIZE:
+                raise EOFError('No image HDU found in bz2 stream')
+            header_bytes += block
+            if find_header_end(block) is not None:
+                return fits.Header.fromstring(header_bytes.decode('ascii')), header_bytes
+
+
+def find_image_hdu(reader, hdu=None):
+    """Locate an image (or compressed image) HDU using ranged requests.
+
+    Only the headers are fetched on the way to it.
+
+    Args:
+        reader (S3RangeReader): access to the FITS file.
+        hdu (int, str or None): which HDU, as in `match_hdu`.
+
+    Returns:
+        (astropy Header, bytes, int): the image header, its raw bytes, and the
+            byte offset of its data in the file.
+
+    Raises:
+        HDUNotFoundError: if there is no such HDU.
+    """
+    offset = 0
+    for index in itertools.count():
+        try:
+            header, header_bytes = reader.read_header(offset)
+        except EOFError:
+            raise HDUNotFoundError(_describe_missing_hdu(hdu)) from None
+        data_offset = offset + len(header_bytes)
+        if match_hdu(header, index, hdu):
+            return header, header_bytes, data_offset
+        offset = data_offset + get_data_size(header)
+
+
+def _describe_missing_hdu(hdu):
+    return 'No image HDU in the file' if hdu is None else f'No HDU {hdu!r} in the file'
+
+
+def read_image_window(reader, header, data_offset, bounds):
+    """Read the rows of an uncompressed 2d image that overlap a window.
+
+    The rows are fetched with a single ranged request and then cropped.
+    """
+    ystart, yend, xstart, xend = bounds
+    ncols = get_image_shape(header)[-1]
+    raw = np.empty((max(yend - ystart, 0), ncols), dtype=BITPIX_DTYPES[header['BITPIX']])
+    if raw.size:
+        reader.readinto(data_offset + ystart * ncols * raw.itemsize, raw)
+    return scale_image_data(raw, header)[:, xstart:xend]
+
+
+def read_compressed_window(reader, header, data_offset, bounds):
+    """Fetch and decode only the tiles of a compressed 2d image that overlap a window.
+
+    Tiles are stored row-major, so the rows of tiles covering the window are a
+    contiguous run of table rows, and their compressed bytes are a contiguous
+    range of the heap. Those are fetched with two ranged requests and rewritten
+    as a smaller compressed image (with the heap offsets, image height and
+    dither seed adjusted) which astropy then decodes.
+    """
+    ystart, yend, xstart, xend = bounds
+    nrows_image, ncols_image = header['ZNAXIS2'], header['ZNAXIS1']
+    tile_height = header.get('ZTILE2', 1)
+    tiles_per_row = -(-ncols_image // header.get('ZTILE1', ncols_image))
+
+    first_tile_row = ystart // tile_height
+    last_tile_row = max(first_tile_row, (yend - 1) // tile_height)
+    first_row = first_tile_row * tiles_per_row
+    nrows = (last_tile_row - first_tile_row + 1) * tiles_per_row
+    row_size = header['NAXIS1']
+    table = bytearray(reader.read(data_offset + first_row * row_size, nrows * row_size))
+    rows = np.frombuffer(table, dtype=np.uint8).reshape(nrows, row_size)
+
+    # Read the (count, heap offset) descriptors of every variable length column
+    descriptors = []
+    for offset, code, heap_element_size in get_table_columns(header):
+        if code not in 'PQ':
+            continue
+        dtype = np.dtype('>i4' if code == 'P' else '>i8')
+        width = 2 * dtype.itemsize
+        pairs = rows[:, offset:offset + width].copy().view(dtype).reshape(nrows, 2)
+        descriptors.append((offset, width, pairs, heap_element_size))
+
+    heap_ranges = [
+        (pairs[:, 1], pairs[:, 1] + pairs[:, 0] * heap_element_size)
+        for _, _, pairs, heap_element_size in descriptors
+    ]
+    heap_lo = min(int(starts.min()) for starts, _ in heap_ranges)
+    heap_hi = max(int(ends.max()) for _, ends in heap_ranges)
+    heap_start = data_offset + header.get('THEAP', row_size * header['NAXIS2'])
+    heap = reader.read(heap_start + heap_lo, heap_hi - heap_lo) if heap_hi > heap_lo else b''
+
+    # Point the descriptors at the start of the fetched part of the heap
+    for offset, width, pairs, _ in descriptors:
+        pairs[:, 1] = np.where(pairs[:, 0] > 0, pairs[:, 1] - heap_lo, 0)
+        rows[:, offset:offset + width] = pairs.view(np.uint8).reshape(nrows, width)
+
+    band_start = first_tile_row * tile_height
+    band_header = header.copy()
+    band_header['NAXIS2'] = nrows
+    band_header['PCOUNT'] = len(heap)
+    band_header['ZNAXIS2'] = min(nrows_image, (last_tile_row + 1) * tile_height) - band_start
+    if 'ZDITHER0' in band_header:
+        # The dither seed depends on the tile number, which now starts at first_row
+        band_header['ZDITHER0'] = (header['ZDITHER0'] - 1 + first_row) % 10000 + 1
+    for keyword in ('THEAP',) + CHECKSUM_KEYWORDS:
+        band_header.remove(keyword, ignore_missing=True)
+
+    data_bytes = bytes(table) + heap
+    data_bytes += b'\0' * (-len(data_bytes) % BLOCK_SIZE)
+    band = decode_compressed_hdu(band_header.tostring().encode('ascii'), data_bytes)
+    return band[ystart - band_start:yend - band_start, xstart:xend]
+
+
+def load_from_range_reader(reader, window=None, hdu=None):
+    """Decode an image HDU of a FITS file read with ranged requests.
+
+    Only the headers and the image data bytes are fetched.
+
+    Args:
+        reader (S3RangeReader): access to the FITS file.
+        window (callable): optional function that takes the image shape and
+            returns the (ystart, yend, xstart, xend) pixel bounds to read.
+            Only the rows (or compressed tiles) overlapping it are fetched.
+        hdu (int, str or None): which HDU, as in `match_hdu`.
+
+    Returns:
+        numpy array of pixel values in native byte order.
+    """
+    header, header_bytes, data_offset = find_image_hdu(reader, hdu)
+    shape = get_image_shape(header)
+    bounds = None if window is None else window(shape)
+    partial = bounds is not None and len(shape) == 2
+
+    if is_compressed_image_hdu(header):
+        if partial:
+            return read_compressed_window(reader, header, data_offset, bounds)
+        data = decode_compressed_hdu(header_bytes, reader.read(data_offset, get_data_size(header)))
+    elif partial:
+        return read_image_window(reader, header, data_offset, bounds)
+    else:
+        raw = np.empty(shape, dtype=BITPIX_DTYPES[header['BITPIX']])
+        reader.readinto(data_offset, raw)
+        data = scale_image_data(raw, header)
+
+    return data if bounds is None else crop(data, bounds)
+
+
+def crop(image_array, bounds):
+    """Slice (ystart, yend, xstart, xend) pixel bounds out of an image array."""
+    ystart, yend, xstart, xend = bounds
+    return image_array[..., ystart:yend, xstart:xend]
+
+
+def load_from_stream(reader, hdu=None):
+    """Decode an image HDU of a FITS file from a sequential reader.
+
+    The pixels are decompressed straight into an array sized from the header.
+    The data of the HDUs before it are skipped without being kept.
+
+    Args:
+        reader (Bz2StreamReader): the decompressed FITS file.
+        hdu (int, str or None): which HDU, as in `match_hdu`.
+    """
+    for index in itertools.count():
+        try:
+            header, header_bytes = reader.read_header()
+        except EOFError:
+            raise HDUNotFoundError(_describe_missing_hdu(hdu)) from None
+        data_size = get_data_size(header)
+        if not match_hdu(header, index, hdu):
+            reader.skip(data_size)
+        elif is_image_hdu(header):
+            raw = np.empty(get_image_shape(header), dtype=BITPIX_DTYPES[header['BITPIX']])
+            if reader.readinto(raw) != raw.nbytes:
+                raise EOFError('Unexpected end of bz2 stream')
+            return scale_image_data(raw, header)
+        else:
+            return decode_compressed_hdu(header_bytes, reader.read(data_size))
+
+
+def supports_partial_reads(key):
+    """Whether a window of the image in `key` can be read without decoding it all."""
+    return not key.endswith('.bz2')
+
+
+def load_image_from_s3(client, bucket, key, window=None, hdu=None, prefix=b''):
+    """Decode an image HDU of a FITS file stored in s3.
+
+    Args:
+        client: boto3 s3 client
+        bucket (str): s3 bucket name
+        key (str): s3 object key. Keys ending in '.bz2' are streamed and
+            decompressed; anything else is read with ranged requests.
+        window (callable): optional function that takes the image shape and
+            returns the (ystart, yend, xstart, xend) pixel bounds to read.
+            bz2 files are decoded in full and then cropped.
+        hdu (int, str or None): which HDU, as in `match_hdu`. Defaults to the
+            first HDU with image data.
+        prefix (bytes): optional bytes already fetched from the start of the
+            object, as in `S3RangeReader`. Not used for bz2 files.
+
+    Returns:
+        numpy array of pixel values in native byte order.
+
+    Raises:
+        HDUNotFoundError: if there is no such HDU.
+    """
+    if not supports_partial_reads(key):
+        body = client.get_object(Bucket=bucket, Key=key)['Body']
+        data = load_from_stream(Bz2StreamReader(body), hdu)
+        return data if window is None else crop(data, window(data.shape))
+    return load_from_range_reader(S3RangeReader(client, bucket, key, prefix), window, hdu)
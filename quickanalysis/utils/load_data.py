@@ -1,30 +1,780 @@
+import json
+import logging
+import threading
+from urllib.error import HTTPError
+
 import boto3
 import numpy as np
 from astropy.io import fits
-from cachetools import cached, TTLCache
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from cachetools import TTLCache
 
 from quickanalysis import settings
+from quickanalysis.analysis.histogram import build_full_histogram
+from quickanalysis.analysis.preview import encode_preview
+from quickanalysis.analysis.preview import get_stretch_parameters
+from quickanalysis.analysis.preview import render_preview
+from quickanalysis.analysis.pyramid import build_pyramid
+from quickanalysis.analysis.region_index import APPROXIMATE_STATS
+from quickanalysis.analysis.region_index import INDEXED_STATS
+from quickanalysis.analysis.region_index import ORDER_INDEXED_STATS
+from quickanalysis.analysis.region_index import build_histogram_index
+from quickanalysis.analysis.region_index import build_region_index
+from quickanalysis.analysis.region_index import get_approximate_order_stats
+from quickanalysis.analysis.region_index import get_indexed_order_stats
+from quickanalysis.analysis.region_index import get_indexed_stats
+from quickanalysis.analysis.region_index import supports_region_index
+from quickanalysis.analysis.region_stats import ALL_STATS
+from quickanalysis.analysis.region_stats import compute_region_stats
+from quickanalysis.analysis.region_stats import get_value_counts
+from quickanalysis.analysis.session import build_session_table
+from quickanalysis.utils import pools
+from quickanalysis.utils.cache import ImageCache
+from quickanalysis.utils.disk_cache import DiskArrayCache
+from quickanalysis.utils.fits_stream import HDUNotFoundError
+from quickanalysis.utils.fits_stream import HEADER_FETCH_SIZE
+from quickanalysis.utils.fits_stream import load_image_from_s3
+from quickanalysis.utils.fits_stream import supports_partial_reads
+from quickanalysis.utils.fits_stream import to_native_byteorder
+from quickanalysis.utils.metrics import add_bytes_fetched
+from quickanalysis.utils.metrics import span
+from quickanalysis.utils.prefetch import PrefetchQueue
+from quickanalysis.utils.single_flight import SingleFlight
 from quickanalysis.utils.useful import roundint
 
-s3 = boto3.client('s3', settings.AWS_REGION)
+logger = logging.getLogger(__name__)
+
+s3 = boto3.client('s3', settings.AWS_REGION, config=Config(
+    max_pool_connections=settings.S3_MAX_CONCURRENT_DOWNLOADS))
+
+# Bounds the downloads in flight, so a burst of requests for large frames
+# queues here instead of starving every request of bandwidth.
+download_slots = threading.BoundedSemaphore(settings.S3_MAX_CONCURRENT_DOWNLOADS)
+
+# Concurrent requests for an image that isn't cached share one metadata
+# lookup and one download. Their stats count how many loads were coalesced.
+metadata_lookups = SingleFlight()
+image_loads = SingleFlight()
 
 URL_EXPIRATION = 3600
-MAX_CACHE_SIZE = 1e8  # the max `sys.getsizeof(x)` size for the cache
+
+# Decoded image arrays, keyed by (s3_directory, full_filename, etag).
+# The disk cache is shared by all the workers on a machine; the memory cache
+# holds this worker's recently used (usually memory-mapped) arrays.
+image_cache = ImageCache(settings.IMAGE_CACHE_MAX_BYTES)
+disk_cache = DiskArrayCache(settings.DISK_CACHE_DIR, settings.DISK_CACHE_MAX_BYTES)
+
+# Data computed from cached images (eg. pyramids), keyed by image key + name
+derived_cache = ImageCache(settings.DERIVED_CACHE_MAX_BYTES)
+
+# s3 object metadata, keyed by (s3_directory, full_filename). Missing objects
+# are remembered for a shorter time, since new frames arrive continuously.
+metadata_cache = TTLCache(maxsize=4096, ttl=settings.METADATA_CACHE_TTL)
+missing_cache = TTLCache(maxsize=4096, ttl=settings.METADATA_MISSING_TTL)
+metadata_lock = threading.Lock()
+
+# The first bytes of objects whose metadata was just fetched, kept until the
+# image is loaded so that its primary header isn't requested twice.
+header_prefixes = TTLCache(maxsize=256, ttl=settings.METADATA_CACHE_TTL)
+
+# s3 error codes that mean the object doesn't exist
+NOT_FOUND_CODES = ('404', 'NoSuchKey', 'NotFound')
+
+# Objects listed under a prefix that are analyzed as images
+FITS_EXTENSIONS = ('.fits', '.fit', '.fts', '.fits.fz', '.fits.bz2')
+
+
+class ImageNotFoundError(Exception):
+    """ Raised when the requested image does not exist in s3. """
+
+    def __init__(self, full_filename, s3_directory):
+        super().__init__(f"Image does not exist: {s3_directory}/{full_filename}.")
+        self.full_filename = full_filename
+        self.s3_directory = s3_directory
+
+
+class ImageSelectionError(Exception):
+    """ Raised when the requested HDU or plane of an image doesn't exist. """
+
+
+def is_not_found_error(error):
+    """ Whether an exception from s3 (or from a presigned url) means the object is missing. """
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code') in NOT_FOUND_CODES
+    return isinstance(error, HTTPError) and error.code == 404
+
 
 def check_if_s3_image_exists(full_filename, s3_directory):
+    """ Whether an image exists in s3.
+
+    Only a not found response from s3 means the image is missing (and is
+    remembered as such, see `get_image_metadata`). Any other error, such as
+    missing credentials or a network failure, is raised rather than being
+    mistaken for a missing image, and nothing is cached for it.
+    """
     try:
-        s3.head_object(
-            Bucket=settings.S3_BUCKET,
-            Key=f'{s3_directory}/{full_filename}'
-        )
-    except Exception as e:
+        get_image_metadata(full_filename, s3_directory)
+    except ImageNotFoundError:
         return False
     return True
 
 
-#@cached(cache=TTLCache(maxsize=1024, ttl=URL_EXPIRATION))
-def get_image_data(full_filename, s3_directory):
-    print('FULL FILENAME: ',full_filename)
+def get_image_metadata(full_filename, s3_directory):
+    """ Return the metadata of an image in s3, from a short lived cache.
+
+    Repeated calls for the same image within METADATA_CACHE_TTL seconds don't
+    make another request to s3.
+
+    Returns:
+        dict: 'size' (bytes), 'etag' and 'last_modified' of the object.
+
+    Raises:
+        ImageNotFoundError: if the object doesn't exist.
+    """
+    key = (s3_directory, full_filename)
+    with metadata_lock:
+        metadata = metadata_cache.get(key)
+        missing = key in missing_cache
+    if metadata is not None:
+        return metadata
+    if missing:
+        raise ImageNotFoundError(full_filename, s3_directory)
+    return metadata_lookups.do(key, lambda: fetch_image_metadata(full_filename, s3_directory))
+
+
+def fetch_image_metadata(full_filename, s3_directory):
+    """ Fetch the metadata of an image in s3 and cache it (see `get_image_metadata`).
+
+    Rather than a HEAD, this is a ranged GET of the start of the object: it
+    takes the same round trip, and the bytes (which hold the primary header)
+    are kept in `header_prefixes` for the first load of the image.
+    """
+    key = (s3_directory, full_filename)
+    try:
+        with span('exists_check'):
+            response = s3.get_object(
+                Bucket=settings.S3_BUCKET,
+                Key=f'{s3_directory}/{full_filename}',
+                Range=f'bytes=0-{HEADER_FETCH_SIZE - 1}',
+            )
+            prefix = response['Body'].read()
+    except ClientError as e:
+        if not is_not_found_error(e):
+            raise
+        with metadata_lock:
+            missing_cache[key] = True
+        raise ImageNotFoundError(full_filename, s3_directory) from e
+
+    add_bytes_fetched(len(prefix))
+    metadata = {
+        'size': int(response['ContentRange'].rpartition('/')[2]),  # 'bytes 0-11519/<size>'
+        'etag': response['ETag'],
+        'last_modified': response['LastModified'],
+    }
+    with metadata_lock:
+        metadata_cache[key] = metadata
+        if supports_partial_reads(full_filename):
+            header_prefixes[key] = prefix
+    return metadata
+
+
+def forget_image_metadata(full_filename, s3_directory):
+    """ Drop any cached metadata for an image, so the next lookup asks s3. """
+    key = (s3_directory, full_filename)
+    with metadata_lock:
+        metadata_cache.pop(key, None)
+        missing_cache.pop(key, None)
+        header_prefixes.pop(key, None)
+
+
+def get_image_etag(full_filename, s3_directory):
+    """ Return the ETag of an image in s3. Raises ImageNotFoundError if the object is missing. """
+    return get_image_metadata(full_filename, s3_directory)['etag']
+
+
+def get_image_key(full_filename, s3_directory, hdu=None, plane=None):
+    """ Return the key identifying an image in the caches.
+
+    The image caches hold whole decoded HDUs, under `get_hdu_key(image_key)`,
+    while analyses are cached under the whole key.
+
+    Returns:
+        tuple: (s3_directory, full_filename, etag, hdu, plane)
+    """
+    if isinstance(hdu, str):
+        hdu = hdu.upper()  # EXTNAME matching is case insensitive
+    return (s3_directory, full_filename, get_image_etag(full_filename, s3_directory), hdu, plane)
+
+
+def get_hdu_key(image_key):
+    """ Return the part of an image key identifying the decoded HDU in the image caches. """
+    return image_key[:4]
+
+
+def get_image_data(full_filename, s3_directory, subregion=None, hdu=None, plane=None):
+    """ Return the decoded pixel data for an image in s3.
+
+    Decoded arrays are kept in `image_cache` and `disk_cache`. The object's
+    ETag is part of the cache key, so an image that is overwritten in s3 is
+    downloaded again.
+
+    Args:
+        full_filename (str): Photon Ranch filename in S3, including the extension.
+        s3_directory (str): The 'folder' that the image resides in s3.
+        subregion (dict): Optional rectangle to return instead of the full
+            image, with 'x0', 'x1', 'y0', 'y1' in [0, 1] (see `get_subregion_rect`).
+            If the full image isn't cached, only the rows or tiles covering the
+            rectangle are fetched and decoded. bz2 files and data cubes can't be
+            read partially, so they are loaded (and cached) in full.
+        hdu (int or str): Optional HDU to read, by index in the file (0 is the
+            primary HDU) or by EXTNAME. Defaults to the first HDU with image data.
+            Only this HDU is decoded and cached, so the other extensions of a
+            multi-extension file are never decoded.
+        plane (int): Optional 2d frame to select from a data cube, counting
+            across all the axes but the last two. Required if the HDU has more
+            than one frame.
+
+    Returns:
+        read-only 2d numpy array of pixel values. The same array is shared by
+        every request for the image, including concurrent ones.
+
+    Raises:
+        ImageNotFoundError: if the image doesn't exist in s3.
+        ImageSelectionError: if the HDU or plane doesn't exist.
+    """
+    logger.debug('Getting image data for %s/%s', s3_directory, full_filename)
+    return get_image_data_for_key(get_image_key(full_filename, s3_directory, hdu, plane), subregion)
+
+
+def get_image_data_for_key(image_key, subregion=None):
+    """ Same as `get_image_data`, for an image key from `get_image_key`. """
+    s3_directory, full_filename, _, hdu, plane = image_key
+    image_data = get_cached_image_data(image_key)
+    if image_data is None:
+        hdu_key = get_hdu_key(image_key)
+        if subregion is not None and supports_partial_reads(full_filename):
+            region = download_image_data(full_filename, s3_directory, subregion=subregion, hdu=hdu)
+            if region.ndim == 2:
+                return get_image_plane(region, plane)
+            # Cubes are read in full, so they are worth keeping
+            image_data = get_image_plane(cache_image_data(hdu_key, region), plane)
+        else:
+            image_data = get_image_plane(image_loads.do(hdu_key, lambda: load_image_data(hdu_key)), plane)
+
+    if subregion is not None:
+        image_data = get_subregion_rect(
+            image_data, subregion['x0'], subregion['x1'], subregion['y0'], subregion['y1'])
+    return image_data
+
+
+def get_cached_image_data(image_key):
+    """ Return the full frame of an image if the memory or disk cache holds it, else None.
+
+    Unlike `get_image_data_for_key`, this never downloads the image.
+    """
+    hdu_key = get_hdu_key(image_key)
+    image_data = image_cache.get(hdu_key)
+    if image_data is None:
+        image_data = disk_cache.get(hdu_key)
+        if image_data is None:
+            return None
+        image_cache.put(hdu_key, image_data)
+    return get_image_plane(image_data, image_key[4])
+
+
+def get_image_plane(image_data, plane=None):
+    """ Select a 2d frame from the data of an HDU, without copying it.
+
+    Args:
+        image_data (numpy array): the decoded HDU, with two or more dimensions.
+        plane (int): index of the frame, counting across all the axes but the
+            last two. Can be omitted (or 0) if the HDU holds a single frame.
+
+    Raises:
+        ImageSelectionError: if there is no such frame, or none was chosen from several.
+    """
+    if image_data.ndim < 2:
+        raise ImageSelectionError(f"The HDU is not an image: its data has shape {image_data.shape}.")
+    if image_data.ndim == 2 and not plane:
+        return image_data
+    frames = image_data.reshape((-1,) + image_data.shape[-2:])
+    if plane is None:
+        if len(frames) > 1:
+            raise ImageSelectionError(
+                f"The image is a cube of {len(frames)} planes: select one with 'plane'.")
+        plane = 0
+    if not 0 <= plane < len(frames):
+        raise ImageSelectionError(f"Plane {plane} is out of range: the image has {len(frames)} planes.")
+    return frames[plane]
+
+
+def load_image_data(hdu_key):
+    """ Download an HDU of an image and add it to the caches. Returns the cached array. """
+    # Another caller may have finished loading it since we last looked
+    image_data = image_cache.get(hdu_key)
+    if image_data is not None:
+        return image_data
+
+    s3_directory, full_filename, _, hdu = hdu_key
+    return cache_image_data(hdu_key, download_image_data(full_filename, s3_directory, hdu=hdu))
+
+
+def cache_image_data(hdu_key, image_data):
+    """ Add a decoded HDU to the memory and disk caches. Returns the cached array. """
+    # Prefer the memory-mapped copy, so the decoded pages are shared with other workers
+    cached_copy = disk_cache.put(hdu_key, image_data)
+    if cached_copy is not None:
+        image_data = cached_copy
+    image_cache.put(hdu_key, image_data)
+    return image_data
+
+
+def get_load_stats():
+    """ Return the counters of the image caches and of the coalesced loads, by name. """
+    return {
+        "image_cache": image_cache.stats(),
+        "disk_cache": disk_cache.stats(),
+        "derived_cache": derived_cache.stats(),
+        "metadata_lookups": metadata_lookups.stats(),
+        "image_loads": image_loads.stats(),
+        "prefetch": prefetch_queue.stats(),
+    }
+
+
+def get_derived_data(image_key, name, build):
+    """ Return data derived from an image, computing it on first use.
+
+    The result is kept in `derived_cache` under the image's key, so it is
+    recomputed if the image changes in s3.
+
+    Args:
+        image_key (tuple): the image's key, from `get_image_key`.
+        name (str): what is derived from the image, eg. 'pyramid'.
+        build (callable): computes the data when it isn't cached.
+    """
+    key = image_key + (name,)
+    value = derived_cache.get(key)
+    if value is None:
+        value = build()
+        derived_cache.put(key, value)
+    return value
+
+
+def get_image_pyramid(full_filename, s3_directory, hdu=None, plane=None):
+    """ Return the multi-resolution pyramid of an image (see `build_pyramid`).
+
+    The downsampled levels are cached alongside the image, so analyses that
+    can work from an approximate, lower resolution version of the image only
+    pay for building it once.
+
+    Returns:
+        list of 2d numpy arrays: level i is downsampled by a factor of 2**i,
+            and level 0 is the full resolution image.
+    """
+    image_key = get_image_key(full_filename, s3_directory, hdu, plane)
+    image_data = get_image_data_for_key(image_key)
+    levels = get_derived_data(image_key, 'pyramid', lambda: build_pyramid(image_data)[1:])
+    return [image_data] + levels
+
+
+def get_region_key(subregion):
+    """ Hashable version of a subregion dict, used to share work between operations. """
+    if subregion is None:
+        return None
+    return tuple(sorted(subregion.items()))
+
+
+def get_image_value_counts(full_filename, s3_directory, subregion=None, region_data=None, hdu=None, plane=None):
+    """ Return `get_value_counts` of an image or subregion, cached with the image.
+
+    Args:
+        region_data (numpy array): optional pixels of the image or subregion,
+            if the caller already has them.
+    """
+    if subregion is None:
+        return get_image_summary(full_filename, s3_directory, hdu, plane)['value_counts']
+    image_key = get_image_key(full_filename, s3_directory, hdu, plane)
+    if region_data is None:
+        return _get_region_value_counts(image_key, subregion, lambda: get_image_data_for_key(image_key, subregion))
+    return _get_region_value_counts(image_key, subregion, lambda: region_data)
+
+
+def _get_region_value_counts(image_key, subregion, get_region):
+    return get_derived_data(
+        image_key, ('value_counts', get_region_key(subregion)), lambda: get_value_counts(get_region()))
+
+
+def get_image_stats(full_filename, s3_directory, subregion=None, which=ALL_STATS, hdu=None, plane=None):
+    """ Return `compute_region_stats` of an image or subregion, cached with the image.
+
+    Once the full frame of an 8 or 16 bit image is cached, its subregions
+    are answered from the image's tiled indexes, built once per cached image:
+    mean, std, min and max from the region index (see `build_region_index`)
+    in time proportional to the subregion's perimeter, and median, mode and
+    MAD from the histogram index (see `build_histogram_index`), which only
+    reads the pixels in the coarse bins the answers fall in. This keeps the
+    stats of a selection box that the user is dragging fast.
+
+    Until then, only the subregion is read (see `get_image_data`), so the
+    first query of a new image doesn't wait for the whole frame.
+    """
+    which = tuple(which)
+    if subregion is None:
+        stats = get_image_summary(full_filename, s3_directory, hdu, plane)['stats']
+        return {name: stats[name] for name in which}
+    image_key = get_image_key(full_filename, s3_directory, hdu, plane)
+
+    image_data = get_cached_image_data(image_key)
+    if image_data is not None and supports_region_index(image_data):
+        bounds = get_subregion_bounds(
+            image_data.shape, subregion['x0'], subregion['x1'], subregion['y0'], subregion['y1'])
+        stats = {}
+        simple = [name for name in which if name in INDEXED_STATS]
+        if simple:
+            index = get_derived_data(image_key, 'region_index', lambda: build_region_index(image_data))
+            stats.update(get_indexed_stats(index, image_data, *bounds, which=simple))
+        order = [name for name in which if name in ORDER_INDEXED_STATS]
+        if order:
+            index = _get_histogram_index(image_key, image_data)
+            stats.update(get_indexed_order_stats(index, image_data, *bounds, which=order))
+        return {name: stats[name] for name in which}
+
+    def build():
+        region = get_image_data_for_key(image_key, subregion)
+        value_counts = _get_region_value_counts(image_key, subregion, lambda: region)
+        return compute_region_stats(region, which=which, value_counts=value_counts)
+
+    return get_derived_data(image_key, ('stats', get_region_key(subregion), which), build)
+
+
+def get_approximate_stats(full_filename, s3_directory, subregion=None, which=INDEXED_STATS + APPROXIMATE_STATS,
+                          hdu=None, plane=None):
+    """ Return stats like `get_image_stats`, estimating the median of a subregion.
+
+    Once the full frame of an 8 or 16 bit image is cached, the median of a
+    subregion is interpolated from the coarse histogram of the histogram
+    index, without reading any pixels besides the strips along its edges.
+    Until then the index isn't built (it is as large as the image, and needs
+    the full frame summary), and the exact stats of the subregion are
+    returned instead, from a read of only the subregion. Everything else is
+    exact.
+
+    Args:
+        which (iterable of str): statistics to compute, from INDEXED_STATS and APPROXIMATE_STATS.
+
+    Returns:
+        (dict, dict): the statistics, and for each one a bound on its absolute error.
+    """
+    which = tuple(which)
+    unknown = set(which) - set(INDEXED_STATS + APPROXIMATE_STATS)
+    if unknown:
+        raise ValueError(f"Statistics cannot be estimated: {sorted(unknown)}")
+    estimated = [name for name in which if name in APPROXIMATE_STATS]
+    exact = [name for name in which if name not in APPROXIMATE_STATS]
+
+    image_data = None
+    if subregion is not None and estimated:
+        image_key = get_image_key(full_filename, s3_directory, hdu, plane)
+        image_data = get_cached_image_data(image_key)
+    if image_data is None or not supports_region_index(image_data):
+        stats = get_image_stats(full_filename, s3_directory, subregion, which, hdu, plane)
+        return stats, {name: 0 for name in which}
+
+    bounds = get_subregion_bounds(
+        image_data.shape, subregion['x0'], subregion['x1'], subregion['y0'], subregion['y1'])
+    index = _get_histogram_index(image_key, image_data)
+    stats, errors = get_approximate_order_stats(index, image_data, *bounds, which=estimated)
+    stats.update(get_image_stats(full_filename, s3_directory, subregion, exact, hdu, plane))
+    errors.update({name: 0 for name in exact})
+    return {name: stats[name] for name in which}, {name: errors[name] for name in which}
+
+
+def _get_histogram_index(image_key, image_data):
+    def build():
+        value_counts = _get_image_summary(image_key)['value_counts']
+        return build_histogram_index(image_data, value_counts)
+    return get_derived_data(image_key, 'histogram_index', build)
+
+
+def get_image_histogram(full_filename, s3_directory, subregion=None, hdu=None, plane=None):
+    """ Return the full resolution histogram of an image or subregion (see `build_full_histogram`).
+
+    It is computed on the first request and cached with the image, so the
+    windows requested while zooming and panning the histogram in the UI are
+    rebinned from it without another pass over the pixels.
+    """
+    if subregion is None:
+        return get_image_summary(full_filename, s3_directory, hdu, plane)['histogram']
+    image_key = get_image_key(full_filename, s3_directory, hdu, plane)
+
+    def build():
+        region = get_image_data_for_key(image_key, subregion)
+        value_counts = _get_region_value_counts(image_key, subregion, lambda: region)
+        return build_full_histogram(region, value_counts=value_counts)
+
+    return get_derived_data(image_key, ('histogram', get_region_key(subregion)), build)
+
+
+def get_image_preview(full_filename, s3_directory, size, stretch='auto', image_format='png', line=None,
+                      hdu=None, plane=None):
+    """ Return a stretched preview of an image, encoded as PNG or WebP (see `analysis.preview`).
+
+    The stretch comes from the image's cached full frame statistics, and the
+    8-bit preview of each size and stretch is rendered once from the image's
+    pyramid and cached. The encoded images are cached too, by size, stretch,
+    format and line, so moving the line only draws it over the cached preview
+    and encodes the result.
+
+    Args:
+        size (int): pixels along the longest side of the preview.
+        stretch (str): one of `preview.STRETCHES`.
+        image_format (str): one of `preview.FORMATS`.
+        line (tuple of float): optional (x0, y0, x1, y1) line to draw, relative
+            to the image dimensions.
+
+    Returns:
+        bytes: the encoded preview.
+    """
+    image_key = get_image_key(full_filename, s3_directory, hdu, plane)
+
+    def build_preview():
+        parameters = get_stretch_parameters(_get_image_summary(image_key)['stats'], stretch)
+        pyramid = get_image_pyramid(full_filename, s3_directory, hdu, plane)
+        return render_preview(pyramid, parameters, size)
+
+    def build_encoded():
+        preview = get_derived_data(image_key, ('preview', size, stretch), build_preview)
+        with span('serialize'):
+            return encode_preview(preview, image_format, line)
+
+    line = None if line is None else tuple(line)
+    return get_derived_data(image_key, ('preview_image', size, stretch, image_format, line), build_encoded)
+
+
+def get_image_summary(full_filename, s3_directory, hdu=None, plane=None):
+    """ Return the full frame analyses of an image, computed once per image.
+
+    The summary is kept in memory with the image, and persisted as a sidecar
+    file in the disk cache, so repeated full frame requests (even after a
+    restart) don't touch the pixels again.
+
+    Returns:
+        dict: 'stats' (every statistic in ALL_STATS), 'value_counts' (as
+            `get_value_counts`, trimmed to the values present, or None for
+            float data) and 'histogram' (see `build_full_histogram`).
+    """
+    return _get_image_summary(get_image_key(full_filename, s3_directory, hdu, plane))
+
+
+def _get_image_summary(image_key):
+    def build():
+        sidecar = disk_cache.get_sidecar(image_key)
+        if sidecar is not None:
+            return unpack_summary(sidecar)
+        summary = build_summary(get_image_data_for_key(image_key))
+        disk_cache.put_sidecar(image_key, pack_summary(summary))
+        return summary
+
+    return get_derived_data(image_key, 'summary', build)
+
+
+def build_summary(image_data):
+    """ Compute the full frame analyses returned by `get_image_summary`. """
+    value_counts = get_value_counts(image_data)
+    if value_counts is not None:
+        low_val, counts = value_counts
+        nonzero = np.flatnonzero(counts)
+        value_counts = (low_val + int(nonzero[0]), counts[nonzero[0]:nonzero[-1] + 1])
+    return {
+        'stats': compute_region_stats(image_data, value_counts=value_counts),
+        'value_counts': value_counts,
+        'histogram': build_full_histogram(image_data, value_counts=value_counts),
+    }
+
+
+def pack_summary(summary):
+    """ Convert a summary to a dict of arrays, for `DiskArrayCache.put_sidecar`. """
+    histogram = dict(summary['histogram'])
+    arrays = {'histogram_cumulative': histogram.pop('cumulative')}
+    meta = {'stats': summary['stats'], 'histogram': histogram}
+    arrays['meta'] = np.array(json.dumps(meta, default=lambda value: value.item()))  # numpy scalars
+    if summary['value_counts'] is not None:
+        arrays['value_counts_low'] = np.array(summary['value_counts'][0])
+        arrays['value_counts'] = summary['value_counts'][1]
+    return arrays
+
+
+def unpack_summary(arrays):
+    """ Inverse of `pack_summary`. """
+    meta = json.loads(str(arrays['meta']))
+    value_counts = None
+    if 'value_counts' in arrays:
+        value_counts = (int(arrays['value_counts_low']), arrays['value_counts'])
+    return {
+        'stats': meta['stats'],
+        'value_counts': value_counts,
+        'histogram': dict(meta['histogram'], cumulative=arrays['histogram_cumulative']),
+    }
+
+
+def list_images(s3_directory, prefix=''):
+    """ Return the FITS images in an s3 directory whose filename starts with `prefix`.
+
+    The metadata of every listed image is cached (see `get_image_metadata`),
+    so analyzing them doesn't look each one up again.
+
+    Returns:
+        list of str: the filenames, in key order.
+    """
+    kwargs = {'Bucket': settings.S3_BUCKET, 'Prefix': f'{s3_directory}/{prefix}'}
+    filenames = []
+    with span('exists_check'):
+        while True:
+            response = s3.list_objects_v2(**kwargs)
+            for obj in response.get('Contents', []):
+                full_filename = obj['Key'][len(s3_directory) + 1:]
+                if not full_filename.endswith(FITS_EXTENSIONS):
+                    continue
+                metadata = {'size': obj['Size'], 'etag': obj['ETag'], 'last_modified': obj['LastModified']}
+                with metadata_lock:
+                    metadata_cache[(s3_directory, full_filename)] = metadata
+                    missing_cache.pop((s3_directory, full_filename), None)
+                filenames.append(full_filename)
+            if not response.get('IsTruncated'):
+                return filenames
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+def get_session_statistics(s3_directory, full_filenames=None, prefix=None, which=ALL_STATS, histogram_bins=None,
+                           lo=None, hi=None, hdu=None, plane=None):
+    """ Return the statistics and histograms of the frames of a session, as columns.
+
+    The frames are loaded and summarized on `pools.session_pool`, several at
+    once. Their summaries are the cached full frame analyses of
+    `get_image_summary`, so when a session is polled as new frames arrive,
+    only the new frames are downloaded and processed.
+
+    Args:
+        s3_directory (str): the 'folder' the frames reside in.
+        full_filenames (list of str): the frames, in order.
+        prefix (str): instead of `full_filenames`, the start of the filenames
+            of the frames (see `list_images`). Only the last SESSION_MAX_FRAMES
+            of them are included.
+        which, histogram_bins, lo, hi: as in `analysis.session.build_session_table`.
+
+    Returns:
+        dict: 'frames' (the filenames of the rows), 'stats' and optionally
+            'histograms' (see `build_session_table`), and 'errors', the
+            message for each frame that is missing or has no such HDU or plane.
+    """
+    if full_filenames is None:
+        full_filenames = list_images(s3_directory, prefix or '')[-settings.SESSION_MAX_FRAMES:]
+    futures = [pools.submit(pools.session_pool, get_image_summary, full_filename, s3_directory, hdu, plane)
+               for full_filename in full_filenames]
+
+    frames, summaries, errors = [], [], {}
+    for full_filename, future in zip(full_filenames, futures):
+        try:
+            summaries.append(future.result())
+        except (ImageNotFoundError, ImageSelectionError) as e:
+            errors[full_filename] = str(e)
+            continue
+        frames.append(full_filename)
+    table = build_session_table(summaries, which, histogram_bins, lo, hi)
+    return dict(table, frames=frames, errors=errors)
+
+
+def prefetch_images(images):
+    """ Load images into the caches in the background, before anyone asks for them.
+
+    Each image is downloaded and decoded, and its full frame stats, value
+    counts and histogram are computed, so the first analysis request for it
+    is a cache hit. Images are processed newest first: later entries of
+    `images`, and later calls, go ahead of earlier ones. At most
+    PREFETCH_QUEUE_SIZE images wait at once; beyond that the oldest are dropped.
+
+    Args:
+        images (iterable of (str, str)): (s3_directory, full_filename) pairs,
+            oldest first.
+    """
+    for s3_directory, full_filename in images:
+        prefetch_queue.put((s3_directory, full_filename))
+
+
+def warm_image(key):
+    """ Load an image and its full frame analyses into the caches (see `prefetch_images`). """
+    s3_directory, full_filename = key
+    get_image_stats(full_filename, s3_directory)
+    get_image_histogram(full_filename, s3_directory)
+
+
+prefetch_queue = PrefetchQueue(warm_image, settings.PREFETCH_QUEUE_SIZE, settings.PREFETCH_WORKERS)
+
+
+def download_image_data(full_filename, s3_directory, loader=None, subregion=None, hdu=None):
+    """ Download and decode an image from s3, bypassing the cache.
+
+    Args:
+        full_filename (str): Photon Ranch filename in S3, including the extension.
+        s3_directory (str): The 'folder' that the image resides in s3.
+        loader (str): 'url' or 'stream'. Defaults to `settings.IMAGE_LOADER`.
+        subregion (dict): Optional rectangle to read, as in `get_image_data`.
+            This always uses the 'stream' loader, which can fetch byte ranges.
+            Only 2d images are read partially: for a data cube the whole HDU
+            is returned, so that it can be cached.
+        hdu (int or str): Optional HDU to read, as in `get_image_data`.
+
+    Returns:
+        read-only numpy array of pixel values of the whole HDU (which may be a
+        cube), in native byte order. Whatever the loader, the pixels are
+        decoded into one array and byte swapped in place, so it is never copied
+        and analyses never need to swap or copy it again.
+
+    Raises:
+        ImageNotFoundError: if the image doesn't exist in s3.
+        ImageSelectionError: if the HDU doesn't exist or has no image data.
+    """
+    try:
+        with download_slots, span('decode'):
+            image_data = to_native_byteorder(_download_image_data(full_filename, s3_directory, loader, subregion, hdu))
+    except HDUNotFoundError as e:
+        raise ImageSelectionError(f"{s3_directory}/{full_filename}: {e}") from e
+    except (ClientError, HTTPError) as e:
+        if not is_not_found_error(e):
+            raise
+        # The object was deleted since its metadata was cached
+        forget_image_metadata(full_filename, s3_directory)
+        raise ImageNotFoundError(full_filename, s3_directory) from e
+    image_data.setflags(write=False)
+    return image_data
+
+
+def pop_header_prefix(full_filename, s3_directory):
+    """ Return (and forget) the first bytes of an image kept by `fetch_image_metadata`, or b''. """
+    with metadata_lock:
+        return header_prefixes.pop((s3_directory, full_filename), b'')
+
+
+def _download_image_data(full_filename, s3_directory, loader, subregion, hdu):
+    if subregion is not None:
+        def window(shape):
+            if len(shape) != 2:
+                return None  # read the whole cube
+            return get_subregion_bounds(
+                shape[-2:], subregion['x0'], subregion['x1'], subregion['y0'], subregion['y1'])
+        return load_image_from_s3(
+            s3, settings.S3_BUCKET, f'{s3_directory}/{full_filename}', window=window, hdu=hdu,
+            prefix=pop_header_prefix(full_filename, s3_directory))
+
+    loader = loader or settings.IMAGE_LOADER
+    if loader == 'stream':
+        return load_image_from_s3(
+            s3, settings.S3_BUCKET, f'{s3_directory}/{full_filename}', hdu=hdu,
+            prefix=pop_header_prefix(full_filename, s3_directory))
+    if loader != 'url':
+        raise ValueError(f"Unknown image loader: {loader}")
+
     params = {
         'Bucket': settings.S3_BUCKET,
         'Key': f'{s3_directory}/{full_filename}'
@@ -34,7 +784,37 @@ def get_image_data(full_filename, s3_directory):
         Params=params,
         ExpiresIn=URL_EXPIRATION
     )
-    return fits.getdata(url)
+    selector = {}
+    if hdu is not None:
+        selector = {'extname': hdu} if isinstance(hdu, str) else {'ext': hdu}
+    # astropy downloads and decodes together, so all of it counts as fetching
+    try:
+        with span('fetch'):
+            image_data = fits.getdata(url, **selector)
+    except (KeyError, IndexError) as e:
+        raise HDUNotFoundError(f"No HDU {hdu!r} in the file") from e
+    add_bytes_fetched(get_image_metadata(full_filename, s3_directory)['size'])
+    return image_data
+
+
+def get_subregion_bounds(shape, x0, x1, y0, y1):
+    """ Convert a rectangle in relative coordinates to pixel bounds.
+
+    Args:
+        shape (tuple[int]): the (rows, columns) shape of the image.
+        x0, x1, y0, y1 (float in [0,1]): corners of the region, as in `get_subregion_rect`.
+
+    Returns:
+        tuple[int]: ystart, yend, xstart, xend for slicing the image array.
+    """
+    ylen, xlen = shape
+
+    # Scale the subregion coordinates by the image dimensions
+    ystart = int(np.rint(min(y0, y1) * ylen))
+    yend =   int(np.rint(max(y0, y1) * ylen))
+    xstart = int(np.rint(min(x0, x1) * xlen))
+    xend =   int(np.rint(max(x0, x1) * xlen))
+    return ystart, yend, xstart, xend
 
 
 def get_subregion_rect(image_array, x0, x1, y0, y1):
@@ -49,15 +829,10 @@ def get_subregion_rect(image_array, x0, x1, y0, y1):
         y1 (float in [0,1]): y coordinate for the other corner of the region.
     
     Returns:
-        2-d numpy array of pixel values.
+        numpy array of pixel values. The selection is made in the last two
+        dimensions, so a cube gives a cube of the same rectangle in each plane.
     """
 
-    # Compute the full pixel dimensions
-    ylen, xlen = np.shape(image_array)
-
-    ystart = np.rint(min(y0, y1) * ylen).astype(int)
-    # Scale the subregion coordinates by the image dimensions
-    yend =   np.rint(max(y1, y1) * ylen).astype(int)
-    xstart = np.rint(min(x0, x1) * xlen).astype(int) 
-    xend =   np.rint(max(x0, x1) * xlen).astype(int)
-    return image_array[ystart:yend, xstart:xend]
+    with span('subregion'):
+        ystart, yend, xstart, xend = get_subregion_bounds(np.shape(image_array)[-2:], x0, x1, y0, y1)
+        return image_array[..., ystart:yend, xstart:xend]
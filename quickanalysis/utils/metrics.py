@@ -0,0 +1,334 @@
+"""Per-request timing of the stages of an analysis, and Prometheus metrics.
+
+Code marks the work it does with `span(stage)`, where stage is one of STAGES:
+
+    exists_check    looking up the image's metadata in s3
+    fetch           waiting for bytes from s3
+    decode          decompressing and decoding the FITS data
+    subregion       selecting a region of the image
+    compute         the analysis itself
+    serialize       encoding the response
+
+Spans nest, and each one only counts its own time: the time of the spans
+inside it (in the same thread) is subtracted. The app opens a 'compute' span
+around each request, so whatever the request spends outside the other stages
+counts as compute.
+
+The time of each span is added to the `stage_seconds` histogram, labelled
+with the route of the request it ran for ('background' outside of requests,
+eg. when prefetching). At the end of a request its total time in each stage
+is logged as one JSON record, at INFO level on the 'quickanalysis.utils.metrics'
+logger, and its duration is added to the `request_seconds` histogram.
+`render_metrics` formats all of this in the Prometheus text format.
+"""
+import contextvars
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+STAGES = ('exists_check', 'fetch', 'decode', 'subregion', 'compute', 'serialize')
+
+# Upper bounds (in seconds) of the histogram buckets
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Route label of the work done outside of a request
+BACKGROUND = 'background'
+
+# Counters from the load stats (see `render_load_stats`); the others are gauges
+COUNTER_STATS = ('hits', 'misses', 'evictions', 'calls', 'executions', 'coalesced', 'errors',
+                 'queued', 'dropped', 'completed', 'failed')
+
+logger = logging.getLogger(__name__)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A Prometheus counter, with one value per combination of labels.
+
+    Args:
+        name (str): metric name, ending in '_total'.
+        documentation (str): the HELP text.
+        label_names (tuple of str): names of the labels.
+    """
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        """Return the lines of the metric in the Prometheus text format."""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    """A Prometheus histogram, with one distribution per combination of labels.
+
+    Args:
+        name (str): metric name.
+        documentation (str): the HELP text.
+        label_names (tuple of str): names of the labels.
+        buckets (tuple of float): increasing upper bounds of the buckets.
+            A final +Inf bucket is always added.
+    """
+
+    def __init__(self, name, documentation, label_names=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._series = {}  # labels -> [bucket counts, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+
+    def count(self, labels=()):
+        """Return the number of values observed with `labels`."""
+        with self._lock:
+            series = self._series.get(labels)
+            return sum(series[0]) if series else 0
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        """Return the lines of the metric in the Prometheus text format."""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+        names = self.label_names + ('le',)
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                bucket_labels = _format_labels(names, labels + (_format_value(bound),))
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}')
+        return lines
+
+
+stage_seconds = Histogram(
+    'quickanalysis_stage_seconds', 'Time spent in each stage of handling a request.', ('route', 'stage'))
+request_seconds = Histogram(
+    'quickanalysis_request_seconds', 'Time to handle a request.', ('route', 'status'))
+bytes_fetched = Counter(
+    'quickanalysis_s3_bytes_fetched_total', 'Bytes of image data fetched from s3.', ('route',))
+
+
+class RequestTimer:
+    """The time a request spent in each stage so far.
+
+    Args:
+        route (str): the route label of the request.
+    """
+
+    def __init__(self, route):
+        self.route = route
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.bytes_fetched = 0
+        self.root = None
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_bytes(self, nbytes):
+        with self._lock:
+            self.bytes_fetched += nbytes
+
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+
+class _Span:
+    def __init__(self, stage):
+        self.stage = stage
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter()
+        self.children = 0.0  # time spent in nested spans of the same thread
+
+    def close(self, parent):
+        elapsed = time.perf_counter() - self.start
+        if parent is not None and parent.thread == self.thread:
+            parent.children += elapsed
+        record_stage(self.stage, elapsed - self.children)
+
+
+_current_request = contextvars.ContextVar('current_request', default=None)
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def get_route():
+    """Return the route label of the current request, or BACKGROUND."""
+    request = _current_request.get()
+    return request.route if request is not None else BACKGROUND
+
+
+def record_stage(stage, seconds):
+    """Add time spent in a stage to the current request and to `stage_seconds`."""
+    request = _current_request.get()
+    if request is not None:
+        request.add(stage, seconds)
+    stage_seconds.observe((get_route(), stage), seconds)
+
+
+def add_bytes_fetched(nbytes):
+    """Count bytes downloaded from s3 for the current request."""
+    request = _current_request.get()
+    if request is not None:
+        request.add_bytes(nbytes)
+    bytes_fetched.inc((get_route(),), nbytes)
+
+
+@contextmanager
+def span(stage):
+    """Time the enclosed block as part of `stage` (see the module docstring)."""
+    parent = _current_span.get()
+    current = _Span(stage)
+    token = _current_span.set(current)
+    try:
+        yield
+    finally:
+        _current_span.reset(token)
+        current.close(parent)
+
+
+def start_request(route):
+    """Start timing a request, in a 'compute' span that lasts until `finish_request`.
+
+    Returns:
+        RequestTimer
+    """
+    request = RequestTimer(route)
+    _current_request.set(request)
+    request.root = _Span('compute')
+    _current_span.set(request.root)
+    return request
+
+
+def finish_request(status):
+    """Stop timing the current request, record its duration and log its stages.
+
+    Does nothing if no request is being timed.
+
+    Args:
+        status (int): the response status code.
+    """
+    request = _current_request.get()
+    if request is None:
+        return
+    request.root.close(None)
+    _current_span.set(None)
+    _current_request.set(None)
+    duration = request.elapsed()
+    request_seconds.observe((request.route, str(status)), duration)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps({
+            'route': request.route,
+            'status': status,
+            'seconds': round(duration, 6),
+            'stages': {stage: round(seconds, 6) for stage, seconds in request.stages.items()},
+            'bytes_fetched': request.bytes_fetched,
+        }))
+
+
+def render_load_stats(load_stats):
+    """Format the counters of `load_data.get_load_stats` as Prometheus metrics.
+
+    The caches (the groups whose name ends in 'cache') share metrics labelled
+    by cache name, and also report their hit ratio. Every other group gets its
+    own metrics.
+
+    Returns:
+        list of str: lines in the Prometheus text format.
+    """
+    metrics = {}  # name -> (type, [(label names, label values, value)])
+    for group, stats in load_stats.items():
+        is_cache = group.endswith('cache')
+        prefix = 'quickanalysis_cache_' if is_cache else f'quickanalysis_{group}_'
+        label_names, labels = (('cache',), (group,)) if is_cache else ((), ())
+        values = dict(stats)
+        if is_cache and 'hits' in values:
+            lookups = values['hits'] + values['misses']
+            values['hit_ratio'] = values['hits'] / lookups if lookups else 0.0
+        for stat, value in values.items():
+            if stat in COUNTER_STATS:
+                name, kind = f'{prefix}{stat}_total', 'counter'
+            else:
+                name, kind = f'{prefix}{stat}', 'gauge'
+            metrics.setdefault(name, (kind, []))[1].append((label_names, labels, value))
+
+    lines = []
+    for name, (kind, samples) in sorted(metrics.items()):
+        lines.append(f'# TYPE {name} {kind}')
+        for label_names, labels, value in samples:
+            lines.append(f'{name}{_format_labels(label_names, labels)} {_format_value(value)}')
+    return lines
+
+
+def render_metrics(load_stats):
+    """Return every metric in the Prometheus text exposition format.
+
+    Args:
+        load_stats (dict): the result of `load_data.get_load_stats`.
+    """
+    lines = stage_seconds.render() + request_seconds.render() + bytes_fetched.render()
+    lines += render_load_stats(load_stats)
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """Forget every recorded value (used by the tests)."""
+    stage_seconds.clear()
+    request_seconds.clear()
+    bytes_fetched.clear()
@@ -0,0 +1,32 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from quickanalysis import settings
+
+# Shared by all requests in a worker process. Most numpy work releases the
+# GIL, so independent analyses of one image can run on several cores.
+# Tasks running on this pool must not wait on other tasks submitted to it.
+analysis_pool = ThreadPoolExecutor(settings.ANALYSIS_WORKERS, thread_name_prefix='analysis')
+
+# Reduces the bands of large frames in parallel (see `analysis.tiled`). It is
+# separate from `analysis_pool` so that analyses running there can wait on it.
+# With a single worker, the bands are reduced in the calling thread instead.
+stats_pool = None
+if settings.STATS_WORKERS > 1:
+    stats_pool = ThreadPoolExecutor(settings.STATS_WORKERS, thread_name_prefix='stats')
+
+# Loads and summarizes the frames of a session. Most of the time is spent
+# waiting for s3, so it has more threads than there are cores.
+session_pool = ThreadPoolExecutor(settings.SESSION_WORKERS, thread_name_prefix='session')
+
+
+def submit(pool, function, *args):
+    """Run `function(*args)` on `pool` in a copy of the caller's context.
+
+    The task sees the caller's context variables, so the time it spends in
+    each stage is counted for the caller's request (see `utils.metrics`).
+
+    Returns:
+        concurrent.futures.Future
+    """
+    return pool.submit(contextvars.copy_context().run, function, *args)
@@ -0,0 +1,112 @@
+import heapq
+import itertools
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class PrefetchQueue:
+    """Bounded queue of keys to process in the background, newest first.
+
+    Keys are handed to `run(key)` on daemon worker threads, started on first
+    use. The most recently queued key is always processed next, since the
+    newest frames are the ones users are about to open. Queuing a key that is
+    already waiting moves it to the front instead of adding it twice. When
+    the queue is full, the oldest waiting key is dropped to make room.
+
+    Args:
+        run (callable): called with each key. Exceptions are counted and
+            logged, and don't stop the worker.
+        max_size (int): the most keys waiting at once.
+        workers (int): threads processing keys.
+    """
+
+    def __init__(self, run, max_size, workers):
+        self.run = run
+        self.max_size = max_size
+        self.workers = workers
+        self.queued = 0
+        self.dropped = 0
+        self.completed = 0
+        self.failed = 0
+        self._heap = []  # (-sequence, key), so the newest key pops first
+        self._sequence = {}  # key -> sequence of its live heap entry
+        self._counter = itertools.count()
+        self._active = 0
+        self._threads = []
+        self._condition = threading.Condition()
+
+    def put(self, key):
+        """Queue `key` to be processed, ahead of everything already waiting."""
+        with self._condition:
+            sequence = next(self._counter)
+            if key not in self._sequence and len(self._sequence) >= self.max_size:
+                self._drop_oldest()
+            self._sequence[key] = sequence
+            heapq.heappush(self._heap, (-sequence, key))
+            self.queued += 1
+            self._start_workers()
+            self._condition.notify_all()
+
+    def _drop_oldest(self):
+        oldest = min(self._sequence, key=self._sequence.get)
+        del self._sequence[oldest]  # its heap entry is skipped when popped
+        self.dropped += 1
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name='prefetch', daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _next_key(self):
+        """Wait for and remove the newest live key. Called with the condition held."""
+        while True:
+            while not self._heap:
+                self._condition.wait()
+            negative_sequence, key = heapq.heappop(self._heap)
+            if self._sequence.get(key) == -negative_sequence:
+                del self._sequence[key]
+                return key
+
+    def _work(self):
+        while True:
+            with self._condition:
+                key = self._next_key()
+                self._active += 1
+            try:
+                self.run(key)
+                succeeded = True
+            except Exception:
+                logger.exception('prefetch of %s failed', key)
+                succeeded = False
+            with self._condition:
+                self._active -= 1
+                if succeeded:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                self._condition.notify_all()
+
+    def join(self, timeout=None):
+        """Wait until nothing is waiting or running. Returns False on timeout."""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._sequence and not self._active, timeout)
+
+    def __len__(self):
+        with self._condition:
+            return len(self._sequence)
+
+    def stats(self):
+        """Return the queue counters as a dict."""
+        with self._condition:
+            return {
+                "queued": self.queued,
+                "dropped": self.dropped,
+                "completed": self.completed,
+                "failed": self.failed,
+                "waiting": len(self._sequence),
+                "running": self._active,
+                "max_size": self.max_size,
+            }
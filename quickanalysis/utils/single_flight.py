@@ -0,0 +1,78 @@
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """Coalesce concurrent calls that compute the same thing.
+
+    The first caller for a key runs the function; callers that arrive while
+    it is running wait for it and get the same result (or exception) instead
+    of running it again. Once the call finishes the key is forgotten, so a
+    later call runs the function again (caching results is left to the caller).
+
+    Counters:
+        calls: every call to `do`.
+        executions: calls that ran the function themselves.
+        coalesced: calls that waited for another caller's result instead.
+        errors: executions that raised.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.executions = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def do(self, key, function):
+        """Return `function()`, sharing one call between concurrent callers for `key`."""
+        with self._lock:
+            self.calls += 1
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                self.executions += 1
+                future = Future()
+                self._calls[key] = future
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = function()
+        except BaseException as e:
+            with self._lock:
+                self.errors += 1
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._calls)
+
+    def reset_stats(self):
+        """Reset the counters to zero."""
+        with self._lock:
+            self.calls = 0
+            self.executions = 0
+            self.coalesced = 0
+            self.errors = 0
+
+    def stats(self):
+        """Return the counters as a dict, with the number of calls currently running."""
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "executions": self.executions,
+                "coalesced": self.coalesced,
+                "errors": self.errors,
+                "in_flight": len(self._calls),
+            }
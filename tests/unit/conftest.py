@@ -0,0 +1,169 @@
+import bz2
+import datetime
+import hashlib
+import io
+
+import pytest
+from astropy.io import fits
+from botocore.exceptions import ClientError
+
+from quickanalysis import settings
+from quickanalysis.utils import load_data
+from quickanalysis.utils.disk_cache import DiskArrayCache
+
+
+class FakeStreamingBody:
+    """Mimics the botocore StreamingBody returned by `get_object`.
+
+    Like the real one, the bytes are read from the file as they are consumed.
+    """
+
+    def __init__(self, path, start, length):
+        self._path = path
+        self._position = start
+        self._remaining = length
+
+    def read(self, amt=None):
+        amt = self._remaining if amt is None else min(amt, self._remaining)
+        with self._path.open('rb') as f:
+            f.seek(self._position)
+            data = f.read(amt)
+        self._position += len(data)
+        self._remaining -= len(data)
+        return data
+
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class FakeS3Client:
+    """Filesystem-backed stand in for the parts of the boto3 s3 client we use.
+
+    Every call is recorded in `requests` so tests can check how the object
+    was read (eg. that ranged GETs were used).
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.requests = []
+
+    def _path(self, Bucket, Key):
+        return self.root / Bucket / Key
+
+    def _missing(self, Key, operation, code):
+        return ClientError({'Error': {'Code': code, 'Message': f'Not Found: {Key}'}}, operation)
+
+    def put_object(self, Bucket, Key, Body):
+        path = self._path(Bucket, Key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(Body)
+
+    def head_object(self, Bucket, Key):
+        self.requests.append(('head_object', Key, None))
+        path = self._path(Bucket, Key)
+        if not path.is_file():
+            raise self._missing(Key, 'HeadObject', '404')
+        return {
+            'ContentLength': path.stat().st_size,
+            'ETag': self._etag(path),
+            'LastModified': datetime.datetime.fromtimestamp(path.stat().st_mtime, datetime.timezone.utc),
+        }
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.requests.append(('get_object', Key, Range))
+        path = self._path(Bucket, Key)
+        if not path.is_file():
+            raise self._missing(Key, 'GetObject', 'NoSuchKey')
+        size = path.stat().st_size
+        start, length = 0, size
+        if Range is not None:
+            start, end = Range[len('bytes='):].split('-')
+            start = int(start)
+            if start >= size:
+                raise ClientError({'Error': {'Code': 'InvalidRange', 'Message': 'Range Not Satisfiable'}}, 'GetObject')
+            length = min(int(end) + 1, size) - start
+        body = FakeStreamingBody(path, start, length)
+        return {
+            'Body': body,
+            'ContentLength': length,
+            'ContentRange': f'bytes {start}-{start + length - 1}/{size}',
+            'ETag': self._etag(path),
+            'LastModified': datetime.datetime.fromtimestamp(path.stat().st_mtime, datetime.timezone.utc),
+        }
+
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken=None, MaxKeys=1000):
+        self.requests.append(('list_objects_v2', Prefix, ContinuationToken))
+        bucket = self.root / Bucket
+        keys = sorted(str(path.relative_to(bucket)) for path in bucket.rglob('*') if path.is_file())
+        keys = [key for key in keys if key.startswith(Prefix)]
+        if ContinuationToken is not None:
+            keys = [key for key in keys if key > ContinuationToken]
+        response = {'IsTruncated': len(keys) > MaxKeys, 'Contents': []}
+        for key in keys[:MaxKeys]:
+            path = bucket / key
+            response['Contents'].append({
+                'Key': key,
+                'Size': path.stat().st_size,
+                'ETag': self._etag(path),
+                'LastModified': datetime.datetime.fromtimestamp(path.stat().st_mtime, datetime.timezone.utc),
+            })
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = keys[MaxKeys - 1]
+        return response
+
+    def _etag(self, path):
+        digest = hashlib.md5()
+        with path.open('rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return '"{}"'.format(digest.hexdigest())
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn):
+        return str(self._path(Params['Bucket'], Params['Key']))
+
+
+@pytest.fixture
+def fake_s3(tmp_path, monkeypatch):
+    """Replace the s3 client used by `load_data` with a local stand in.
+
+    The disk cache is pointed at a temporary directory as well.
+    """
+    client = FakeS3Client(tmp_path)
+    monkeypatch.setattr(load_data, 's3', client)
+    monkeypatch.setattr(load_data, 'disk_cache', DiskArrayCache(str(tmp_path / 'cache'), 1e8))
+    load_data.image_cache.clear()
+    load_data.derived_cache.clear()
+    load_data.metadata_cache.clear()
+    load_data.missing_cache.clear()
+    load_data.metadata_lookups.reset_stats()
+    load_data.image_loads.reset_stats()
+    yield client
+    load_data.image_cache.clear()
+    load_data.derived_cache.clear()
+    load_data.metadata_cache.clear()
+    load_data.missing_cache.clear()
+
+
+@pytest.fixture
+def put_fits(fake_s3):
+    """Upload an HDUList (or a single array) to the fake s3 bucket.
+
+    The compression is chosen from the filename: '.bz2' files are bz2
+    compressed, optionally as several concatenated streams.
+    """
+    def put(s3_directory, full_filename, hdul, bz2_streams=1):
+        if not isinstance(hdul, fits.HDUList):
+            hdul = fits.HDUList([fits.PrimaryHDU(hdul)])
+        buffer = io.BytesIO()
+        hdul.writeto(buffer)
+        body = buffer.getvalue()
+        if full_filename.endswith('.bz2'):
+            step = -(-len(body) // bz2_streams)
+            body = b''.join(bz2.compress(body[i:i + step]) for i in range(0, len(body), step))
+        fake_s3.put_object(Bucket=settings.S3_BUCKET, Key=f'{s3_directory}/{full_filename}', Body=body)
+        return body
+    return put
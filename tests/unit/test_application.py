@@ -0,0 +1,311 @@
+import io
+import json
+import os
+
+import pytest
+import numpy as np
+from PIL import Image
+
+from application import app
+from quickanalysis import settings
+from quickanalysis.utils import load_data
+from quickanalysis.utils.encoding import decode_binary
+
+S3_DIRECTORY = "tst/raw"
+
+
+@pytest.fixture
+def client(fake_s3, put_fits, monkeypatch):
+    # The stream loader fetches through get_object, so downloads show up in fake_s3.requests
+    monkeypatch.setattr(settings, "IMAGE_LOADER", "stream")
+    rng = np.random.default_rng(5)
+    put_fits(S3_DIRECTORY, "im.fits", rng.poisson(100, size=(30, 40)).astype(np.uint16))
+    return app.test_client()
+
+
+def post(client, route, body):
+    return client.post(route, data=json.dumps(body))
+
+
+def test_batch(client, fake_s3):
+    response = post(client, "/batch", {
+        "full_filename": "im.fits",
+        "s3_directory": S3_DIRECTORY,
+        "operations": [
+            {"type": "statistics"},
+            {"type": "histogram", "clip_percent": 0.05},
+            {"type": "lineprofile", "start": {"x": 0, "y": 0}, "end": {"x": 1, "y": 0}},
+        ],
+    })
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert [r["success"] for r in results] == [True, True, True]
+    # The image is only read once (its header is at byte 0)
+    header_reads = [r for r in fake_s3.requests if r[0] == "get_object" and r[2].startswith("bytes=0-")]
+    assert len(header_reads) == 1
+
+
+def test_batch_missing_image(client):
+    response = post(client, "/batch", {
+        "full_filename": "missing.fits",
+        "s3_directory": S3_DIRECTORY,
+        "operations": [{"type": "statistics"}],
+    })
+    assert response.status_code == 400
+
+
+def test_statistics_missing_image(client, fake_s3):
+    for _ in range(2):
+        response = post(client, "/statistics", {"full_filename": "missing.fits", "s3_directory": S3_DIRECTORY})
+        assert response.status_code == 400
+        assert response.get_json()["message"] == f"Image does not exist: {S3_DIRECTORY}/missing.fits."
+    # The missing object is remembered, so s3 is only asked once
+    assert len(fake_s3.requests) == 1
+
+
+def test_batch_validation_error(client):
+    response = post(client, "/batch", {"full_filename": "im.fits"})
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("options", [{"linewidth": 0}, {"order": -1}, {"order": 6}])
+def test_invalid_line_options_are_a_validation_error(client, options):
+    line = dict({"start": {"x": 0, "y": 0}, "end": {"x": 1, "y": 1}}, **options)
+    image = {"full_filename": "im.fits", "s3_directory": S3_DIRECTORY}
+    response = post(client, "/lineprofile", dict(image, **line))
+    assert response.status_code == 400
+    operations = [{"type": "statistics"}, dict(line, type="lineprofile")]
+    response = post(client, "/batch", dict(image, operations=operations))
+    assert response.status_code == 400
+    assert "operations" in response.get_json()["message"]
+
+
+def test_histogram_lod_reuses_cached_counts(client, fake_s3):
+    body = {"full_filename": "im.fits", "s3_directory": S3_DIRECTORY, "max_bins": 10}
+    response = post(client, "/histogram-lod", body)
+    assert response.status_code == 200
+    histogram = response.get_json()["histogram"]
+    assert len(histogram["counts"]) <= 10
+    assert sum(histogram["counts"]) == 30 * 40
+
+    fake_s3.requests.clear()
+    low, high = histogram["range"]
+    response = post(client, "/histogram-lod", dict(body, lo=low + 5, hi=high - 5, max_bins=3))
+    assert response.status_code == 200
+    assert len(response.get_json()["histogram"]["counts"]) == 3
+    assert not [r for r in fake_s3.requests if r[0] == "get_object"]
+
+
+def test_histogram_lod_invalid_window(client):
+    body = {"full_filename": "im.fits", "s3_directory": S3_DIRECTORY, "lo": 10, "hi": 1}
+    assert post(client, "/histogram-lod", body).status_code == 400
+    assert post(client, "/histogram-lod", dict(body, lo=0, max_bins=0)).status_code == 400
+
+
+def test_histogram_clipped(client):
+    data = load_data.get_image_data("im.fits", S3_DIRECTORY)
+    body = {"full_filename": "im.fits", "s3_directory": S3_DIRECTORY, "clip_percent": 0.05}
+    subregion = {"shape": "rect", "x0": 0, "x1": 0.5, "y0": 0, "y1": 0.5}
+    for subregion, region in [(None, data), (subregion, data[:16, :21])]:
+        response = post(client, "/histogram-clipped", dict(body, subregion=subregion) if subregion else body)
+        assert response.status_code == 200
+        histogram = response.get_json()["histogram"]
+        assert "percentiles" not in histogram["stats"]
+        assert histogram["edges"][0] == np.percentile(region, 5)
+        assert histogram["edges"][-1] >= np.percentile(region, 95)
+
+
+@pytest.mark.parametrize("route, extra", [
+    ("/statistics", {}), ("/histogram-clipped", {"clip_percent": 0.01}), ("/histogram-lod", {}),
+])
+@pytest.mark.parametrize("invalid", [
+    {"hdu": -1}, {"hdu": True}, {"hdu": 1.5}, {"plane": "one"}, {"plane": -1}, {"subregion": "all"},
+    {"subregion": {"x0": 0, "x1": 0.5, "y0": 0}}, {"subregion": {"x0": 0, "x1": 1.5, "y0": 0, "y1": 1}},
+    {"subregion": {"x0": 0.5, "x1": 0, "y0": 0, "y1": 1}}, {"subregion": {"x0": 0, "x1": 1, "y0": 1, "y1": 0.5}},
+    {"full_filename": None},
+])
+def test_invalid_selection_is_a_validation_error(client, route, extra, invalid):
+    body = dict({"full_filename": "im.fits", "s3_directory": S3_DIRECTORY}, **extra, **invalid)
+    response = post(client, route, body)
+    assert response.status_code == 400
+    assert response.get_json()["message"].startswith("Validation error")
+
+
+def test_histogram_clipped_validation_error(client):
+    body = {"full_filename": "im.fits", "s3_directory": S3_DIRECTORY}
+    assert post(client, "/histogram-clipped", body).status_code == 400
+    assert post(client, "/histogram-clipped", dict(body, clip_percent=0.6)).status_code == 400
+    assert post(client, "/histogram-clipped", dict(body, clip_percent=None)).status_code == 200
+
+
+def test_statistics_binary_response(client):
+    response = client.post(
+        "/histogram-clipped",
+        data=json.dumps({"full_filename": "im.fits", "s3_directory": S3_DIRECTORY, "clip_percent": 0.01}),
+        headers={"Accept": "application/octet-stream"},
+    )
+    assert response.mimetype == "application/octet-stream"
+    payload = decode_binary(response.data)
+    json_payload = post(client, "/histogram-clipped", {
+        "full_filename": "im.fits", "s3_directory": S3_DIRECTORY, "clip_percent": 0.01}).get_json()
+    assert payload["histogram"]["counts"].tolist() == json_payload["histogram"]["counts"]
+
+
+def test_cache_stats(client):
+    post(client, "/statistics", {"full_filename": "im.fits", "s3_directory": S3_DIRECTORY})
+    stats = client.get("/cache-stats").get_json()
+    assert stats["image_loads"]["executions"] == 1
+    assert stats["image_cache"]["entries"] == 1
+
+
+def test_metrics(client):
+    post(client, "/statistics", {"full_filename": "im.fits", "s3_directory": S3_DIRECTORY})
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    for stage in ("exists_check", "fetch", "decode", "compute", "serialize"):
+        assert f'quickanalysis_stage_seconds_count{{route="/statistics",stage="{stage}"}}' in text
+    assert 'quickanalysis_request_seconds_count{route="/statistics",status="200"}' in text
+    assert 'quickanalysis_s3_bytes_fetched_total{route="/statistics"}' in text
+    assert 'quickanalysis_cache_hit_ratio{cache="image_cache"}' in text
+
+
+def test_prefetch_warms_the_caches(client, fake_s3):
+    body = {"images": [{"full_filename": "im.fits", "s3_directory": S3_DIRECTORY}]}
+    response = post(client, "/prefetch", body)
+    assert response.status_code == 202
+    assert load_data.prefetch_queue.join(5)
+
+    fake_s3.requests.clear()
+    for route, extra in [("/statistics", {}), ("/histogram-clipped", {"clip_percent": 0.01}), ("/histogram-lod", {})]:
+        response = post(client, route, dict(body["images"][0], **extra))
+        assert response.status_code == 200
+    assert not fake_s3.requests
+
+
+def test_prefetch_validation_error(client):
+    assert post(client, "/prefetch", {"images": []}).status_code == 400
+    assert post(client, "/prefetch", {"images": [{"full_filename": "im.fits"}]}).status_code == 400
+
+
+def test_full_frame_requests_use_the_persisted_summary(client, fake_s3):
+    body = {"full_filename": "im.fits", "s3_directory": S3_DIRECTORY, "clip_percent": 0.01}
+    first = [post(client, route, body).get_json() for route in ("/statistics", "/histogram-clipped")]
+
+    # As if after a restart, with the decoded image evicted from the disk cache
+    load_data.image_cache.clear()
+    load_data.derived_cache.clear()
+    os.unlink(load_data.disk_cache.get_path(load_data.get_hdu_key(load_data.get_image_key("im.fits", S3_DIRECTORY))))
+    fake_s3.requests.clear()
+
+    second = [post(client, route, body).get_json() for route in ("/statistics", "/histogram-clipped")]
+    assert second == first
+    assert not [r for r in fake_s3.requests if r[0] == "get_object"]
+
+
+def test_statistics_selected_stats(client):
+    body = {"full_filename": "im.fits", "s3_directory": S3_DIRECTORY,
+            "subregion": {"x0": 0, "x1": 0.5, "y0": 0, "y1": 0.5}}
+    response = post(client, "/statistics", dict(body, stats=["mean", "max"]))
+    assert response.status_code == 200
+    assert set(response.get_json()["stats"]) == {"mean", "max"}
+    assert post(client, "/statistics", dict(body, stats=["nope"])).status_code == 400
+
+
+def test_statistics_approximate(client):
+    body = {"full_filename": "im.fits", "s3_directory": S3_DIRECTORY, "approximate": True,
+            "subregion": {"x0": 0, "x1": 0.5, "y0": 0, "y1": 0.5}}
+    response = post(client, "/statistics", dict(body, stats=["median", "max"]))
+    assert response.status_code == 200
+    payload = response.get_json()
+    assert set(payload["stats"]) == set(payload["errors"]) == {"median", "max"}
+    assert payload["errors"]["max"] == 0
+    assert post(client, "/statistics", dict(body, stats=["mode"])).status_code == 400
+
+
+def test_statistics_of_a_cube_plane(client, put_fits):
+    cube = np.arange(3 * 10 * 12, dtype=np.uint16).reshape(3, 10, 12)
+    put_fits(S3_DIRECTORY, "cube.fits", cube)
+    body = {"full_filename": "cube.fits", "s3_directory": S3_DIRECTORY, "stats": ["min"]}
+    response = post(client, "/statistics", dict(body, plane=2))
+    assert response.status_code == 200
+    assert response.get_json()["stats"]["min"] == 240
+
+    response = post(client, "/statistics", body)
+    assert response.status_code == 400
+    assert "plane" in response.get_json()["message"]
+    assert post(client, "/lineprofile", dict(body, start={"x": 0, "y": 0}, end={"x": 1, "y": 1}, hdu=5)).status_code == 400
+
+
+def test_preview(client):
+    query = {"full_filename": "im.fits", "s3_directory": S3_DIRECTORY, "size": 20}
+    response = client.get("/preview", query_string=query)
+    assert response.status_code == 200
+    assert response.mimetype == "image/png"
+    image = Image.open(io.BytesIO(response.data))
+    assert (image.mode, image.size) == ("L", (20, 15))
+
+    response = client.get("/preview", query_string=dict(query, format="webp", stretch="linear"))
+    assert response.status_code == 200
+    assert response.mimetype == "image/webp"
+
+
+def test_preview_line_is_drawn_over_the_cached_preview(client, fake_s3, monkeypatch):
+    renders = []
+    render_preview = load_data.render_preview
+    monkeypatch.setattr(load_data, "render_preview", lambda *args: renders.append(args) or render_preview(*args))
+    query = {"full_filename": "im.fits", "s3_directory": S3_DIRECTORY, "size": 40}
+    assert client.get("/preview", query_string=query).status_code == 200
+    fake_s3.requests.clear()
+
+    for x in (0.1, 0.5, 0.9):
+        response = client.get("/preview", query_string=dict(query, x0=x, y0=0, x1=x, y1=1))
+        assert response.status_code == 200
+        assert Image.open(io.BytesIO(response.data)).mode == "RGB"
+    assert len(renders) == 1
+    assert not [r for r in fake_s3.requests if r[0] == "get_object"]
+
+
+def test_preview_validation_error(client):
+    query = {"full_filename": "im.fits", "s3_directory": S3_DIRECTORY}
+    assert client.get("/preview", query_string=dict(query, stretch="log")).status_code == 400
+    assert client.get("/preview", query_string=dict(query, format="gif")).status_code == 400
+    assert client.get("/preview", query_string=dict(query, size=0)).status_code == 400
+    assert client.get("/preview", query_string=dict(query, x0=0, y0=0)).status_code == 400
+    assert client.get("/preview", query_string=dict(query, x0=0, y0=0, x1=2, y1=1)).status_code == 400
+    assert client.get("/preview", query_string=dict(query, full_filename="missing.fits")).status_code == 400
+
+
+def test_session_statistics(client, put_fits):
+    put_fits(S3_DIRECTORY, "im2.fits", np.full((30, 40), 7, dtype=np.uint16))
+    body = {"s3_directory": S3_DIRECTORY, "full_filenames": ["im.fits", "missing.fits", "im2.fits"],
+            "stats": ["median", "max"], "histogram_bins": 5}
+    response = post(client, "/session-statistics", body)
+    assert response.status_code == 200
+    payload = response.get_json()
+    assert payload["frames"] == ["im.fits", "im2.fits"]
+    assert set(payload["errors"]) == {"missing.fits"}
+    assert set(payload["stats"]) == {"median", "max"}
+    assert payload["stats"]["median"][1] == 7
+    assert [sum(row) for row in payload["histograms"]["counts"]] == [30 * 40, 30 * 40]
+    assert len(payload["histograms"]["edges"]) == 6
+
+    assert post(client, "/session-statistics", {"s3_directory": S3_DIRECTORY}).status_code == 400
+    assert post(client, "/session-statistics", dict(body, prefix="im")).status_code == 400
+    assert post(client, "/session-statistics", dict(body, stats=["nope"])).status_code == 400
+    assert post(client, "/session-statistics", dict(body, lo=10, hi=0)).status_code == 400
+
+
+def test_session_statistics_only_processes_new_frames(client, fake_s3, put_fits):
+    body = {"s3_directory": S3_DIRECTORY, "prefix": "im", "stats": ["mean"]}
+    assert post(client, "/session-statistics", body).get_json()["frames"] == ["im.fits"]
+
+    put_fits(S3_DIRECTORY, "im2.fits", np.ones((30, 40), dtype=np.uint16))
+    fake_s3.requests.clear()
+    payload = post(client, "/session-statistics", body).get_json()
+    assert payload["frames"] == ["im.fits", "im2.fits"]
+    assert payload["stats"]["mean"][1] == 1
+    # The listing provides the metadata, and only the new frame is downloaded
+    assert {r[0] for r in fake_s3.requests} == {"list_objects_v2", "get_object"}
+    assert {r[1] for r in fake_s3.requests if r[0] == "get_object"} == {f"{S3_DIRECTORY}/im2.fits"}
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import threading
+import time
+
+import numpy as np
+
+from asgi import WsgiToAsgi
+from asgi import application
+from quickanalysis import settings
+from quickanalysis.utils import load_data
+
+
+def make_scope(method, path, query_string=b"", headers=()):
+    return {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query_string,
+        "headers": list(headers),
+        "http_version": "1.1",
+        "scheme": "http",
+        "server": ("testserver", 80),
+        "client": ("127.0.0.1", 1234),
+    }
+
+
+async def call(app, scope, body=b"", chunk_size=None):
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] if chunk_size else [body]
+    messages = [{"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+                for i, chunk in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    status = sent[0]["status"]
+    headers = dict(sent[0]["headers"])
+    return status, headers, b"".join(m.get("body", b"") for m in sent[1:])
+
+
+def test_asgi_get():
+    status, headers, body = asyncio.run(call(application, make_scope("GET", "/")))
+    assert status == 200
+    assert headers[b"content-type"] == b"application/json"
+    assert json.loads(body) == {"data": "welcome"}
+
+
+def test_asgi_post_chunked_body(fake_s3, put_fits, monkeypatch):
+    monkeypatch.setattr(settings, "IMAGE_LOADER", "stream")
+    put_fits("tst/raw", "im.fits", np.arange(1200, dtype=np.uint16).reshape(30, 40))
+    body = json.dumps({"full_filename": "im.fits", "s3_directory": "tst/raw"}).encode()
+    status, _, response = asyncio.run(call(application, make_scope("POST", "/statistics"), body, chunk_size=7))
+    assert status == 200
+    assert json.loads(response)["stats"]["max"] == 1199
+
+
+def test_asgi_coalesces_concurrent_loads(fake_s3, put_fits, monkeypatch):
+    monkeypatch.setattr(settings, "IMAGE_LOADER", "stream")
+    download_image_data = load_data.download_image_data
+
+    def slow_download(*args, **kwargs):
+        time.sleep(0.1)  # so every request arrives while the first download is in progress
+        return download_image_data(*args, **kwargs)
+
+    monkeypatch.setattr(load_data, "download_image_data", slow_download)
+    put_fits("tst/raw", "im.fits", np.arange(1200, dtype=np.uint16).reshape(30, 40))
+    body = json.dumps({"full_filename": "im.fits", "s3_directory": "tst/raw"}).encode()
+
+    async def main():
+        return await asyncio.gather(*[
+            call(application, make_scope("POST", "/statistics"), body) for _ in range(10)
+        ])
+
+    assert [status for status, _, _ in asyncio.run(main())] == [200] * 10
+    header_reads = [r for r in fake_s3.requests if r[0] == "get_object" and r[2].startswith("bytes=0-")]
+    assert len(header_reads) == 1
+
+
+def test_asgi_limits_concurrent_requests():
+    lock = threading.Lock()
+    active = [0, 0]  # current, max
+
+    def wsgi_app(environ, start_response):
+        with lock:
+            active[0] += 1
+            active[1] = max(active)
+        time.sleep(0.02)
+        with lock:
+            active[0] -= 1
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [environ["PATH_INFO"].encode()]
+
+    app = WsgiToAsgi(wsgi_app, workers=8, max_concurrent_requests=2)
+
+    async def main():
+        return await asyncio.gather(*[call(app, make_scope("GET", f"/{i}")) for i in range(6)])
+
+    results = asyncio.run(main())
+    assert [body for _, _, body in results] == [f"/{i}".encode() for i in range(6)]
+    assert active[1] == 2
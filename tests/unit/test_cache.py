@@ -0,0 +1,76 @@
+import threading
+
+import pytest
+import numpy as np
+
+from quickanalysis.utils.cache import ImageCache, get_nbytes
+
+
+def make_array(nbytes):
+    return np.zeros(nbytes, dtype=np.uint8)
+
+
+def test_get_nbytes_array_and_containers():
+    arr = make_array(100)
+    assert get_nbytes(arr) == 100
+    assert get_nbytes((arr, arr)) == 200
+    assert get_nbytes({"a": arr, "b": [arr]}) == 200
+
+
+def test_cache_hit_and_miss_counters():
+    cache = ImageCache(max_bytes=1000)
+    cache.put("a", make_array(100))
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["current_bytes"] == 100
+
+
+def test_cache_evicts_least_recently_used():
+    cache = ImageCache(max_bytes=300)
+    cache.put("a", make_array(100))
+    cache.put("b", make_array(100))
+    cache.put("c", make_array(100))
+    cache.get("a")  # 'b' is now the least recently used entry
+    cache.put("d", make_array(100))
+    assert "a" in cache and "c" in cache and "d" in cache
+    assert "b" not in cache
+    assert cache.stats()["evictions"] == 1
+    assert cache.current_bytes == 300
+
+
+def test_cache_skips_values_larger_than_budget():
+    cache = ImageCache(max_bytes=100)
+    cache.put("a", make_array(50))
+    assert not cache.put("big", make_array(101))
+    assert "big" not in cache
+    assert "a" in cache
+
+
+def test_cache_replace_updates_size():
+    cache = ImageCache(max_bytes=1000)
+    cache.put("a", make_array(100))
+    cache.put("a", make_array(300))
+    assert len(cache) == 1
+    assert cache.current_bytes == 300
+    assert cache.pop("a") is not None
+    assert cache.current_bytes == 0
+
+
+def test_cache_concurrent_puts_stay_in_budget():
+    cache = ImageCache(max_bytes=1000)
+
+    def worker(offset):
+        for i in range(200):
+            cache.put((offset, i), make_array(64))
+            cache.get((offset, i - 1))
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert cache.current_bytes <= 1000
+    assert cache.current_bytes == 64 * len(cache)
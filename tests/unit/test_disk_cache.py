@@ -0,0 +1,71 @@
+import os
+
+import pytest
+import numpy as np
+
+from quickanalysis.utils.disk_cache import DiskArrayCache
+
+
+@pytest.fixture
+def disk_cache(tmp_path):
+    return DiskArrayCache(str(tmp_path / "cache"), max_bytes=10000)
+
+
+def test_put_and_get_memory_mapped(disk_cache):
+    arr = np.arange(100, dtype=np.uint16).reshape(10, 10)
+    cached = disk_cache.put("a", arr)
+    np.testing.assert_array_equal(cached, arr)
+    assert not cached.flags.writeable
+    np.testing.assert_array_equal(disk_cache.get("a"), arr)
+    assert disk_cache.stats()["hits"] == 2
+
+
+def test_missing_key_is_a_miss(disk_cache):
+    assert disk_cache.get("nope") is None
+    assert disk_cache.stats()["misses"] == 1
+
+
+def test_no_temporary_files_left_behind(disk_cache):
+    disk_cache.put("a", np.zeros(10))
+    assert not [name for name in os.listdir(disk_cache.directory) if name.endswith(".tmp")]
+
+
+def test_evicts_least_recently_accessed(disk_cache):
+    arr = np.zeros(3000, dtype=np.uint8)
+    disk_cache.put("a", arr)
+    disk_cache.put("b", arr)
+    # Make 'a' the oldest entry, then touch it so 'b' becomes the oldest
+    os.utime(disk_cache.get_path("a"), (1, 1))
+    os.utime(disk_cache.get_path("b"), (2, 2))
+    disk_cache.get("a")
+    disk_cache.put("c", arr)
+    disk_cache.put("d", arr)
+    assert disk_cache.get("b") is None
+    assert disk_cache.get("a") is not None
+    assert disk_cache.stats()["current_bytes"] <= disk_cache.max_bytes
+
+
+def test_oversized_and_disabled(tmp_path, disk_cache):
+    assert disk_cache.put("big", np.zeros(20000, dtype=np.uint8)) is None
+    disabled = DiskArrayCache(str(tmp_path / "off"), max_bytes=0)
+    assert disabled.put("a", np.zeros(10)) is None
+    assert disabled.get("a") is None
+
+
+def test_corrupt_file_is_a_miss(disk_cache):
+    disk_cache.put("a", np.zeros(10))
+    with open(disk_cache.get_path("a"), "wb") as f:
+        f.write(b"not an array")
+    assert disk_cache.get("a") is None
+
+
+def test_sidecar_round_trip(disk_cache):
+    arrays = {"counts": np.arange(5), "meta": np.array('{"a": 1}')}
+    assert disk_cache.get_sidecar("a") is None
+    assert disk_cache.put_sidecar("a", arrays)
+    loaded = disk_cache.get_sidecar("a")
+    np.testing.assert_array_equal(loaded["counts"], arrays["counts"])
+    assert str(loaded["meta"]) == '{"a": 1}'
+    # Stored separately from a cached array with the same key
+    disk_cache.put("a", np.zeros(3))
+    assert disk_cache.get_sidecar("a") is not None
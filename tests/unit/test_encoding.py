@@ -0,0 +1,71 @@
+import pytest
+import numpy as np
+from flask import Flask
+
+from quickanalysis.utils.encoding import decode_binary, encode_binary
+from quickanalysis.utils.encoding import decode_msgpack, encode_msgpack
+from quickanalysis.utils.encoding import make_response
+from quickanalysis.utils.useful import NumpyEncoder
+
+
+@pytest.fixture
+def payload():
+    return {
+        "success": True,
+        "histogram": {
+            "counts": np.arange(5, dtype=np.int64),
+            "edges": np.linspace(0, 1, 6),
+            "stats": {"median": np.float64(1.5), "mode": np.uint16(3)},
+        },
+        "profiles": [np.arange(3, dtype=">u2"), np.ones((2, 3), dtype=np.float32)],
+        "start": (0, 0.5),
+    }
+
+
+def assert_same_payload(decoded, payload):
+    histogram = decoded["histogram"]
+    np.testing.assert_array_equal(histogram["counts"], payload["histogram"]["counts"])
+    np.testing.assert_array_equal(histogram["edges"], payload["histogram"]["edges"])
+    assert histogram["stats"] == {"median": 1.5, "mode": 3}
+    np.testing.assert_array_equal(decoded["profiles"][0], [0, 1, 2])
+    assert decoded["profiles"][1].shape == (2, 3)
+    assert decoded["profiles"][1].dtype == np.float32
+    assert decoded["start"] == [0, 0.5]
+    assert decoded["success"] is True
+
+
+def test_binary_roundtrip(payload):
+    data = encode_binary(payload)
+    assert data[:4] == b"QAB1"
+    decoded = decode_binary(data)
+    assert_same_payload(decoded, payload)
+    # Big-endian input is sent as little-endian
+    assert decoded["profiles"][0].dtype == np.dtype("<u2")
+
+
+def test_binary_buffers_are_aligned(payload):
+    data = encode_binary(payload)
+    header_end = 8 + int.from_bytes(data[4:8], "little")
+    assert header_end % 8 == 0
+    assert len(data) % 8 == 0
+
+
+def test_msgpack_roundtrip(payload):
+    assert_same_payload(decode_msgpack(encode_msgpack(payload)), payload)
+
+
+@pytest.mark.parametrize("accept, mimetype", [
+    (None, "application/json"),
+    ("*/*", "application/json"),
+    ("application/octet-stream", "application/octet-stream"),
+    ("application/msgpack", "application/msgpack"),
+    ("application/x-msgpack, application/json;q=0.5", "application/x-msgpack"),
+])
+def test_make_response_negotiates(payload, accept, mimetype):
+    app = Flask(__name__)
+    app.json_encoder = NumpyEncoder
+    headers = {} if accept is None else {"Accept": accept}
+    with app.test_request_context(headers=headers):
+        response = app.make_response(make_response(payload))
+    assert response.mimetype == mimetype
+    assert response.status_code == 200
@@ -0,0 +1,202 @@
+import inspect
+
+import pytest
+import numpy as np
+from astropy.io import fits
+
+from quickanalysis import settings
+from quickanalysis.utils.fits_stream import HDUNotFoundError
+from quickanalysis.utils.fits_stream import load_image_from_s3
+from quickanalysis.utils.fits_stream import find_header_end
+from quickanalysis.utils.fits_stream import S3RangeReader
+from quickanalysis.utils.fits_stream import load_from_range_reader
+from quickanalysis.utils.fits_stream import HEADER_FETCH_SIZE
+
+S3_DIRECTORY = "tst/raw"
+
+
+@pytest.fixture
+def uint16_image():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 65535, size=(50, 70), dtype=np.uint16)
+
+
+def compressed_hdu(data, tile_shape):
+    """ A CompImageHDU with tiles of tile_shape (numpy axis order).
+
+    The pinned astropy (4.2) takes the tile shape as `tile_size`, in FITS axis
+    order; astropy 5.3 renamed it to `tile_shape`, in numpy order.
+    """
+    if "tile_shape" in inspect.signature(fits.CompImageHDU).parameters:
+        return fits.CompImageHDU(data, tile_shape=tile_shape)
+    return fits.CompImageHDU(data, tile_size=tuple(reversed(tile_shape)))
+
+
+def load(fake_s3, full_filename):
+    return load_image_from_s3(fake_s3, settings.S3_BUCKET, f"{S3_DIRECTORY}/{full_filename}")
+
+
+def test_find_header_end():
+    header = fits.Header({"SIMPLE": True, "BITPIX": 8, "NAXIS": 0})
+    header_bytes = header.tostring().encode("ascii")
+    assert find_header_end(header_bytes) == 2880
+    assert find_header_end(header_bytes[:160]) is None
+
+
+@pytest.mark.parametrize("full_filename", ["im.fits", "im.fits.bz2"])
+def test_uint16_image_matches_astropy(fake_s3, put_fits, uint16_image, full_filename):
+    put_fits(S3_DIRECTORY, full_filename, uint16_image)
+    data = load(fake_s3, full_filename)
+    assert data.dtype == np.uint16
+    assert data.dtype.isnative
+    np.testing.assert_array_equal(data, uint16_image)
+
+
+@pytest.mark.parametrize("dtype", [np.int16, np.int32, np.float32, np.float64])
+def test_other_dtypes_match_astropy(fake_s3, put_fits, uint16_image, dtype):
+    image = (uint16_image // 4).astype(dtype)
+    put_fits(S3_DIRECTORY, "im.fits", image)
+    data = load(fake_s3, "im.fits")
+    assert data.dtype == np.dtype(dtype)
+    np.testing.assert_array_equal(data, image)
+
+
+def test_scaled_image_matches_astropy(fake_s3, put_fits, uint16_image, tmp_path):
+    hdu = fits.PrimaryHDU(uint16_image.astype(np.int16))
+    hdu.header["BSCALE"] = 0.5
+    hdu.header["BZERO"] = 10.0
+    put_fits(S3_DIRECTORY, "im.fits", fits.HDUList([hdu]))
+    expected = fits.getdata(str(tmp_path / settings.S3_BUCKET / S3_DIRECTORY / "im.fits"))
+    data = load(fake_s3, "im.fits")
+    assert data.dtype == expected.dtype
+    np.testing.assert_allclose(data, expected)
+
+
+@pytest.mark.parametrize("full_filename", ["im.fits", "im.fits.bz2"])
+def test_signed_bytes_match_astropy(fake_s3, put_fits, uint16_image, tmp_path, full_filename):
+    image = (uint16_image // 256 - 128).astype(np.int8)
+    put_fits(S3_DIRECTORY, full_filename, image)
+    data = load(fake_s3, full_filename)
+    assert data.dtype == np.int8
+    np.testing.assert_array_equal(data, image)
+    if full_filename == "im.fits":
+        expected = fits.getdata(str(tmp_path / settings.S3_BUCKET / S3_DIRECTORY / full_filename))
+        assert expected.dtype == data.dtype
+
+
+def test_multistream_bz2(fake_s3, put_fits, uint16_image):
+    put_fits(S3_DIRECTORY, "im.fits.bz2", uint16_image, bz2_streams=4)
+    np.testing.assert_array_equal(load(fake_s3, "im.fits.bz2"), uint16_image)
+
+
+def test_image_in_extension(fake_s3, put_fits, uint16_image):
+    hdul = fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(uint16_image)])
+    put_fits(S3_DIRECTORY, "im.fits.bz2", hdul)
+    np.testing.assert_array_equal(load(fake_s3, "im.fits.bz2"), uint16_image)
+
+
+def test_tile_compressed_image(fake_s3, put_fits, uint16_image):
+    hdul = fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(uint16_image)])
+    put_fits(S3_DIRECTORY, "im.fits.fz", hdul)
+    np.testing.assert_array_equal(load(fake_s3, "im.fits.fz"), uint16_image)
+
+
+def test_uncompressed_reads_use_ranges(fake_s3, put_fits):
+    """ Only the headers and the first image are downloaded. """
+    image = np.ones((400, 500), dtype=np.uint16)
+    hdul = fits.HDUList([fits.PrimaryHDU(image), fits.ImageHDU(image)])
+    body = put_fits(S3_DIRECTORY, "im.fits", hdul)
+    reader = S3RangeReader(fake_s3, settings.S3_BUCKET, f"{S3_DIRECTORY}/im.fits")
+    load_from_range_reader(reader)
+    assert all(rng is not None for _, _, rng in fake_s3.requests)
+    assert reader.bytes_fetched <= image.nbytes + HEADER_FETCH_SIZE
+    assert reader.bytes_fetched < len(body) * 0.6
+
+
+def window_of(bounds):
+    return lambda shape: bounds
+
+
+@pytest.mark.parametrize("bounds", [(10, 30, 5, 40), (0, 50, 0, 70), (49, 50, 69, 70), (20, 20, 0, 10)])
+def test_uncompressed_window(fake_s3, put_fits, uint16_image, bounds):
+    put_fits(S3_DIRECTORY, "im.fits", uint16_image)
+    data = load_image_from_s3(
+        fake_s3, settings.S3_BUCKET, f"{S3_DIRECTORY}/im.fits", window=window_of(bounds))
+    ystart, yend, xstart, xend = bounds
+    np.testing.assert_array_equal(data, uint16_image[ystart:yend, xstart:xend])
+
+
+@pytest.mark.parametrize("tile_shape", [None, (16, 16), (7, 70)])
+@pytest.mark.parametrize("bounds", [(10, 30, 5, 40), (0, 50, 0, 70), (33, 50, 60, 70)])
+def test_compressed_window(fake_s3, put_fits, uint16_image, tile_shape, bounds):
+    hdu = fits.CompImageHDU(uint16_image) if tile_shape is None else compressed_hdu(uint16_image, tile_shape)
+    hdul = fits.HDUList([fits.PrimaryHDU(), hdu])
+    put_fits(S3_DIRECTORY, "im.fits.fz", hdul)
+    data = load_image_from_s3(
+        fake_s3, settings.S3_BUCKET, f"{S3_DIRECTORY}/im.fits.fz", window=window_of(bounds))
+    ystart, yend, xstart, xend = bounds
+    np.testing.assert_array_equal(data, uint16_image[ystart:yend, xstart:xend])
+
+
+def test_compressed_window_of_dithered_floats(fake_s3, put_fits, uint16_image, tmp_path):
+    """ Quantized float tiles depend on their tile number for the dither seed. """
+    image = uint16_image.astype(np.float32) / 7
+    hdul = fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(image, quantize_method=1)])
+    put_fits(S3_DIRECTORY, "im.fits.fz", hdul)
+    expected = fits.getdata(str(tmp_path / settings.S3_BUCKET / S3_DIRECTORY / "im.fits.fz"))
+    bounds = (17, 41, 3, 30)
+    data = load_image_from_s3(
+        fake_s3, settings.S3_BUCKET, f"{S3_DIRECTORY}/im.fits.fz", window=window_of(bounds))
+    np.testing.assert_array_equal(data, expected[17:41, 3:30])
+
+
+def test_compressed_window_fetches_fewer_bytes(fake_s3, put_fits):
+    rng = np.random.default_rng(1)
+    image = rng.integers(0, 65535, size=(400, 300), dtype=np.uint16)
+    hdul = fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(image)])
+    body = put_fits(S3_DIRECTORY, "im.fits.fz", hdul)
+    reader = S3RangeReader(fake_s3, settings.S3_BUCKET, f"{S3_DIRECTORY}/im.fits.fz")
+    data = load_from_range_reader(reader, window=window_of((100, 120, 0, 50)))
+    np.testing.assert_array_equal(data, image[100:120, 0:50])
+    assert reader.bytes_fetched < len(body) / 5
+
+
+def test_bz2_window_is_cropped(fake_s3, put_fits, uint16_image):
+    put_fits(S3_DIRECTORY, "im.fits.bz2", uint16_image)
+    data = load_image_from_s3(
+        fake_s3, settings.S3_BUCKET, f"{S3_DIRECTORY}/im.fits.bz2", window=window_of((1, 4, 2, 9)))
+    np.testing.assert_array_equal(data, uint16_image[1:4, 2:9])
+
+
+@pytest.fixture
+def mosaic():
+    """ A multi-extension file with one image per amplifier, and a table. """
+    amplifiers = [np.full((20, 30), i, dtype=np.uint16) for i in range(3)]
+    hdus = [fits.ImageHDU(data, name=f"SCI{i}") for i, data in enumerate(amplifiers)]
+    table = fits.BinTableHDU.from_columns([fits.Column(name="x", format="E", array=np.zeros(4))], name="CAT")
+    return fits.HDUList([fits.PrimaryHDU()] + hdus + [table]), amplifiers
+
+
+@pytest.mark.parametrize("full_filename", ["im.fits", "im.fits.bz2"])
+@pytest.mark.parametrize("hdu, amplifier", [(None, 0), (2, 1), ("SCI2", 2), ("sci1", 1)])
+def test_select_hdu(fake_s3, put_fits, mosaic, full_filename, hdu, amplifier):
+    hdul, amplifiers = mosaic
+    put_fits(S3_DIRECTORY, full_filename, hdul)
+    data = load_image_from_s3(fake_s3, settings.S3_BUCKET, f"{S3_DIRECTORY}/{full_filename}", hdu=hdu)
+    np.testing.assert_array_equal(data, amplifiers[amplifier])
+
+
+def test_select_hdu_skips_the_other_extensions(fake_s3, put_fits, mosaic):
+    hdul, amplifiers = mosaic
+    put_fits(S3_DIRECTORY, "im.fits", hdul)
+    reader = S3RangeReader(fake_s3, settings.S3_BUCKET, f"{S3_DIRECTORY}/im.fits")
+    load_from_range_reader(reader, hdu="SCI2")
+    assert reader.bytes_fetched <= amplifiers[2].nbytes + 4 * HEADER_FETCH_SIZE
+
+
+@pytest.mark.parametrize("full_filename", ["im.fits", "im.fits.bz2"])
+@pytest.mark.parametrize("hdu", [0, 4, 9, "NOPE"])
+def test_select_missing_hdu(fake_s3, put_fits, mosaic, full_filename, hdu):
+    put_fits(S3_DIRECTORY, full_filename, mosaic[0])
+    with pytest.raises(HDUNotFoundError):
+        load_image_from_s3(fake_s3, settings.S3_BUCKET, f"{S3_DIRECTORY}/{full_filename}", hdu=hdu)
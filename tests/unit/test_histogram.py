@@ -0,0 +1,121 @@
+import pytest
+import numpy as np
+
+from quickanalysis.analysis.histogram import FULL_HISTOGRAM_MAX_BINS
+from quickanalysis.analysis.histogram import build_full_histogram
+from quickanalysis.analysis.histogram import get_histogram
+from quickanalysis.analysis.histogram import get_histogram_counts
+from quickanalysis.analysis.histogram import get_histogram_from_counts
+from quickanalysis.analysis.histogram import get_histogram_window
+from quickanalysis.analysis.region_stats import get_value_counts
+
+
+@pytest.fixture
+def uint16_image():
+    """ A small 16-bit frame with a sky background, a hot pixel and a saturated star. """
+    rng = np.random.default_rng(7)
+    data = rng.poisson(900, size=(60, 80)).astype(np.uint16)
+    data[5, 5] = 3
+    data[30:33, 40:43] = 65535
+    return data
+
+
+def reference_histogram(arr, bin_edges):
+    """ The np.histogram pass that get_histogram used for every dtype. """
+    return np.histogram(arr, bins=bin_edges)
+
+
+@pytest.mark.parametrize("clip_percent", [None, 0, 0.05, 0.0137])
+@pytest.mark.parametrize("bin_size", [None, 1, 3])
+def test_get_histogram_integer_matches_np_histogram(uint16_image, clip_percent, bin_size):
+    counts, edges = get_histogram(uint16_image, bin_size=bin_size, clip_percent=clip_percent)
+    if clip_percent is not None:
+        assert edges[0] == np.percentile(uint16_image, clip_percent * 100)
+    expected_counts, expected_edges = reference_histogram(uint16_image, edges)
+    np.testing.assert_array_equal(edges, expected_edges)
+    np.testing.assert_array_equal(counts, expected_counts)
+    assert counts.dtype == expected_counts.dtype
+
+
+def test_get_histogram_integer_matches_float_path(uint16_image):
+    region = uint16_image[10:50, 10:50]
+    counts, edges = get_histogram(region, clip_percent=0.05)
+    float_counts, float_edges = get_histogram(region.astype(np.float64), clip_percent=0.05)
+    np.testing.assert_array_equal(counts, float_counts)
+    np.testing.assert_array_equal(edges, float_edges)
+
+
+def test_get_histogram_saturated_uint16_range(uint16_image):
+    counts, edges = get_histogram(uint16_image, bin_size=100)
+    assert edges[0] == 3 and edges[-1] > 65535
+    assert counts.sum() == uint16_image.size
+
+
+def test_get_histogram_from_counts_fractional_edges():
+    data = np.array([0, 1, 1, 2, 5, 5, 5, 9, 10], dtype=np.int32)
+    low_val, counts = get_value_counts(data)
+    for edges in ([0.5, 2.0, 5.0, 9.5], [-3, 1, 5, 10], [1.5, 2.5], [5, 5.5, 20]):
+        expected, _ = np.histogram(data, bins=edges)
+        np.testing.assert_array_equal(get_histogram_from_counts(low_val, counts, np.array(edges)), expected)
+
+
+def test_histogram_window_integer(uint16_image):
+    full_histogram = build_full_histogram(uint16_image)
+    assert (full_histogram["min"], full_histogram["max"]) == (3, 65535)
+
+    counts, edges = get_histogram_window(full_histogram, lo=800, hi=1000, max_bins=50)
+    assert len(counts) == 41  # 201 values in bins of 5
+    expected, _ = np.histogram(uint16_image, bins=edges)
+    np.testing.assert_array_equal(counts, expected)
+    assert edges[0] == 800 and edges[-1] == 1001
+
+    # The whole range, rebinned
+    counts, edges = get_histogram_window(full_histogram, max_bins=1000)
+    assert len(counts) <= 1000
+    assert counts.sum() == uint16_image.size
+
+
+def test_histogram_window_float():
+    rng = np.random.default_rng(3)
+    data = rng.normal(10, 2, size=(50, 50))
+    full_histogram = build_full_histogram(data)
+    counts, edges = get_histogram_window(full_histogram, lo=8, hi=12, max_bins=40)
+    assert len(counts) == 40
+    assert edges[0] <= 8 and edges[-1] >= 12
+    assert counts.sum() == np.count_nonzero((data >= edges[0]) & (data < edges[-1]))
+    assert get_histogram_window(full_histogram, max_bins=7)[0].sum() == data.size
+
+
+def test_histogram_window_wide_integer_range():
+    data = np.array([0, 5, 1_000_000, 1_000_001], dtype=np.int32)
+    full_histogram = build_full_histogram(data)
+    assert full_histogram["cumulative"].size <= FULL_HISTOGRAM_MAX_BINS + 1
+    counts, _ = get_histogram_window(full_histogram, max_bins=2)
+    np.testing.assert_array_equal(counts, [2, 2])
+
+
+def test_histogram_window_invalid():
+    full_histogram = build_full_histogram(np.arange(10))
+    with pytest.raises(ValueError):
+        get_histogram_window(full_histogram, max_bins=0)
+    with pytest.raises(ValueError):
+        get_histogram_window(full_histogram, lo=5, hi=1)
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.float32])
+def test_histogram_counts_match_numpy(uint16_image, dtype):
+    data = uint16_image.astype(dtype)
+    if dtype == np.float32:
+        data += np.random.default_rng(1).uniform(-0.5, 0.5, size=data.shape).astype(np.float32)
+    full_histogram = build_full_histogram(data)
+    edges = np.array([0, 800, 900, 1000, 70000])
+    expected, _ = np.histogram(data, edges)
+    counts = get_histogram_counts(full_histogram, edges)
+    if dtype == np.uint16:
+        np.testing.assert_array_equal(counts, expected)
+        # The last bin includes its upper edge
+        assert get_histogram_counts(full_histogram, np.array([900, 65535]))[0] == (data >= 900).sum()
+    else:
+        # Float edges are rounded up to the full resolution bins, about one count wide here
+        np.testing.assert_allclose(counts, expected, rtol=0.05)
+    assert counts.sum() == data.size
@@ -1,10 +1,35 @@
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 import requests
 import numpy as np
+from astropy.io import fits
+from botocore.exceptions import ClientError
 from urllib.error import HTTPError
 
+from quickanalysis import settings
+from quickanalysis.analysis.region_stats import compute_region_stats
+from quickanalysis.utils import load_data
+
 from quickanalysis.utils.load_data import check_if_s3_image_exists
+from quickanalysis.utils.load_data import ImageNotFoundError
+from quickanalysis.utils.load_data import ImageSelectionError
+from quickanalysis.utils.load_data import forget_image_metadata
+from quickanalysis.utils.load_data import get_approximate_stats
 from quickanalysis.utils.load_data import get_image_data
+from quickanalysis.utils.load_data import get_image_metadata
+from quickanalysis.utils.load_data import get_image_histogram
+from quickanalysis.utils.load_data import get_image_stats
+from quickanalysis.utils.load_data import get_image_summary
+from quickanalysis.utils.load_data import get_load_stats
+from quickanalysis.utils.load_data import image_cache
+from quickanalysis.utils.load_data import get_hdu_key
+from quickanalysis.utils.load_data import get_image_key
+from quickanalysis.utils.load_data import get_image_pyramid
+from quickanalysis.utils.load_data import get_subregion_rect
 
 NONEXISTENT_FILE = "im a string not a filename"
 VALID_FITS_FILENAME = "eco2-ec002cs-20230828-00021260B1-EX00.fits.fz"
@@ -30,3 +55,291 @@ def test_get_image_data_invalid_filename():
     s3_directory = "eco/ec002cs/20230828/raw"
     with pytest.raises(Exception):
         data = get_image_data(NONEXISTENT_FILE, s3_directory)
+
+
+@pytest.mark.parametrize("loader", ["url", "stream"])
+def test_get_image_data_loaders(fake_s3, put_fits, monkeypatch, loader):
+    monkeypatch.setattr(settings, "IMAGE_LOADER", loader)
+    image = np.arange(12, dtype=np.uint16).reshape(3, 4)
+    put_fits("tst/raw", "im.fits.bz2", image)
+    np.testing.assert_array_equal(get_image_data("im.fits.bz2", "tst/raw"), image)
+
+
+def test_get_image_data_is_cached(fake_s3, put_fits):
+    image = np.arange(12, dtype=np.uint16).reshape(3, 4)
+    put_fits("tst/raw", "im.fits", image)
+    first = get_image_data("im.fits", "tst/raw")
+    second = get_image_data("im.fits", "tst/raw")
+    assert first is second
+    assert image_cache.stats()["hits"] == 1
+
+
+def test_get_image_data_reloads_changed_image(fake_s3, put_fits):
+    image = np.arange(12, dtype=np.uint16).reshape(3, 4)
+    put_fits("tst/raw", "im.fits", image)
+    get_image_data("im.fits", "tst/raw")
+    put_fits("tst/raw", "im.fits", image + 1)
+    forget_image_metadata("im.fits", "tst/raw")  # as if the metadata ttl expired
+    np.testing.assert_array_equal(get_image_data("im.fits", "tst/raw"), image + 1)
+
+
+def test_get_image_metadata_is_cached(fake_s3, put_fits, monkeypatch):
+    monkeypatch.setattr(settings, "IMAGE_LOADER", "stream")
+    image = np.arange(12, dtype=np.uint16).reshape(3, 4)
+    body = put_fits("tst/raw", "im.fits", image)
+    for _ in range(3):
+        metadata = get_image_metadata("im.fits", "tst/raw")
+        get_image_data("im.fits", "tst/raw")
+    assert metadata["size"] == len(body)
+    # The metadata and the header come from one ranged GET, then the data is read once
+    assert [r[0] for r in fake_s3.requests] == ["get_object", "get_object"]
+
+
+def test_missing_image_is_negatively_cached(fake_s3):
+    for _ in range(2):
+        assert not check_if_s3_image_exists("missing.fits", "tst/raw")
+        with pytest.raises(ImageNotFoundError, match="tst/raw/missing.fits"):
+            get_image_data("missing.fits", "tst/raw")
+    assert len(fake_s3.requests) == 1
+
+
+def test_s3_errors_are_not_mistaken_for_a_missing_image(fake_s3, put_fits, monkeypatch):
+    put_fits("tst/raw", "im.fits", np.zeros((4, 4), dtype=np.uint16))
+    get_object = fake_s3.get_object
+
+    def denied(Bucket, Key, Range=None):
+        raise ClientError({"Error": {"Code": "AccessDenied", "Message": "Access Denied"}}, "GetObject")
+
+    monkeypatch.setattr(fake_s3, "get_object", denied)
+    with pytest.raises(ClientError):
+        check_if_s3_image_exists("im.fits", "tst/raw")
+    # The failure isn't cached, so the image is found once s3 answers again
+    monkeypatch.setattr(fake_s3, "get_object", get_object)
+    assert check_if_s3_image_exists("im.fits", "tst/raw")
+
+
+def test_get_subregion_rect_reversed_corners():
+    image = np.arange(100).reshape(10, 10)
+    region = get_subregion_rect(image, 0.8, 0.2, 0.9, 0.1)
+    np.testing.assert_array_equal(region, image[1:9, 2:8])
+
+
+@pytest.mark.parametrize("full_filename", ["im.fits", "im.fits.bz2"])
+def test_get_image_data_subregion(fake_s3, put_fits, full_filename):
+    image = np.arange(2000, dtype=np.uint16).reshape(40, 50)
+    put_fits("tst/raw", full_filename, image)
+    subregion = {"x0": 0.1, "x1": 0.5, "y0": 0.25, "y1": 0.5}
+    data = get_image_data(full_filename, "tst/raw", subregion=subregion)
+    np.testing.assert_array_equal(data, image[10:20, 5:25])
+    # Partial reads are not cached, but bz2 files are loaded in full
+    assert len(image_cache) == (1 if full_filename.endswith(".bz2") else 0)
+
+
+def test_get_image_data_subregion_uses_cached_image(fake_s3, put_fits):
+    image = np.arange(2000, dtype=np.uint16).reshape(40, 50)
+    put_fits("tst/raw", "im.fits", image)
+    get_image_data("im.fits", "tst/raw")
+    fake_s3.requests.clear()
+    data = get_image_data("im.fits", "tst/raw", subregion={"x0": 0, "x1": 0.5, "y0": 0, "y1": 0.5})
+    np.testing.assert_array_equal(data, image[:20, :25])
+    assert not any(op == "get_object" for op, _, _ in fake_s3.requests)
+
+
+def test_get_image_data_uses_disk_cache_after_restart(fake_s3, put_fits):
+    image = np.arange(12, dtype=np.uint16).reshape(3, 4)
+    put_fits("tst/raw", "im.fits", image)
+    get_image_data("im.fits", "tst/raw")
+    image_cache.clear()  # as if the worker restarted
+    fake_s3.requests.clear()
+    data = get_image_data("im.fits", "tst/raw")
+    np.testing.assert_array_equal(data, image)
+    assert not data.flags.writeable
+    assert not any(op == "get_object" for op, _, _ in fake_s3.requests)
+
+
+def test_get_image_data_decodes_and_caches_one_hdu(fake_s3, put_fits):
+    amplifiers = [np.full((20, 30), i, dtype=np.uint16) for i in range(3)]
+    hdul = fits.HDUList([fits.PrimaryHDU()] + [fits.ImageHDU(data, name=f"AMP{i}") for i, data in enumerate(amplifiers)])
+    put_fits("tst/raw", "mosaic.fits", hdul)
+    np.testing.assert_array_equal(get_image_data("mosaic.fits", "tst/raw", hdu="AMP1"), amplifiers[1])
+    np.testing.assert_array_equal(get_image_data("mosaic.fits", "tst/raw", hdu=3), amplifiers[2])
+    np.testing.assert_array_equal(get_image_data("mosaic.fits", "tst/raw"), amplifiers[0])
+    assert len(image_cache) == 3
+
+    stats = get_image_stats("mosaic.fits", "tst/raw", hdu="amp1")
+    assert stats["max"] == 1
+    with pytest.raises(ImageSelectionError):
+        get_image_data("mosaic.fits", "tst/raw", hdu="AMP9")
+
+
+def test_get_image_data_selects_a_plane_of_a_cube(fake_s3, put_fits):
+    cube = np.arange(4 * 10 * 12, dtype=np.uint16).reshape(4, 10, 12)
+    put_fits("tst/raw", "cube.fits", cube)
+    np.testing.assert_array_equal(get_image_data("cube.fits", "tst/raw", plane=2), cube[2])
+    subregion = {"x0": 0, "x1": 0.5, "y0": 0, "y1": 0.5}
+    np.testing.assert_array_equal(get_image_data("cube.fits", "tst/raw", subregion, plane=3), cube[3, :5, :6])
+    assert get_image_stats("cube.fits", "tst/raw", plane=1)["min"] == cube[1].min()
+    assert len(image_cache) == 1  # the cube is decoded once for all its planes
+
+    for plane in (None, 4):
+        with pytest.raises(ImageSelectionError):
+            get_image_data("cube.fits", "tst/raw", plane=plane)
+
+
+def test_cube_subregion_is_loaded_and_cached_in_full(fake_s3, put_fits):
+    cube = np.arange(3 * 10 * 12, dtype=np.uint16).reshape(3, 10, 12)
+    put_fits("tst/raw", "cube.fits", cube)
+    subregion = {"x0": 0, "x1": 0.5, "y0": 0, "y1": 0.5}
+    for plane in (0, 2):
+        data = get_image_data("cube.fits", "tst/raw", subregion, plane=plane)
+        np.testing.assert_array_equal(data, cube[plane, :5, :6])
+    assert len(image_cache) == 1
+    assert sum(op == "get_object" for op, _, _ in fake_s3.requests) == 2  # the headers and the data, once
+
+
+def test_get_image_pyramid_is_cached(fake_s3, put_fits):
+    image = np.ones((600, 800), dtype=np.uint16)
+    put_fits("tst/raw", "im.fits", image)
+    pyramid = get_image_pyramid("im.fits", "tst/raw")
+    np.testing.assert_array_equal(pyramid[0], image)
+    assert pyramid[1].shape == (300, 400)
+    assert get_image_pyramid("im.fits", "tst/raw")[1] is pyramid[1]
+
+
+@pytest.mark.parametrize("loader", ["url", "stream"])
+def test_concurrent_loads_are_coalesced(fake_s3, put_fits, monkeypatch, loader):
+    monkeypatch.setattr(settings, "IMAGE_LOADER", loader)
+    image = np.arange(1200, dtype=np.uint16).reshape(30, 40)
+    put_fits("tst/raw", "im.fits", image)
+    download_image_data = load_data.download_image_data
+    downloads = []
+
+    def slow_download(*args, **kwargs):
+        downloads.append(args)
+        time.sleep(0.1)  # so every caller arrives while the first load is in progress
+        return download_image_data(*args, **kwargs)
+
+    monkeypatch.setattr(load_data, "download_image_data", slow_download)
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: get_image_data("im.fits", "tst/raw"), range(8)))
+
+    assert len(downloads) == 1
+    assert all(result is results[0] for result in results)
+    assert not results[0].flags.writeable
+    np.testing.assert_array_equal(results[0], image)
+    stats = get_load_stats()["image_loads"]
+    assert stats["executions"] == 1
+    assert stats["calls"] == stats["executions"] + stats["coalesced"]
+    assert stats["in_flight"] == 0
+
+
+def test_concurrent_metadata_lookups_are_coalesced(fake_s3, put_fits, monkeypatch):
+    put_fits("tst/raw", "im.fits", np.zeros((2, 2), dtype=np.uint16))
+    get_object = fake_s3.get_object
+
+    def slow_get_object(**kwargs):
+        time.sleep(0.1)
+        return get_object(**kwargs)
+
+    monkeypatch.setattr(fake_s3, "get_object", slow_get_object)
+    with ThreadPoolExecutor(4) as pool:
+        etags = set(pool.map(lambda _: get_image_metadata("im.fits", "tst/raw")["etag"], range(4)))
+    assert len(etags) == 1
+    assert get_load_stats()["metadata_lookups"] == {
+        "calls": 4, "executions": 1, "coalesced": 3, "errors": 0, "in_flight": 0}
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.float32])
+def test_image_summary_is_persisted(fake_s3, put_fits, dtype):
+    rng = np.random.default_rng(11)
+    image = rng.poisson(300, size=(30, 40)).astype(dtype)
+    put_fits("tst/raw", "im.fits", image)
+    summary = get_image_summary("im.fits", "tst/raw")
+    assert summary["stats"] == compute_region_stats(image)
+    assert (summary["value_counts"] is None) == (dtype == np.float32)
+
+    # As if after a restart, with the decoded image evicted from the disk cache
+    image_cache.clear()
+    load_data.derived_cache.clear()
+    os.unlink(load_data.disk_cache.get_path(get_hdu_key(get_image_key("im.fits", "tst/raw"))))
+    fake_s3.requests.clear()
+
+    stats = get_image_stats("im.fits", "tst/raw")
+    histogram = get_image_histogram("im.fits", "tst/raw")
+    assert not fake_s3.requests
+    assert stats == pytest.approx(summary["stats"])
+    np.testing.assert_array_equal(histogram["cumulative"], summary["histogram"]["cumulative"])
+
+
+def test_subregion_mean_std_use_the_region_index(fake_s3, put_fits):
+    rng = np.random.default_rng(12)
+    image = rng.poisson(300, size=(200, 300)).astype(np.uint16)
+    put_fits("tst/raw", "im.fits", image)
+    get_image_data("im.fits", "tst/raw")  # the indexes are only used once the full frame is cached
+    subregion = {"x0": 0.1, "x1": 0.9, "y0": 0.2, "y1": 0.7}
+    stats = get_image_stats("im.fits", "tst/raw", subregion, which=("mean", "std", "min", "max"))
+    expected = compute_region_stats(image[40:140, 30:270], which=("mean", "std", "min", "max"))
+    assert stats == pytest.approx(expected)
+    assert len(load_data.derived_cache) == 1  # the index, and no cached per-subregion results
+
+
+def test_first_subregion_stats_only_read_the_subregion(fake_s3, put_fits):
+    rng = np.random.default_rng(14)
+    image = rng.poisson(300, size=(200, 300)).astype(np.uint16)
+    body = put_fits("tst/raw", "im.fits", image)
+    subregion = {"x0": 0.1, "x1": 0.9, "y0": 0.2, "y1": 0.3}
+    stats = get_image_stats("im.fits", "tst/raw", subregion)
+    assert stats == pytest.approx(compute_region_stats(image[40:60, 30:270]))
+    # Neither the full frame nor its summary and indexes were needed
+    assert len(load_data.image_cache) == 0
+    image_key = load_data.get_image_key("im.fits", "tst/raw")
+    for name in ("summary", "region_index", "histogram_index"):
+        assert image_key + (name,) not in load_data.derived_cache
+    ranges = [r[2][len("bytes="):].split("-") for r in fake_s3.requests if r[0] == "get_object"]
+    assert sum(int(end) + 1 - int(start) for start, end in ranges) < len(body) / 2
+
+
+def test_subregion_order_stats_use_the_histogram_index(fake_s3, put_fits):
+    rng = np.random.default_rng(13)
+    image = rng.poisson(300, size=(200, 300)).astype(np.uint16)
+    put_fits("tst/raw", "im.fits", image)
+    get_image_data("im.fits", "tst/raw")
+    expected = compute_region_stats(image[40:140, 30:270])
+    subregion = {"x0": 0.1, "x1": 0.9, "y0": 0.2, "y1": 0.7}
+    for _ in range(2):  # building, then reusing the indexes
+        stats = get_image_stats("im.fits", "tst/raw", subregion)
+        assert stats == pytest.approx(expected)
+        assert stats["median"] == expected["median"]
+        assert stats["median_abs_deviation"] == expected["median_abs_deviation"]
+
+    stats, errors = get_approximate_stats("im.fits", "tst/raw", subregion)
+    assert abs(stats["median"] - expected["median"]) <= errors["median"]
+    assert errors["mean"] == 0 and stats["mean"] == pytest.approx(expected["mean"])
+
+
+def test_first_approximate_stats_only_read_the_subregion(fake_s3, put_fits):
+    rng = np.random.default_rng(15)
+    image = rng.poisson(300, size=(200, 300)).astype(np.uint16)
+    put_fits("tst/raw", "im.fits", image)
+    subregion = {"x0": 0.1, "x1": 0.9, "y0": 0.2, "y1": 0.3}
+    stats, errors = get_approximate_stats("im.fits", "tst/raw", subregion, which=("median", "mean"))
+    # Without the cached frame the stats are exact
+    expected = compute_region_stats(image[40:60, 30:270], which=("median", "mean"))
+    assert stats == pytest.approx(expected)
+    assert errors == {"median": 0, "mean": 0}
+    assert len(load_data.image_cache) == 0
+    image_key = load_data.get_image_key("im.fits", "tst/raw")
+    for name in ("summary", "histogram_index"):
+        assert image_key + (name,) not in load_data.derived_cache
+
+
+def test_list_images_pages_through_the_listing(fake_s3, monkeypatch):
+    for name in ("b.fits", "a.fits.bz2", "c.jpg", "c.fits.fz", "other.fits"):
+        fake_s3.put_object(Bucket=settings.S3_BUCKET, Key=f"session/{name}", Body=b"")
+    monkeypatch.setattr(fake_s3, "list_objects_v2", functools.partial(fake_s3.list_objects_v2, MaxKeys=2))
+    assert load_data.list_images("session") == ["a.fits.bz2", "b.fits", "c.fits.fz", "other.fits"]
+    assert load_data.list_images("session", "b") == ["b.fits"]
+    # The listed metadata is cached
+    fake_s3.requests.clear()
+    assert load_data.get_image_metadata("b.fits", "session")["size"] == 0
+    assert not fake_s3.requests
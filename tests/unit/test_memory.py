@@ -0,0 +1,91 @@
+"""Peak memory used by the endpoints, beyond the cached image itself.
+
+Frames are shared read-only from the caches, so an analysis should only
+allocate small, bounded temporaries (or, for the order statistics of float
+data, a single sorted copy), never convert or duplicate the whole frame.
+"""
+import json
+import tracemalloc
+
+import pytest
+import numpy as np
+
+from application import app
+from quickanalysis import settings
+from quickanalysis.utils import pools
+from quickanalysis.utils.load_data import get_image_data
+
+S3_DIRECTORY = "tst/raw"
+SHAPE = (3000, 3000)
+# Allowance for the bounded temporaries of the chunked passes (a few blocks
+# of COUNT_CHUNK_SIZE bin indices), which don't grow with the frame.
+TEMPORARY_BYTES = 8 << 20
+SUBREGION = {"x0": 0.1, "x1": 0.8, "y0": 0.15, "y1": 0.9}
+
+REQUESTS = [
+    ("/statistics", {}),
+    ("/statistics", {"subregion": SUBREGION}),
+    ("/statistics", {"subregion": SUBREGION, "approximate": True, "stats": ["median", "mean"]}),
+    ("/histogram-clipped", {"clip_percent": 0.01}),
+    ("/histogram-clipped", {"clip_percent": 0.01, "subregion": SUBREGION}),
+    ("/histogram-lod", {"max_bins": 500}),
+    ("/histogram-lod", {"max_bins": 500, "subregion": SUBREGION}),
+    ("/lineprofile", {"start": {"x": 0, "y": 0}, "end": {"x": 1, "y": 1}, "linewidth": 3}),
+    ("/batch", {"operations": [
+        {"type": "statistics", "subregion": SUBREGION},
+        {"type": "histogram", "clip_percent": 0.01},
+        {"type": "lineprofile", "start": {"x": 0, "y": 0.5}, "end": {"x": 1, "y": 0.5}},
+    ]}),
+]
+
+
+def measure_peak(function):
+    """ Return the most memory allocated while `function` runs, above what it leaves allocated. """
+    tracemalloc.start()
+    try:
+        function()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - current
+
+
+@pytest.fixture
+def frame(fake_s3, put_fits, monkeypatch, request):
+    monkeypatch.setattr(settings, "IMAGE_LOADER", "stream")
+    # Reduce the bands serially, so the temporaries don't depend on the number of cores
+    monkeypatch.setattr(pools, "stats_pool", None)
+    rng = np.random.default_rng(21)
+    image = rng.normal(1000, 30, size=SHAPE).astype(request.param)
+    put_fits(S3_DIRECTORY, "im.fits", image)
+    return image
+
+
+@pytest.mark.parametrize("frame", [np.uint16, np.int16, np.float32], indirect=True)
+def test_loading_decodes_in_place(frame):
+    tracemalloc.start()
+    try:
+        data = get_image_data("im.fits", S3_DIRECTORY)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert data.dtype.isnative and not data.flags.writeable
+    np.testing.assert_array_equal(data, frame)
+    assert peak < frame.nbytes + TEMPORARY_BYTES
+
+
+@pytest.mark.parametrize("frame", [np.uint16, np.float32], indirect=True)
+@pytest.mark.parametrize("route, body", REQUESTS)
+def test_endpoint_peak_memory(frame, route, body):
+    client = app.test_client()
+    get_image_data("im.fits", S3_DIRECTORY)
+    body = dict(body, full_filename="im.fits", s3_directory=S3_DIRECTORY)
+
+    def run():
+        response = client.post(route, data=json.dumps(body))
+        assert response.status_code == 200, response.get_json()
+
+    peak = measure_peak(run)
+    # Float order statistics need one sorted copy; integer data is never copied
+    copies = 1 if frame.dtype.kind == 'f' else 0
+    assert peak < copies * frame.nbytes + TEMPORARY_BYTES, f"{route} allocated {peak / frame.nbytes:.2f} frames"
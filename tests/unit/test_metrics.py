@@ -0,0 +1,78 @@
+import time
+
+import pytest
+
+from quickanalysis.utils import metrics
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_nested_spans_only_count_their_own_time():
+    request = metrics.start_request('/test')
+    with metrics.span('decode'):
+        with metrics.span('fetch'):
+            time.sleep(0.02)
+        time.sleep(0.01)
+    metrics.finish_request(200)
+
+    assert request.stages['fetch'] >= 0.02
+    assert 0.01 <= request.stages['decode'] < 0.02
+    # The rest of the request counts as compute
+    assert request.stages['compute'] < 0.01
+    assert metrics.stage_seconds.count(('/test', 'fetch')) == 1
+    assert metrics.request_seconds.count(('/test', '200')) == 1
+
+
+def test_spans_outside_requests_are_background():
+    with metrics.span('fetch'):
+        pass
+    metrics.add_bytes_fetched(10)
+    assert metrics.stage_seconds.count((metrics.BACKGROUND, 'fetch')) == 1
+    assert metrics.bytes_fetched.get((metrics.BACKGROUND,)) == 10
+
+
+def test_finish_request_logs_the_stages(caplog):
+    caplog.set_level('INFO', logger=metrics.logger.name)
+    metrics.start_request('/test')
+    metrics.add_bytes_fetched(100)
+    metrics.finish_request(404)
+    record = caplog.records[-1]
+    assert '"route": "/test"' in record.message
+    assert '"status": 404' in record.message
+    assert '"bytes_fetched": 100' in record.message
+    # Nothing to do once the request is finished
+    metrics.finish_request(500)
+    assert metrics.request_seconds.count(('/test', '500')) == 0
+
+
+def test_histogram_render():
+    histogram = metrics.Histogram('test_seconds', 'Help text.', ('route',), buckets=(0.1, 1))
+    histogram.observe(('/a',), 0.05)
+    histogram.observe(('/a',), 0.5)
+    histogram.observe(('/a',), 5)
+    assert histogram.render() == [
+        '# HELP test_seconds Help text.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{route="/a",le="0.1"} 1',
+        'test_seconds_bucket{route="/a",le="1"} 2',
+        'test_seconds_bucket{route="/a",le="+Inf"} 3',
+        'test_seconds_sum{route="/a"} 5.55',
+        'test_seconds_count{route="/a"} 3',
+    ]
+
+
+def test_render_load_stats():
+    lines = metrics.render_load_stats({
+        'image_cache': {'hits': 3, 'misses': 1, 'current_bytes': 10},
+        'image_loads': {'calls': 2, 'in_flight': 0},
+    })
+    assert 'quickanalysis_cache_hits_total{cache="image_cache"} 3' in lines
+    assert 'quickanalysis_cache_hit_ratio{cache="image_cache"} 0.75' in lines
+    assert 'quickanalysis_cache_current_bytes{cache="image_cache"} 10' in lines
+    assert '# TYPE quickanalysis_image_loads_calls_total counter' in lines
+    assert 'quickanalysis_image_loads_in_flight 0' in lines
@@ -0,0 +1,69 @@
+import pytest
+import numpy as np
+
+from quickanalysis.analysis.operations import get_clipped_histogram
+from quickanalysis.analysis.operations import run_operations
+from quickanalysis.analysis.region_stats import compute_region_stats
+
+
+@pytest.fixture
+def image():
+    rng = np.random.default_rng(3)
+    return rng.poisson(200, size=(40, 60)).astype(np.uint16)
+
+
+SUBREGION = {"x0": 0.1, "x1": 0.6, "y0": 0.2, "y1": 0.9}
+
+
+def test_run_operations_matches_single_operations(image):
+    operations = [
+        {"type": "lineprofile", "start": {"x": 0, "y": 0}, "end": {"x": 1, "y": 1}},
+        {"type": "statistics"},
+        {"type": "statistics", "subregion": SUBREGION},
+        {"type": "histogram", "clip_percent": 0.05, "subregion": SUBREGION},
+        {"type": "histogram", "clip_percent": 0.01},
+    ]
+    results = run_operations(image, operations)
+    assert [r["type"] for r in results] == [op["type"] for op in operations]
+    assert all(r["success"] for r in results)
+
+    region = image[8:36, 6:36]
+    assert results[1]["stats"] == compute_region_stats(image)
+    assert results[2]["stats"] == compute_region_stats(region)
+    expected = get_clipped_histogram(region, 0.05)
+    np.testing.assert_array_equal(results[3]["histogram"]["counts"], expected["counts"])
+    assert results[3]["histogram"]["stats"] == expected["stats"]
+
+
+def test_failed_operation_does_not_affect_others(image):
+    results = run_operations(image, [
+        {"type": "nonsense"},
+        {"type": "lineprofile", "start": {"x": 0, "y": 0}, "end": {"x": 2, "y": 1}},
+        {"type": "histogram"},
+        {"type": "statistics"},
+    ])
+    assert [r["success"] for r in results] == [False, False, False, True]
+    assert "Unknown operation" in results[0]["message"]
+
+
+def test_bad_subregion_only_fails_its_operation(image):
+    results = run_operations(image, [
+        {"type": "statistics", "subregion": {"x0": [0], "x1": 1, "y0": 0, "y1": 1}},
+        {"type": "histogram", "clip_percent": 0.05, "subregion": "everything"},
+        {"type": "statistics", "subregion": SUBREGION},
+    ])
+    assert [r["success"] for r in results] == [False, False, True]
+    assert results[2]["stats"] == compute_region_stats(image[8:36, 6:36])
+
+
+def test_line_profiles_are_grouped_by_options(image):
+    operations = [
+        {"type": "lineprofile", "start": {"x": 0, "y": 0}, "end": {"x": 1, "y": 1}},
+        {"type": "lineprofile", "start": {"x": 0, "y": 0.5}, "end": {"x": 1, "y": 0.5}, "linewidth": 3},
+        {"type": "lineprofile", "start": {"x": 0.2, "y": 0}, "end": {"x": 0.2, "y": 1}},
+    ]
+    batched = run_operations(image, operations)
+    single = [run_operations(image, [operation])[0] for operation in operations]
+    for batched_result, single_result in zip(batched, single):
+        np.testing.assert_array_equal(batched_result["data"], single_result["data"])
+    assert len(batched[0]["data"]) != len(batched[2]["data"])
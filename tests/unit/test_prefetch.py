@@ -0,0 +1,44 @@
+import threading
+
+from quickanalysis.utils.prefetch import PrefetchQueue
+
+
+def test_newest_first_and_bounded():
+    started = threading.Event()
+    release = threading.Event()
+    processed = []
+
+    def run(key):
+        if key == "blocker":
+            started.set()
+            release.wait(5)
+        processed.append(key)
+
+    queue = PrefetchQueue(run, max_size=3, workers=1)
+    queue.put("blocker")
+    assert started.wait(5)
+    for key in ["a", "b", "c", "d", "b"]:
+        queue.put(key)
+    release.set()
+    assert queue.join(5)
+
+    # "a" was dropped when "d" arrived, and "b" was moved to the front
+    assert processed == ["blocker", "b", "d", "c"]
+    stats = queue.stats()
+    assert stats["dropped"] == 1
+    assert stats["completed"] == 4
+    assert stats["waiting"] == stats["running"] == 0
+
+
+def test_failures_are_counted_and_logged(caplog):
+    def run(key):
+        raise ValueError(key)
+
+    queue = PrefetchQueue(run, max_size=2, workers=2)
+    queue.put("x")
+    assert queue.join(5)
+    assert queue.stats()["failed"] == 1
+    [record] = [r for r in caplog.records if r.name == "quickanalysis.utils.prefetch"]
+    assert record.levelname == "ERROR"
+    assert record.getMessage() == "prefetch of x failed"
+    assert record.exc_info[0] is ValueError
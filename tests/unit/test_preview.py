@@ -0,0 +1,119 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from quickanalysis.analysis.preview import encode_preview
+from quickanalysis.analysis.preview import get_preview_shape
+from quickanalysis.analysis.preview import get_stretch_parameters
+from quickanalysis.analysis.preview import midtones_transfer
+from quickanalysis.analysis.preview import render_preview
+from quickanalysis.analysis.pyramid import build_pyramid
+from quickanalysis.analysis.region_stats import compute_region_stats
+
+
+@pytest.fixture
+def frame():
+    rng = np.random.default_rng(3)
+    return rng.poisson(200, size=(600, 900)).astype(np.uint16)
+
+
+def test_midtones_transfer():
+    x = np.array([0, 0.1, 1])
+    np.testing.assert_allclose(midtones_transfer(0.1, x), [0, 0.5, 1])
+    np.testing.assert_allclose(midtones_transfer(0.5, x), x)
+
+
+def test_auto_stretch_puts_the_median_on_the_target_background(frame):
+    stretch = get_stretch_parameters(compute_region_stats(frame))
+    assert 0 < stretch['black'] < np.median(frame) < stretch['white'] == frame.max()
+
+    preview = render_preview([frame.astype(np.float32)], stretch, 900)
+    assert preview.dtype == np.uint8
+    assert abs(np.median(preview) - 0.25 * 255) <= 2
+
+
+def screen_transfer_function(frame):
+    """ Reference auto stretch of a full frame, straight from its pixels. """
+    x = frame.astype(np.float64) / frame.max()
+    median = np.median(x)
+    sigma = 1.4826 * np.median(np.abs(x - median))
+    black = max(median - 1.25 * sigma, 0)
+    midtone = midtones_transfer(0.25, (median - black) / (1 - black))
+    return midtones_transfer(midtone, np.clip((x - black) / (1 - black), 0, 1))
+
+
+def test_auto_stretch_matches_the_screen_transfer_function(frame):
+    stretch = get_stretch_parameters(compute_region_stats(frame))
+    preview = render_preview([frame], stretch, 900)
+    expected = np.rint(screen_transfer_function(frame) * 255)
+    assert np.abs(preview - expected).max() <= 1
+
+
+def test_linear_stretch(frame):
+    stats = compute_region_stats(frame)
+    stretch = get_stretch_parameters(stats, 'linear')
+    assert stretch == {'black': stats['min'], 'white': stats['max'], 'midtone': 0.5}
+    preview = render_preview([frame], stretch, 900)
+    assert preview.min() == 0 and preview.max() == 255
+
+
+def test_flat_image_is_black():
+    frame = np.full((20, 30), 7, dtype=np.uint16)
+    for name in ('auto', 'linear'):
+        preview = render_preview([frame], get_stretch_parameters(compute_region_stats(frame), name), 30)
+        assert not preview.any()
+
+
+def test_unknown_stretch(frame):
+    with pytest.raises(ValueError):
+        get_stretch_parameters(compute_region_stats(frame), 'log')
+
+
+def test_preview_shape():
+    assert get_preview_shape((600, 900), 300) == (200, 300)
+    assert get_preview_shape((900, 600), 300) == (300, 200)
+    assert get_preview_shape((20, 30), 300) == (20, 30)
+
+
+def test_preview_reads_a_downsampled_level(frame):
+    pyramid = build_pyramid(frame, min_size=100)
+    # The full resolution level is not read
+    pyramid[0] = np.broadcast_to(np.float32(np.nan), frame.shape)
+    stretch = get_stretch_parameters(compute_region_stats(frame))
+    preview = render_preview(pyramid, stretch, 300)
+    assert preview.shape == (200, 300)
+    assert preview.any()
+
+
+def test_preview_keeps_nans_black():
+    frame = np.arange(100, dtype=np.float32).reshape(10, 10)
+    frame[0, 0] = np.nan
+    preview = render_preview([frame], {'black': 0.0, 'white': 99.0, 'midtone': 0.5}, 10)
+    assert preview[0, 0] == 0
+    assert preview[-1, -1] == 255
+
+
+@pytest.mark.parametrize('image_format', ['png', 'webp'])
+def test_encode_preview(image_format):
+    preview = np.arange(200 * 300, dtype=np.uint32).reshape(200, 300).astype(np.uint8)
+    image = Image.open(io.BytesIO(encode_preview(preview, image_format)))
+    assert image.format == image_format.upper()
+    assert image.size == (300, 200)
+    if image_format == 'png':
+        np.testing.assert_array_equal(np.asarray(image), preview)
+
+
+def test_encode_preview_draws_line_over_a_copy():
+    preview = np.zeros((100, 200), dtype=np.uint8)
+    image = np.asarray(Image.open(io.BytesIO(encode_preview(preview, 'png', (0, 0, 1, 0)))))
+    assert image.shape == (100, 200, 3)
+    assert (image[0, :, 0] == 255).all()
+    assert not image[1:].any()
+    assert not preview.any()
+
+
+def test_encode_preview_unknown_format():
+    with pytest.raises(ValueError):
+        encode_preview(np.zeros((2, 2), dtype=np.uint8), 'gif')
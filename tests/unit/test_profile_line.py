@@ -1,11 +1,13 @@
 import pytest
 import numpy as np
 import base64
+from skimage.measure import profile_line
 from mimetypes import guess_extension
 
 from quickanalysis.analysis.profile_line import get_intensity_profile
 from quickanalysis.analysis.profile_line import get_intensity_profile_input_plot
 from quickanalysis.analysis.profile_line import get_pixel_dimensions
+from quickanalysis.analysis.profile_line import get_intensity_profiles
 
 
 @pytest.fixture
@@ -126,3 +128,47 @@ def test_profile_line_vertical_y_gradient(y_gradient_image):
 
     # All values should be increasing (ie. different)
     assert len(set(profile)) == len(profile)
+
+
+def test_input_plot_of_large_image_uses_pyramid():
+    image = np.tile(np.arange(2000, dtype=np.uint16), (1500, 1))
+    plot = get_intensity_profile_input_plot(image, (0, 0), (1, 1))
+    assert plot.startswith("data:image/png;base64,")
+
+
+# Lines that stay inside the image even when widened, so that edge handling
+# differences between scipy versions don't matter.
+LINES = [
+    ((0.1, 0.2), (0.9, 0.7)),
+    ((0.5, 0.5), (0.5, 0.5)),
+    ((0.9, 0.1), (0.2, 0.8)),
+    ((0.05, 0.1), (0.95, 0.9)),
+]
+
+
+@pytest.mark.parametrize("linewidth", [1, 3, 4])
+@pytest.mark.parametrize("order", [0, 1])
+def test_intensity_profiles_match_skimage(linewidth, order):
+    rng = np.random.default_rng(0)
+    image = rng.random((50, 70))
+    profiles, lengths = get_intensity_profiles(image, LINES, linewidth=linewidth, order=order)
+    assert profiles.shape == (len(LINES), lengths.max())
+    for i, (start, end) in enumerate(LINES):
+        x0, y0, x1, y1 = get_pixel_dimensions(image, start, end)
+        expected = profile_line(image, [y0, x0], [y1, x1], linewidth=linewidth, order=order,
+                                mode="constant", cval=-1)
+        assert lengths[i] == len(expected)
+        np.testing.assert_allclose(profiles[i, :lengths[i]], expected)
+        assert np.isnan(profiles[i, lengths[i]:]).all()
+
+
+def test_intensity_profiles_of_integer_image_are_interpolated(x_gradient_image):
+    image = (x_gradient_image * 2).astype(np.uint16)  # 0, 1, 2... across x
+    profiles, lengths = get_intensity_profiles(image, [((0, 0), (0.25, 0))])
+    np.testing.assert_allclose(profiles[0, :lengths[0]], [0, 0.75, 1.5])
+
+
+def test_intensity_profiles_no_lines(x_gradient_image):
+    profiles, lengths = get_intensity_profiles(x_gradient_image, [])
+    assert profiles.shape == (0, 0)
+    assert lengths.size == 0
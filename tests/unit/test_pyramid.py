@@ -0,0 +1,35 @@
+import pytest
+import numpy as np
+
+from quickanalysis.analysis.pyramid import build_pyramid
+from quickanalysis.analysis.pyramid import downsample_block_mean
+from quickanalysis.analysis.pyramid import get_pyramid_level
+
+
+def test_downsample_block_mean():
+    arr = np.array([
+        [0, 2, 4, 6, 9],
+        [2, 4, 6, 8, 9],
+        [1, 1, 1, 1, 9],
+    ], dtype=np.uint16)
+    np.testing.assert_array_equal(downsample_block_mean(arr), [[2, 6]])
+
+
+def test_build_pyramid_levels():
+    arr = np.ones((1000, 1500), dtype=np.uint16)
+    pyramid = build_pyramid(arr, min_size=100)
+    assert pyramid[0] is arr
+    assert [level.shape for level in pyramid[1:]] == [(500, 750), (250, 375), (125, 187)]
+
+
+def test_build_pyramid_small_image():
+    arr = np.ones((10, 10))
+    assert len(build_pyramid(arr)) == 1
+
+
+@pytest.mark.parametrize("min_size, expected_factor", [(100, 8), (300, 4), (750, 2), (1500, 1), (5000, 1)])
+def test_get_pyramid_level(min_size, expected_factor):
+    pyramid = build_pyramid(np.ones((1000, 1500)), min_size=100)
+    level, factor = get_pyramid_level(pyramid, min_size)
+    assert factor == expected_factor
+    assert level is pyramid[{1: 0, 2: 1, 4: 2, 8: 3}[factor]]
@@ -0,0 +1,98 @@
+import pytest
+import numpy as np
+
+from quickanalysis.analysis.region_index import ORDER_INDEXED_STATS
+from quickanalysis.analysis.region_index import build_histogram_index
+from quickanalysis.analysis.region_index import build_region_index
+from quickanalysis.analysis.region_index import get_approximate_order_stats
+from quickanalysis.analysis.region_index import get_indexed_order_stats
+from quickanalysis.analysis.region_index import get_indexed_stats
+from quickanalysis.analysis.region_index import split_rect
+from quickanalysis.analysis.region_index import supports_region_index
+from quickanalysis.analysis.region_stats import compute_region_stats
+from quickanalysis.analysis.region_stats import get_value_counts
+
+
+@pytest.fixture
+def uint16_image():
+    """ A 16-bit frame whose sides aren't multiples of the tile size. """
+    rng = np.random.default_rng(9)
+    data = rng.poisson(1000, size=(203, 150)).astype(np.uint16)
+    data[100, 7] = 65535
+    data[3, 140] = 0
+    return data
+
+
+RECTS = [
+    (0, 203, 0, 150),    # whole image
+    (10, 20, 30, 40),    # inside one tile
+    (5, 190, 17, 149),   # whole tiles and strips on every side
+    (32, 96, 64, 128),   # exactly whole tiles
+    (100, 203, 60, 150), # reaching the partial tiles at the edges
+    (0, 1, 0, 150),      # a single row
+]
+
+
+@pytest.mark.parametrize("rect", RECTS)
+def test_indexed_stats_match_region_stats(uint16_image, rect):
+    index = build_region_index(uint16_image, tile_size=32)
+    ystart, yend, xstart, xend = rect
+    result = get_indexed_stats(index, uint16_image, *rect)
+    expected = compute_region_stats(uint16_image[ystart:yend, xstart:xend], which=result.keys())
+    assert result["min"] == expected["min"] and result["max"] == expected["max"]
+    assert result["mean"] == pytest.approx(expected["mean"], rel=1e-12)
+    assert result["std"] == pytest.approx(expected["std"], rel=1e-12)
+
+
+@pytest.mark.parametrize("rect", RECTS)
+def test_split_rect_covers_the_rect_once(uint16_image, rect):
+    index = build_region_index(uint16_image, tile_size=32)
+    tiles, strips = split_rect(index, *rect)
+    covered = np.zeros(uint16_image.shape, dtype=int)
+    if tiles is not None:
+        covered[tiles[0] * 32:tiles[1] * 32, tiles[2] * 32:tiles[3] * 32] += 1
+    for ystart, yend, xstart, xend in strips:
+        covered[ystart:yend, xstart:xend] += 1
+    expected = np.zeros(uint16_image.shape, dtype=int)
+    expected[rect[0]:rect[1], rect[2]:rect[3]] = 1
+    np.testing.assert_array_equal(covered, expected)
+
+
+def test_supports_region_index():
+    assert supports_region_index(np.zeros((2, 2), dtype=np.uint16))
+    assert not supports_region_index(np.zeros((2, 2), dtype=np.int32))
+    assert not supports_region_index(np.zeros((2, 2), dtype=np.float32))
+    with pytest.raises(ValueError):
+        build_region_index(np.zeros((2, 2), dtype=np.float32))
+
+
+@pytest.mark.parametrize("rect", RECTS)
+@pytest.mark.parametrize("bins", [1, 16, 256])
+def test_indexed_order_stats_match_region_stats(uint16_image, rect, bins):
+    index = build_histogram_index(uint16_image, get_value_counts(uint16_image), tile_size=32, bins=bins)
+    ystart, yend, xstart, xend = rect
+    percentiles = (0, 0.5, 25, 99.5, 100)
+    result = get_indexed_order_stats(index, uint16_image, *rect, percentiles=percentiles)
+    expected = compute_region_stats(
+        uint16_image[ystart:yend, xstart:xend], which=ORDER_INDEXED_STATS, percentiles=percentiles)
+    assert result == expected
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.int16])
+def test_indexed_order_stats_other_dtypes(dtype):
+    rng = np.random.default_rng(4)
+    data = rng.normal(100, 20, size=(70, 90)).astype(dtype)
+    index = build_histogram_index(data, get_value_counts(data), tile_size=16)
+    result = get_indexed_order_stats(index, data, 3, 61, 5, 80)
+    assert result == compute_region_stats(data[3:61, 5:80], which=ORDER_INDEXED_STATS)
+
+
+@pytest.mark.parametrize("rect", RECTS)
+def test_approximate_order_stats_are_within_their_bound(uint16_image, rect):
+    index = build_histogram_index(uint16_image, get_value_counts(uint16_image), tile_size=32, bins=16)
+    ystart, yend, xstart, xend = rect
+    result, errors = get_approximate_order_stats(index, uint16_image, *rect, percentiles=(1, 99))
+    region = uint16_image[ystart:yend, xstart:xend]
+    assert abs(result["median"] - np.median(region)) <= errors["median"]
+    for q in (1, 99):
+        assert abs(result["percentiles"][q] - np.percentile(region, q)) <= errors["percentiles"][q]
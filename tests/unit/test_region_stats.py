@@ -0,0 +1,105 @@
+import pytest
+import numpy as np
+from scipy import stats as scipy_stats
+
+from quickanalysis.analysis import region_stats
+from quickanalysis.analysis.region_stats import compute_region_stats
+from quickanalysis.analysis.region_stats import get_value_counts
+
+
+@pytest.fixture
+def uint16_image():
+    """ A small 16-bit frame with a sky background and a few bright pixels. """
+    rng = np.random.default_rng(42)
+    data = rng.poisson(150, size=(60, 80)).astype(np.uint16)
+    data[10, 10] = 64000
+    data[20, 30] = 51
+    return data
+
+
+def reference_stats(arr):
+    flat = arr.ravel()
+    values, counts = np.unique(flat, return_counts=True)
+    return {
+        "median": np.median(arr),
+        "mean": np.mean(arr),
+        "mode": values[np.argmax(counts)],
+        "min": np.min(arr),
+        "max": np.max(arr),
+        "std": np.std(arr),
+        "median_abs_deviation": scipy_stats.median_abs_deviation(flat),
+    }
+
+
+def assert_matches_reference(result, arr):
+    expected = reference_stats(arr)
+    assert set(result) == set(expected)
+    for name, value in expected.items():
+        assert result[name] == pytest.approx(value), name
+
+
+def test_value_counts_uint16(uint16_image):
+    low_val, counts = get_value_counts(uint16_image)
+    assert low_val == 0
+    assert counts.size == 2**16
+    assert counts.sum() == uint16_image.size
+    assert counts[64000] == 1
+
+
+def test_value_counts_offsets_wide_integers():
+    arr = np.array([[-5, 3], [1000, 3]], dtype=np.int32)
+    low_val, counts = get_value_counts(arr)
+    assert low_val == -5
+    assert counts[3 - low_val] == 2
+
+
+def test_value_counts_not_available_for_floats():
+    assert get_value_counts(np.ones((3, 3))) is None
+
+
+def test_integer_stats_match_reference(uint16_image):
+    assert_matches_reference(compute_region_stats(uint16_image), uint16_image)
+
+
+def test_integer_stats_even_number_of_pixels():
+    # An even pixel count means the median falls between two values
+    arr = np.array([[1, 2], [3, 10]], dtype=np.int16)
+    assert_matches_reference(compute_region_stats(arr), arr)
+
+
+def test_integer_stats_on_subregion_view(uint16_image):
+    view = uint16_image[5:40, 7:33]
+    assert_matches_reference(compute_region_stats(view), view)
+
+
+def test_float_stats_match_reference(uint16_image):
+    arr = uint16_image.astype(np.float32) / 3
+    assert_matches_reference(compute_region_stats(arr), arr)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 100])
+def test_float_stats_in_small_blocks(uint16_image, monkeypatch, chunk_size):
+    # Runs of equal values (and the counted rows) span several blocks
+    monkeypatch.setattr(region_stats, "COUNT_CHUNK_SIZE", chunk_size)
+    arr = (uint16_image // 4).astype(np.float32)
+    assert_matches_reference(compute_region_stats(arr), arr)
+    assert_matches_reference(compute_region_stats(uint16_image), uint16_image)
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.float64])
+def test_percentiles_match_numpy(uint16_image, dtype):
+    arr = uint16_image.astype(dtype)
+    qs = (0, 1.5, 25, 50, 99.9, 100)
+    result = compute_region_stats(arr, which=(), percentiles=qs)
+    for q in qs:
+        assert result["percentiles"][q] == pytest.approx(np.percentile(arr, q))
+
+
+def test_only_requested_stats_are_returned(uint16_image):
+    result = compute_region_stats(uint16_image, which=("min", "max"))
+    assert set(result) == {"min", "max"}
+
+
+def test_unknown_stat_raises(uint16_image):
+    with pytest.raises(ValueError):
+        compute_region_stats(uint16_image, which=("skew",))
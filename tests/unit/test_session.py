@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from quickanalysis.analysis.region_stats import compute_region_stats
+from quickanalysis.analysis.session import build_session_table
+from quickanalysis.utils.load_data import build_summary
+
+
+@pytest.fixture
+def summaries():
+    rng = np.random.default_rng(11)
+    frames = [rng.poisson(background, size=(20, 30)).astype(np.uint16) for background in (100, 120, 140)]
+    return frames, [build_summary(frame) for frame in frames]
+
+
+def test_session_table_columns(summaries):
+    frames, summaries = summaries
+    table = build_session_table(summaries, which=('median', 'max'))
+    assert set(table['stats']) == {'median', 'max'}
+    assert 'histograms' not in table
+    for name, column in table['stats'].items():
+        assert column.dtype == np.float64
+        assert column.tolist() == [compute_region_stats(frame)[name] for frame in frames]
+
+
+def test_session_table_histograms_share_edges(summaries):
+    frames, summaries = summaries
+    table = build_session_table(summaries, which=(), histogram_bins=10)
+    edges = table['histograms']['edges']
+    assert edges[0] == min(frame.min() for frame in frames)
+    assert edges[-1] == max(frame.max() for frame in frames)
+    counts = table['histograms']['counts']
+    assert counts.shape == (3, 10)
+    for row, frame in zip(counts, frames):
+        np.testing.assert_array_equal(row, np.histogram(frame, np.ceil(edges))[0])
+
+
+def test_session_table_histogram_window(summaries):
+    _, summaries = summaries
+    table = build_session_table(summaries, which=(), histogram_bins=4, lo=100, hi=140)
+    np.testing.assert_array_equal(table['histograms']['edges'], [100, 110, 120, 130, 140])
+    with pytest.raises(ValueError):
+        build_session_table(summaries, histogram_bins=4, lo=140, hi=100)
+
+
+def test_empty_session():
+    table = build_session_table([], which=('mean',), histogram_bins=3)
+    assert table['stats']['mean'].size == 0
+    assert table['histograms']['counts'].shape == (0, 3)
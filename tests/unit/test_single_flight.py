@@ -0,0 +1,43 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from quickanalysis.utils.single_flight import SingleFlight
+
+
+def test_concurrent_calls_share_one_result():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def load():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return object()
+
+    with ThreadPoolExecutor(5) as pool:
+        leader = pool.submit(flight.do, "key", load)
+        started.wait(5)
+        followers = [pool.submit(flight.do, "key", load) for _ in range(4)]
+        time.sleep(0.1)  # let the followers start waiting
+        release.set()
+        results = [leader.result()] + [f.result() for f in followers]
+
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert len(flight) == 0
+
+
+def test_exceptions_are_shared_and_forgotten():
+    flight = SingleFlight()
+
+    def fail():
+        raise KeyError("missing")
+
+    with pytest.raises(KeyError):
+        flight.do("key", fail)
+    assert flight.do("key", lambda: 3) == 3
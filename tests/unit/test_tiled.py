@@ -0,0 +1,76 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import numpy as np
+
+from quickanalysis.analysis import tiled
+from quickanalysis.analysis.histogram import build_full_histogram
+from quickanalysis.analysis.histogram import get_histogram
+from quickanalysis.analysis.region_stats import compute_region_stats
+from quickanalysis.analysis.region_stats import get_value_counts
+from quickanalysis.utils import pools
+
+# Several bands of rows
+SHAPE = (900, 1000)
+
+
+@pytest.fixture
+def stats_pool():
+    pool = ThreadPoolExecutor(4)
+    yield pool
+    pool.shutdown()
+
+
+def run_serial_and_parallel(monkeypatch, stats_pool, function):
+    monkeypatch.setattr(pools, "stats_pool", None)
+    serial = function()
+    monkeypatch.setattr(pools, "stats_pool", stats_pool)
+    return serial, function()
+
+
+def test_row_bands_cover_the_array():
+    arr = np.arange(SHAPE[0] * SHAPE[1]).reshape(SHAPE)
+    bands = tiled.get_row_bands(arr)
+    assert len(bands) > 1
+    np.testing.assert_array_equal(np.concatenate(bands), arr)
+    assert len(tiled.get_row_bands(np.zeros((0, 5)))) == 1
+
+
+def test_map_bands_keeps_the_band_order(monkeypatch, stats_pool):
+    monkeypatch.setattr(pools, "stats_pool", stats_pool)
+    arr = np.arange(SHAPE[0] * SHAPE[1]).reshape(SHAPE)
+    firsts = list(tiled.map_bands(lambda band: band[0, 0], arr))
+    assert firsts == [band[0, 0] for band in tiled.get_row_bands(arr)]
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.int32, np.float32, np.float64])
+def test_parallel_stats_are_identical(monkeypatch, stats_pool, dtype):
+    rng = np.random.default_rng(3)
+    scale = 1000 if dtype == np.int32 else 1  # a wide range of values
+    arr = (rng.normal(1000, 50, size=SHAPE) * scale).astype(dtype)
+    for data in (arr, arr[37:811, 120:977]):
+        serial, parallel = run_serial_and_parallel(
+            monkeypatch, stats_pool, lambda: compute_region_stats(data, percentiles=(1, 99)))
+        assert serial == parallel
+        expected = compute_region_stats(data, which=("mean", "std"))
+        assert expected["mean"] == pytest.approx(np.mean(data, dtype=np.float64), rel=1e-12)
+        assert expected["std"] == pytest.approx(np.std(data, dtype=np.float64), rel=1e-9)
+
+
+def test_parallel_value_counts_are_identical(monkeypatch, stats_pool):
+    arr = np.random.default_rng(4).integers(-100000, 100000, size=SHAPE, dtype=np.int32)
+    serial, parallel = run_serial_and_parallel(monkeypatch, stats_pool, lambda: get_value_counts(arr))
+    assert serial[0] == parallel[0]
+    np.testing.assert_array_equal(serial[1], parallel[1])
+
+
+def test_parallel_histograms_are_identical(monkeypatch, stats_pool):
+    arr = np.random.default_rng(5).normal(0, 1, size=SHAPE).astype(np.float32)
+    serial, parallel = run_serial_and_parallel(
+        monkeypatch, stats_pool, lambda: (get_histogram(arr, clip_percent=0.01), build_full_histogram(arr)))
+    (serial_counts, serial_edges), serial_full = serial
+    (counts, edges), full = parallel
+    np.testing.assert_array_equal(counts, serial_counts)
+    np.testing.assert_array_equal(edges, serial_edges)
+    np.testing.assert_array_equal(full["cumulative"], serial_full["cumulative"])
+    np.testing.assert_array_equal(counts, np.histogram(arr, bins=edges)[0])